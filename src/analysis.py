@@ -0,0 +1,230 @@
+"""Статистика по оценкам: согласованность оценщиков и сравнение вариантов видео.
+
+Оценки раскладываются в массив NumPy оценщик x видео x критерий (NaN - нет
+оценки), и все величины считаются по нему векторно:
+- альфа Криппендорфа (интервальная метрика) для каждого критерия;
+- среднее по каждому варианту видео (Человеческий, Сгенерированный, ...);
+- парные разности вариантов внутри одного оценщика.
+Доверительные интервалы - перцентильный бутстреп: веса ресэмплов -
+матрица кратностей, поэтому тысячи ресэмплов считаются несколькими
+матричными умножениями. Результат кэшируется по хешу массива.
+"""
+import hashlib
+import os
+import pickle
+from typing import NamedTuple
+import numpy as np
+import pandas as pd
+
+# Меняется при изменении расчёта, чтобы не брать из кэша старые результаты
+ANALYSIS_VERSION = 1
+CONFIDENCE = 0.95
+# Сколько элементов матрицы весов (ресэмплы x оценщики) строится за раз
+BOOTSTRAP_CHUNK_ELEMENTS = 1_000_000
+
+COLUMNS = ['section', 'criterion', 'variant', 'n', 'estimate', 'ci_low', 'ci_high']
+ALPHA_SECTION = "Альфа Криппендорфа"
+MEAN_SECTION = "Среднее по варианту"
+DIFF_SECTION = "Парная разность"
+
+
+class RatingArray(NamedTuple):
+    # (оценщики, видео, критерии), NaN - нет оценки
+    values: np.ndarray
+    # Актуальные file_id видео в порядке каталога
+    items: tuple
+    # Номер варианта для каждого видео
+    item_variants: np.ndarray
+    variants: tuple
+    criteria: tuple
+
+
+def _catalog_items(catalog):
+    """Видео каталога: (file_id по порядку, номера вариантов, варианты, video_id -> номер видео)"""
+    items, item_variants, variants = [], [], []
+    for videos in catalog.themes.values():
+        for file_id in videos:
+            variant = catalog.videos[file_id].variant
+            if variant not in variants:
+                variants.append(variant)
+            items.append(file_id)
+            item_variants.append(variants.index(variant))
+    item_index = {file_id: i for i, file_id in enumerate(items)}
+    video_items = {video_id: item_index[info.file_id] for video_id, info in catalog.videos.items()}
+    return items, item_variants, variants, video_items
+
+
+def build_array(ratings: pd.DataFrame, catalog) -> RatingArray:
+    """Массив из строк (user_id, video_id, criterion, score).
+
+    Старые file_id сводятся к актуальным по каталогу; оценки видео и
+    критериев, которых нет в каталоге, не учитываются.
+    """
+    items, item_variants, variants, video_items = _catalog_items(catalog)
+    item = ratings['video_id'].map(video_items)
+    criterion = ratings['criterion'].map(dict(catalog.criterion_index))
+    known = item.notna() & criterion.notna()
+    users, _ = pd.factorize(ratings.loc[known, 'user_id'], sort=True)
+    values = np.full((users.max() + 1 if len(users) else 0, len(items), len(catalog.criteria)), np.nan)
+    values[users, item[known].to_numpy(int), criterion[known].to_numpy(int)] = ratings.loc[known, 'score']
+    return RatingArray(values, tuple(items), np.array(item_variants, dtype=int), tuple(variants),
+                       tuple(catalog.criteria))
+
+
+def build_array_chunks(chunks, catalog, raters: int) -> RatingArray:
+    """То же, что build_array, но из порций строк (user_id, video_id, criterion, score).
+
+    Строки должны идти по возрастанию user_id - тогда оценщики нумеруются
+    так же, как в build_array. В памяти только сам массив и одна порция.
+    raters - верхняя граница числа оценщиков (COUNT(DISTINCT user_id)).
+    """
+    items, item_variants, variants, video_items = _catalog_items(catalog)
+    criterion_index = dict(catalog.criterion_index)
+    values = np.full((raters, len(items), len(catalog.criteria)), np.nan)
+    users = {}
+    for rows in chunks:
+        chunk = pd.DataFrame(rows, columns=['user_id', 'video_id', 'criterion', 'score'])
+        item = chunk['video_id'].map(video_items)
+        criterion = chunk['criterion'].map(criterion_index)
+        known = item.notna() & criterion.notna()
+        for user_id in chunk.loc[known, 'user_id'].unique():
+            users.setdefault(user_id, len(users))
+        rater = chunk.loc[known, 'user_id'].map(users)
+        values[rater.to_numpy(int), item[known].to_numpy(int), criterion[known].to_numpy(int)] = \
+            chunk.loc[known, 'score']
+    return RatingArray(values[:len(users)], tuple(items), np.array(item_variants, dtype=int),
+                       tuple(variants), tuple(catalog.criteria))
+
+
+def alpha_terms(m: np.ndarray, s1: np.ndarray, s2: np.ndarray) -> np.ndarray:
+    """Вклады видео в интервальную альфу Криппендорфа.
+
+    m, s1, s2 - число оценок видео, их сумма и сумма квадратов (видео -
+    первая ось). Сумма квадратов разностей по упорядоченным парам оценок
+    видео равна 2(m*s2 - s1^2); видео с одной оценкой не учитываются.
+    Возвращает массив (4, ...): рассогласование внутри видео, m, s1, s2.
+    """
+    pairable = m >= 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        within = np.where(pairable, 2 * (m * s2 - s1 ** 2) / (m - 1), 0.0)
+    return np.stack([within, *(np.where(pairable, a, 0.0) for a in (m, s1, s2))])
+
+
+def alpha_from_terms(within, n, t1, t2) -> np.ndarray:
+    """Альфа по суммам вкладов видео (суммы - по видео, с любыми весами)"""
+    expected = 2 * (n * t2 - t1 ** 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        alpha = 1 - (n - 1) * within / expected
+    return np.where((n >= 2) & (expected > 0), alpha, np.nan)
+
+
+def _bootstrap_weights(units: int, resamples: int, rng: np.random.Generator):
+    """Кратности единиц ресэмплинга порциями: массивы (порция, units)"""
+    chunk = max(1, BOOTSTRAP_CHUNK_ELEMENTS // max(units, 1))
+    pvals = np.full(units, 1 / units)
+    done = 0
+    while done < resamples:
+        size = min(chunk, resamples - done)
+        yield rng.multinomial(units, pvals, size=size).astype(float, copy=False)
+        done += size
+
+
+def _interval(samples: np.ndarray) -> tuple:
+    tail = (1 - CONFIDENCE) / 2 * 100
+    with np.errstate(invalid='ignore'):
+        low, high = np.nanpercentile(samples, [tail, 100 - tail], axis=0)
+    return low, high
+
+
+def analyze(data: RatingArray, resamples: int = 2000, seed: int = 0) -> pd.DataFrame:
+    """Таблица статистик с доверительными интервалами (колонки COLUMNS).
+
+    Для альфы ресэмплируются видео: при ресэмплинге оценщиков копии одного
+    оценщика «согласны» сами с собой и завышают альфу. Средние и разности
+    ресэмплируются по оценщикам - их оценки независимы друг от друга.
+    """
+    raters, n_items, n_criteria = data.values.shape
+    if raters == 0:
+        return pd.DataFrame(columns=COLUMNS)
+    rng = np.random.default_rng(seed)
+    present = ~np.isnan(data.values)
+    x = np.where(present, data.values, 0.0)
+
+    # Альфа: вклады видео (4, видео, критерии); ресэмпл - взвешенная сумма по видео
+    terms = alpha_terms(present.sum(axis=0).astype(float), x.sum(axis=0), np.einsum('ric,ric->ic', x, x))
+    alpha = alpha_from_terms(*terms.sum(axis=1))
+    flat_terms = terms.transpose(1, 0, 2).reshape(n_items, -1)
+    samples = []
+    for weights in _bootstrap_weights(n_items, resamples, rng):
+        samples.append(alpha_from_terms(*(weights @ flat_terms).reshape(-1, 4, n_criteria).transpose(1, 0, 2)))
+    alpha_low, alpha_high = _interval(np.concatenate(samples))
+
+    # Суммы оценщиков по вариантам (оценщики, варианты, критерии)
+    variant_matrix = np.eye(len(data.variants))[data.item_variants]
+    variant_sums = np.einsum('ric,iv->rvc', x, variant_matrix)
+    variant_counts = np.einsum('ric,iv->rvc', present, variant_matrix)
+    with np.errstate(invalid='ignore'):
+        rater_means = variant_sums / variant_counts
+    # Разности вариантов у одного оценщика: (оценщики, пары, критерии)
+    pairs = [(a, b) for a in range(len(data.variants)) for b in range(a + 1, len(data.variants))]
+    diffs = np.stack([rater_means[:, b] - rater_means[:, a] for a, b in pairs], axis=1) \
+        if pairs else np.empty((raters, 0, n_criteria))
+    diff_valid = ~np.isnan(diffs)
+    # Числитель и знаменатель средних в форме (оценщики, ...): ресэмпл - W @ массив
+    parts = [a.reshape(raters, -1) for a in (
+        variant_sums, variant_counts, np.where(diff_valid, diffs, 0.0), diff_valid.astype(float)
+    )]
+
+    def means(weights):
+        sums, counts, diff_sums, diff_counts = (weights @ a for a in parts)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sums / counts, diff_sums / diff_counts
+
+    estimate = means(np.ones((1, raters)))
+    samples = [means(weights) for weights in _bootstrap_weights(raters, resamples, rng)]
+    intervals = [_interval(np.concatenate([s[k] for s in samples])) for k in range(2)]
+
+    rows = []
+    pairable = present.sum(axis=0)
+    alpha_n = np.where(pairable >= 2, pairable, 0).sum(axis=0)
+    for c, criterion in enumerate(data.criteria):
+        rows.append([ALPHA_SECTION, criterion, "", int(alpha_n[c]), alpha[c], alpha_low[c], alpha_high[c]])
+    labels = [
+        (MEAN_SECTION, list(data.variants), variant_counts),
+        (DIFF_SECTION, [f"{data.variants[b]} - {data.variants[a]}" for a, b in pairs], diff_valid),
+    ]
+    for k, (section, names, counts) in enumerate(labels):
+        shape = (len(names), n_criteria)
+        n = counts.sum(axis=0).reshape(shape)
+        value = estimate[k].reshape(shape)
+        low, high = (bound.reshape(shape) for bound in intervals[k])
+        for v, name in enumerate(names):
+            for c, criterion in enumerate(data.criteria):
+                rows.append([section, criterion, name, int(n[v, c]), value[v, c], low[v, c], high[v, c]])
+    return pd.DataFrame(rows, columns=COLUMNS)
+
+
+def content_hash(data: RatingArray, resamples: int, seed: int) -> str:
+    digest = hashlib.sha256()
+    digest.update(repr((ANALYSIS_VERSION, data.values.shape, data.items, data.variants,
+                        data.criteria, data.item_variants.tolist(), resamples, seed)).encode())
+    digest.update(np.ascontiguousarray(data.values).tobytes())
+    return digest.hexdigest()
+
+
+def cached_analysis(data: RatingArray, cache_path, resamples: int = 2000, seed: int = 0) -> pd.DataFrame:
+    """analyze() с кэшем в файле: пересчёт только при изменении оценок или параметров"""
+    key = content_hash(data, resamples, seed)
+    try:
+        with open(cache_path, "rb") as f:
+            cached = pickle.load(f)
+        if cached.get('key') == key:
+            return cached['table']
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        pass
+    table = analyze(data, resamples, seed)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump({'key': key, 'table': table}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+    return table
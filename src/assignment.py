@@ -0,0 +1,169 @@
+"""Сбалансированное назначение тем и порядка показа видео.
+
+Каждая новая сессия получает наименее показанную тему (из ещё не пройденных
+пользователем) и наименее использованный порядок видео из квадрата Уильямса:
+в нём каждое видео стоит на каждой позиции и следует за каждым другим
+одинаковое число раз. Счётчики живут в памяти и при запуске восстанавливаются
+из БД (seed), поэтому баланс сохраняется между перезапусками.
+"""
+import logging
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+
+def williams_orders(n: int) -> list:
+    """Строки квадрата Уильямса для n видео: n строк при чётном n, 2n - при нечётном"""
+    if n <= 1:
+        return [tuple(range(n))]
+    # Первая строка 0, 1, n-1, 2, n-2, ...; остальные - сдвиги по модулю n
+    first, low, high = [0], 1, n - 1
+    while len(first) < n:
+        first.append(low)
+        low += 1
+        if len(first) < n:
+            first.append(high)
+            high -= 1
+    rows = [tuple((x + shift) % n for x in first) for shift in range(n)]
+    if n % 2:
+        # При нечётном n баланс переходов даёт только пара квадрат + зеркальный
+        rows += [row[::-1] for row in rows]
+    return rows
+
+
+def permutation_rank(order) -> int:
+    """Номер перестановки чисел 0..n-1 в лексикографическом порядке (код Лемера)"""
+    rank = 0
+    rest = sorted(order)
+    for x in order:
+        i = rest.index(x)
+        rank = rank * len(rest) + i
+        rest.pop(i)
+    return rank
+
+
+def permutation_unrank(rank: int, n: int) -> tuple:
+    """Обратное к permutation_rank"""
+    digits = []
+    for base in range(1, n + 1):
+        rank, digit = divmod(rank, base)
+        digits.append(digit)
+    if rank:
+        raise ValueError("Номер перестановки вне диапазона")
+    rest = list(range(n))
+    return tuple(rest.pop(i) for i in reversed(digits))
+
+
+class LeastServed:
+    """Счётчики показов с выдачей наименее показанного ключа.
+
+    Ключи разложены по корзинам «число показов -> ключи», минимум только
+    растёт, поэтому take() без ограничений и add() работают за O(1).
+    С ограничением allowed просматриваются корзины от минимальной до первой
+    подходящей - не больше числа ключей (тем в исследовании единицы).
+    """
+
+    def __init__(self, keys=()):
+        self.counts = {}
+        # число показов -> ключи (dict как упорядоченное множество)
+        self._buckets = defaultdict(dict)
+        self._min = 0
+        for key in keys:
+            self.add(key)
+
+    def __contains__(self, key) -> bool:
+        return key in self.counts
+
+    def add(self, key):
+        if key in self.counts:
+            return
+        self.counts[key] = 0
+        self._buckets[0][key] = None
+        self._min = 0
+
+    def increment(self, key):
+        self.add(key)
+        count = self.counts[key]
+        bucket = self._buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[count]
+        self.counts[key] = count + 1
+        self._buckets[count + 1][key] = None
+        if count == self._min and not bucket:
+            self._min = count + 1
+
+    def take(self, allowed=None):
+        """Наименее показанный ключ (из allowed, если задано); счётчик увеличивается"""
+        count = self._min
+        remaining = len(self.counts)
+        while remaining > 0:
+            bucket = self._buckets.get(count)
+            if bucket:
+                for key in bucket:
+                    if allowed is None or key in allowed:
+                        self.increment(key)
+                        return key
+                remaining -= len(bucket)
+            count += 1
+        return None
+
+
+class AssignmentScheduler:
+    def __init__(self):
+        self.themes = LeastServed()
+        # theme -> счётчики строк квадрата Уильямса
+        self.orders = {}
+        self._designs = {}
+
+    def _design(self, n: int) -> list:
+        if n not in self._designs:
+            self._designs[n] = williams_orders(n)
+        return self._designs[n]
+
+    def _orders_for(self, theme: str, n: int) -> LeastServed:
+        orders = self.orders.get(theme)
+        if orders is None or len(orders.counts) != len(self._design(n)):
+            # Новая тема или после перезагрузки каталога изменилось число видео
+            orders = self.orders[theme] = LeastServed(range(len(self._design(n))))
+        return orders
+
+    def seed(self, catalog, sessions):
+        """Восстанавливает счётчики по прошлым сессиям.
+
+        sessions - пары (theme, список file_id в порядке показа); порядок может
+        быть неполным (нет части оценок) - тогда учитывается только тема.
+        """
+        self.themes = LeastServed(catalog.themes)
+        self.orders = {}
+        counted = 0
+        for theme, shown in sessions:
+            self.themes.increment(theme)
+            videos = catalog.themes.get(theme)
+            if not videos or len(shown) != len(videos):
+                continue
+            positions = []
+            for video_id in shown:
+                info = catalog.videos.get(video_id)
+                if info is None or info.theme != theme:
+                    break
+                positions.append(info.position)
+            design = self._design(len(videos))
+            try:
+                row = design.index(tuple(positions))
+            except ValueError:
+                continue
+            self._orders_for(theme, len(videos)).increment(row)
+            counted += 1
+        logger.info(f"Назначения восстановлены: сессий {sum(self.themes.counts.values())}, "
+                    f"с известным порядком {counted}")
+
+    def assign(self, catalog, unfinished) -> tuple:
+        """Тема и порядок видео для новой сессии: (theme, номер строки, список file_id)"""
+        for theme in catalog.themes:
+            self.themes.add(theme)
+        theme = self.themes.take(allowed=set(unfinished))
+        videos = catalog.themes[theme]
+        row = self._orders_for(theme, len(videos)).take()
+        order = self._design(len(videos))[row]
+        return theme, row, [videos[i] for i in order]
@@ -0,0 +1,407 @@
+#! /usr/bin/env python3
+"""Бенчмарки слоя БД и экспорта на синтетических базах.
+
+Для каждого размера (число оценок) создаётся data/bench/ratings_<размер>.db
+с пользователями, прошедшими тему (оценки, завершённая тема, лучшее видео),
+и пользователями в процессе (часть оценок и прогресс). Базы переиспользуются
+между запусками, чтобы результаты разных коммитов были сравнимы.
+
+Каждый замер идёт в отдельном процессе: функции бота - на копии базы под
+параллельной нагрузкой asyncio, экспорт - по исходной базе; пиковая память
+(RSS) - своя для каждого процесса.
+
+Запуск (из директории проекта):
+    python3 src/benchmark.py --sizes 10k,1m,10m --json data/bench/results.json
+    python3 src/benchmark.py --sizes 10k --compare data/bench/results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+SRC_DIR = Path(__file__).resolve().parent
+BASE_DIR = SRC_DIR.parent
+BENCH_DIR = BASE_DIR / "data" / "bench"
+# Доля пользователей, не закончивших тему
+IN_PROGRESS_SHARE = 0.15
+EXPORT_MODES = ("full", "stream", "csv")
+# Первые id пользователей, которых нет в синтетической базе (для записи)
+NEW_USERS = 2_000_000_000
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().lower()
+    for suffix, factor in (("k", 1_000), ("m", 1_000_000)):
+        if text.endswith(suffix):
+            return int(float(text[:-1]) * factor)
+    return int(text)
+
+
+def size_label(size: int) -> str:
+    if size >= 1_000_000 and size % 1_000_000 == 0:
+        return f"{size // 1_000_000}m"
+    if size >= 1_000 and size % 1_000 == 0:
+        return f"{size // 1_000}k"
+    return str(size)
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss в Linux - КБ, в macOS - байты
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def generate_db(path: Path, ratings: int, seed: int = 0) -> dict:
+    """Синтетическая база текущей схемы примерно с ratings оценками"""
+    import catalog
+    import migrations
+
+    current = catalog.current()
+    themes = list(current.themes)
+    criteria = current.criteria
+    rng = random.Random(seed)
+    counts = {"users": 0, "ratings": 0, "in_progress": 0, "completed": 0}
+    progress_rows, completed_rows, best_rows = [], [], []
+
+    def rating_rows():
+        user_id = 0
+        while counts["ratings"] < ratings:
+            user_id += 1
+            theme = themes[user_id % len(themes)]
+            order_count = 1
+            for n in range(2, len(current.themes[theme]) + 1):
+                order_count *= n
+            order_index = rng.randrange(order_count)
+            videos = current.order_videos(theme, order_index)
+            total = len(videos) * len(criteria)
+            in_progress = rng.random() < IN_PROGRESS_SHARE
+            done = rng.randrange(total) if in_progress else total
+            done = min(done, ratings - counts["ratings"])
+            for k in range(done):
+                yield (user_id, theme, videos[k // len(criteria)], criteria[k % len(criteria)], rng.randint(1, 5))
+            counts["ratings"] += done
+            counts["users"] += 1
+            if done < total:
+                counts["in_progress"] += 1
+                progress_rows.append((user_id, themes.index(theme) + 1, order_index,
+                                      done // len(criteria), done % len(criteria)))
+            else:
+                counts["completed"] += 1
+                completed_rows.append((user_id, theme))
+                best_rows.append((user_id, theme, rng.choice(videos), "Синтетическая причина"))
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    for suffix in ("", "-wal", "-shm"):
+        Path(f"{path}{suffix}").unlink(missing_ok=True)
+    migrations.migrate(path)
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("PRAGMA synchronous=OFF")
+        with conn:
+            conn.executemany("INSERT INTO themes (id, name) VALUES (?, ?)",
+                             [(i + 1, theme) for i, theme in enumerate(themes)])
+            conn.executemany(
+                "INSERT INTO ratings (user_id, theme, video_id, criterion, score) VALUES (?, ?, ?, ?, ?)",
+                rating_rows()
+            )
+            conn.executemany(
+                "INSERT INTO progress (user_id, theme_id, order_index, video_index, current_criterion) "
+                "VALUES (?, ?, ?, ?, ?)", progress_rows
+            )
+            conn.executemany("INSERT INTO completed_themes (user_id, theme) VALUES (?, ?)", completed_rows)
+            conn.executemany(
+                "INSERT INTO best_videos (user_id, theme, video_id, reason) VALUES (?, ?, ?, ?)", best_rows
+            )
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+    return counts
+
+
+def db_stats(path: Path) -> dict:
+    conn = sqlite3.connect(path)
+    try:
+        ratings = conn.execute("SELECT COUNT(*) FROM ratings").fetchone()[0]
+        in_progress = conn.execute("SELECT COUNT(*) FROM progress").fetchone()[0]
+        completed = conn.execute("SELECT COUNT(*) FROM completed_themes").fetchone()[0]
+    finally:
+        conn.close()
+    return {"ratings": ratings, "in_progress": in_progress, "completed": completed,
+            "db_bytes": path.stat().st_size}
+
+
+async def timed_concurrently(operation, count: int, concurrency: int) -> dict:
+    """count вызовов operation(i), не больше concurrency одновременно"""
+    latencies = []
+    counter = iter(range(count))
+
+    async def worker():
+        for i in counter:
+            started = time.perf_counter()
+            await operation(i)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "ops": count,
+        "elapsed_s": elapsed,
+        "ops_per_s": count / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000
+    }
+
+
+async def bench_helpers(args) -> dict:
+    """Выполняется в отдельном процессе с BOT_DB_PATH = копия базы"""
+    import tg_bot
+    import catalog
+    from load_test import quiet_logs
+
+    error_counter = quiet_logs()
+    started = time.perf_counter()
+    await tg_bot.init_db()
+    startup = time.perf_counter() - started
+
+    current = catalog.current()
+    themes = list(current.themes)
+    criteria = current.criteria
+    conn = sqlite3.connect(tg_bot.DB_NAME)
+    try:
+        existing = [row[0] for row in conn.execute("SELECT DISTINCT user_id FROM ratings")]
+    finally:
+        conn.close()
+    rng = random.Random(1)
+    readers = [rng.choice(existing) for _ in range(args.ops)] if existing else list(range(args.ops))
+    per_user = len(current.themes[themes[0]]) * len(criteria)
+
+    def progress_data(user_id: int, step: int) -> dict:
+        theme = themes[user_id % len(themes)]
+        videos = list(current.themes[theme])
+        return {
+            'current_theme': theme,
+            'videos': videos,
+            'video_index': step // len(criteria),
+            'current_criterion': step % len(criteria),
+            'current_score': {}
+        }
+
+    async def record_rating(i):
+        # Пользователь проходит тему подряд: каждая оценка - новая строка
+        user_id, step = NEW_USERS + i // per_user, i % per_user
+        data = progress_data(user_id, step + 1)
+        video_id = data['videos'][step // len(criteria)]
+        await tg_bot.record_rating(user_id, video_id, criteria[step % len(criteria)], 3, data)
+
+    async def save_progress(i):
+        user_id = NEW_USERS + 100_000_000 + i
+        await tg_bot.save_progress(progress_data(user_id, i % per_user), user_id)
+
+    async def get_progress(i):
+        # Замеряется чтение из БД, а не из кэша
+        tg_bot.session_cache.invalidate(readers[i], 'progress')
+        await tg_bot.get_progress(readers[i])
+
+    async def get_completed_themes(i):
+        tg_bot.session_cache.invalidate(readers[i], 'completed_themes')
+        await tg_bot.get_completed_themes(readers[i])
+
+    helpers = {}
+    for name, operation in (("record_rating", record_rating), ("save_progress", save_progress),
+                            ("get_progress", get_progress), ("get_completed_themes", get_completed_themes)):
+        helpers[name] = await timed_concurrently(operation, args.ops, args.concurrency)
+    await tg_bot.close_db()
+    return {
+        "startup_s": startup,
+        "concurrency": args.concurrency,
+        "helpers": helpers,
+        "errors": error_counter.errors,
+        "peak_rss_mb": peak_rss_mb()
+    }
+
+
+def bench_export(args) -> dict:
+    """Выполняется в отдельном процессе: экспорт базы args.db в args.work_dir"""
+    import read_db
+
+    work_dir = Path(args.work_dir)
+    read_db.DB_PATH = Path(args.db)
+    read_db.EXCEL_PATH = work_dir / "results.xlsx"
+    read_db.STATE_PATH = work_dir / "results.state.pkl"
+    read_db.ANALYSIS_CACHE_PATH = work_dir / "analysis.cache.pkl"
+    read_db.CSV_DIR = work_dir
+    started = time.perf_counter()
+    if args.export == "full":
+        read_db.export(full=True)
+        paths = [read_db.EXCEL_PATH]
+    else:
+        paths = read_db.stream_export("csv" if args.export == "csv" else "xlsx")
+    elapsed = time.perf_counter() - started
+    return {
+        "elapsed_s": elapsed,
+        "output_bytes": sum(Path(p).stat().st_size for p in paths),
+        "peak_rss_mb": peak_rss_mb()
+    }
+
+
+def run_child(arguments: list, env: dict = None) -> dict:
+    """Запускает этот же скрипт в отдельном процессе и возвращает его JSON"""
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+        out = Path(f.name)
+    try:
+        subprocess.run(
+            [sys.executable, str(Path(__file__).resolve()), *arguments, "--out", str(out)],
+            env={**os.environ, **(env or {})}, check=True
+        )
+        with open(out, encoding="utf-8") as f:
+            return json.load(f)
+    finally:
+        out.unlink(missing_ok=True)
+
+
+def bench_size(size: int, args) -> dict:
+    path = BENCH_DIR / f"ratings_{size_label(size)}.db"
+    result = {"size": size_label(size)}
+    if args.regenerate or not path.exists():
+        print(f"[{size_label(size)}] генерация {path} ...", flush=True)
+        started = time.perf_counter()
+        generate_db(path, size)
+        result["generate_s"] = time.perf_counter() - started
+    result.update(db_stats(path))
+
+    with tempfile.TemporaryDirectory(dir=BENCH_DIR) as tmp_dir:
+        # Функции бота пишут в базу - работаем с копией
+        work_db = Path(tmp_dir) / "ratings.db"
+        shutil.copyfile(path, work_db)
+        print(f"[{size_label(size)}] функции БД ...", flush=True)
+        result.update(run_child(
+            ["--helpers", "--ops", str(args.ops), "--concurrency", str(args.concurrency)],
+            env={"BOT_DB_PATH": str(work_db), "EXPORT_INTERVAL": "0"}
+        ))
+        result["export"] = {}
+        for mode in args.exports:
+            print(f"[{size_label(size)}] экспорт {mode} ...", flush=True)
+            result["export"][mode] = run_child(
+                ["--export", mode, "--db", str(path), "--work-dir", tmp_dir]
+            )
+    return result
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def flatten(report: dict) -> dict:
+    """{(размер, метрика): значение} для сравнения отчётов"""
+    metrics = {}
+    for result in report["results"]:
+        size = result["size"]
+        metrics[(size, "startup_s")] = result["startup_s"]
+        for name, h in result["helpers"].items():
+            metrics[(size, f"{name}.ops_per_s")] = h["ops_per_s"]
+            metrics[(size, f"{name}.p95_ms")] = h["p95_ms"]
+        for mode, e in result["export"].items():
+            metrics[(size, f"export.{mode}.elapsed_s")] = e["elapsed_s"]
+            metrics[(size, f"export.{mode}.peak_rss_mb")] = e["peak_rss_mb"]
+    return metrics
+
+
+def print_report(report: dict):
+    for r in report["results"]:
+        print(f"\n[{r['size']}] оценок {r['ratings']}, в процессе {r['in_progress']}, "
+              f"завершено {r['completed']}, файл {r['db_bytes'] / 2 ** 20:.1f} МБ, "
+              f"запуск бота {r['startup_s']:.2f} с")
+        print(f"  {'функция':<22} {'оп/с':>10} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9}")
+        for name, h in r["helpers"].items():
+            print(f"  {name:<22} {h['ops_per_s']:>10.1f} {h['p50_ms']:>9.2f} {h['p95_ms']:>9.2f} {h['p99_ms']:>9.2f}")
+        for mode, e in r["export"].items():
+            print(f"  экспорт {mode:<14} {e['elapsed_s']:>8.2f} с, пик RSS {e['peak_rss_mb']:.0f} МБ")
+
+
+def print_comparison(baseline: dict, report: dict):
+    """Изменения относительно прошлого отчёта; у оп/с лучше больше, у остального - меньше"""
+    old, new = flatten(baseline), flatten(report)
+    print(f"\nСравнение с {baseline.get('commit') or 'прошлым отчётом'}:")
+    for key in new:
+        if key not in old or not old[key]:
+            continue
+        change = (new[key] - old[key]) / old[key] * 100
+        worse = change < 0 if key[1].endswith("ops_per_s") else change > 0
+        mark = " !" if worse and abs(change) >= 10 else ""
+        print(f"  [{key[0]}] {key[1]:<36} {old[key]:>10.2f} -> {new[key]:>10.2f} ({change:+.1f}%){mark}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки слоя БД и экспорта")
+    parser.add_argument("--sizes", default="10k,1m,10m", help="размеры баз в оценках через запятую")
+    parser.add_argument("--ops", type=int, default=2000, help="вызовов каждой функции БД")
+    parser.add_argument("--concurrency", type=int, default=64, help="одновременных вызовов")
+    parser.add_argument("--exports", default=",".join(EXPORT_MODES),
+                        help="режимы экспорта через запятую: full, stream, csv")
+    parser.add_argument("--regenerate", action="store_true", help="пересоздать синтетические базы")
+    parser.add_argument("--json", help="сохранить отчёт в JSON-файл")
+    parser.add_argument("--compare", help="сравнить с прошлым JSON-отчётом")
+    # Режимы дочерних процессов
+    parser.add_argument("--helpers", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--export", choices=EXPORT_MODES, help=argparse.SUPPRESS)
+    parser.add_argument("--db", help=argparse.SUPPRESS)
+    parser.add_argument("--work-dir", help=argparse.SUPPRESS)
+    parser.add_argument("--out", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    sys.path.insert(0, str(SRC_DIR))
+
+    if args.helpers or args.export:
+        result = asyncio.run(bench_helpers(args)) if args.helpers else bench_export(args)
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f)
+        return
+
+    args.exports = [mode.strip() for mode in args.exports.split(",") if mode.strip()]
+    BENCH_DIR.mkdir(parents=True, exist_ok=True)
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "ops": args.ops,
+        "concurrency": args.concurrency,
+        "results": [bench_size(parse_size(size), args) for size in args.sizes.split(",")]
+    }
+    print_report(report)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print_comparison(json.load(f), report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
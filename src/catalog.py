@@ -0,0 +1,153 @@
+"""Каталог исследования: темы, видео и критерии оценки.
+
+Загружается из catalog.json в корне проекта (путь можно переопределить
+переменной окружения CATALOG_PATH) и проверяется при загрузке. Индексы
+строятся один раз и не меняются; reload() подменяет каталог целиком,
+поэтому код, получивший каталог через current(), видит согласованные данные.
+"""
+import json
+import logging
+import os
+from pathlib import Path
+from types import MappingProxyType
+from typing import NamedTuple
+from assignment import permutation_rank, permutation_unrank
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+CATALOG_PATH = Path(os.environ.get("CATALOG_PATH", BASE_DIR / "catalog.json"))
+
+
+class CatalogError(ValueError):
+    """Файл каталога не прошёл проверку"""
+
+
+class VideoInfo(NamedTuple):
+    theme: str
+    variant: str
+    # Позиция видео внутри темы (с нуля)
+    position: int
+    # Актуальный file_id; для старых загрузок отличается от ключа индекса
+    file_id: str
+
+    @property
+    def name(self) -> str:
+        return f"{self.theme} - {self.variant}"
+
+
+class Catalog:
+    def __init__(self, data: dict):
+        criteria = data.get("criteria")
+        if not isinstance(criteria, list) or not criteria:
+            raise CatalogError("Нужен непустой список criteria")
+        names, hints = [], []
+        for item in criteria:
+            name = item.get("name") if isinstance(item, dict) else None
+            if not isinstance(name, str) or not name:
+                raise CatalogError(f"Критерий без названия: {item!r}")
+            if name in names:
+                raise CatalogError(f"Критерий повторяется: {name}")
+            names.append(name)
+            hints.append(item.get("hint", ""))
+
+        themes = data.get("themes")
+        if not isinstance(themes, list) or not themes:
+            raise CatalogError("Нужен непустой список themes")
+        theme_videos, videos = {}, {}
+        for theme in themes:
+            theme_name = theme.get("name") if isinstance(theme, dict) else None
+            if not isinstance(theme_name, str) or not theme_name:
+                raise CatalogError(f"Тема без названия: {theme!r}")
+            if theme_name in theme_videos:
+                raise CatalogError(f"Тема повторяется: {theme_name}")
+            items = theme.get("videos")
+            if not isinstance(items, list) or not items:
+                raise CatalogError(f"В теме {theme_name} нет видео")
+            file_ids = []
+            for position, video in enumerate(items):
+                file_id = video.get("file_id") if isinstance(video, dict) else None
+                variant = video.get("variant") if isinstance(video, dict) else None
+                if not file_id or not variant:
+                    raise CatalogError(f"Видео без file_id или variant в теме {theme_name}: {video!r}")
+                info = VideoInfo(theme_name, variant, position, file_id)
+                for video_id in [file_id, *video.get("aliases", [])]:
+                    if video_id in videos:
+                        raise CatalogError(f"file_id встречается дважды: {video_id}")
+                    videos[video_id] = info
+                file_ids.append(file_id)
+            theme_videos[theme_name] = tuple(file_ids)
+
+        self.criteria = tuple(names)
+        self.hints = tuple(hints)
+        self.criterion_index = MappingProxyType({name: i for i, name in enumerate(names)})
+        # theme -> file_id в порядке каталога
+        self.themes = MappingProxyType(theme_videos)
+        # file_id (в том числе старые) -> VideoInfo
+        self.videos = MappingProxyType(videos)
+        # file_id -> "Тема - Вариант" для экспорта
+        self.video_names = MappingProxyType({video_id: info.name for video_id, info in videos.items()})
+
+    def video_name(self, video_id: str) -> str:
+        info = self.videos.get(video_id)
+        return info.name if info else video_id
+
+    def variant(self, video_id: str) -> str:
+        info = self.videos.get(video_id)
+        return info.variant if info else video_id
+
+    def order_index(self, theme: str, video_ids) -> int:
+        """Номер перестановки видео темы, показанных в порядке video_ids"""
+        videos = self.themes.get(theme)
+        if videos is None:
+            raise CatalogError(f"Неизвестная тема: {theme}")
+        positions = []
+        for video_id in video_ids:
+            info = self.videos.get(video_id)
+            if info is None or info.theme != theme:
+                raise CatalogError(f"Видео {video_id} не относится к теме {theme}")
+            positions.append(info.position)
+        if sorted(positions) != list(range(len(videos))):
+            raise CatalogError(f"Порядок видео темы {theme} неполон: {positions}")
+        return permutation_rank(positions)
+
+    def order_videos(self, theme: str, index: int) -> list:
+        """file_id темы в порядке перестановки с номером index"""
+        videos = self.themes[theme]
+        return [videos[i] for i in permutation_unrank(index, len(videos))]
+
+
+def load_catalog(path=None) -> Catalog:
+    path = Path(path or CATALOG_PATH)
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        raise CatalogError(f"Не удалось прочитать каталог {path}: {e}") from e
+    if not isinstance(data, dict):
+        raise CatalogError(f"Каталог {path} должен быть объектом JSON")
+    return Catalog(data)
+
+
+_current = None
+
+
+def current() -> Catalog:
+    """Действующий каталог; при первом обращении загружается из CATALOG_PATH"""
+    global _current
+    if _current is None:
+        _current = load_catalog()
+    return _current
+
+
+def reload(path=None) -> bool:
+    """Перечитывает каталог; при ошибке остаётся прежний"""
+    global _current
+    try:
+        catalog = load_catalog(path)
+    except CatalogError as e:
+        logger.error(f"Каталог не обновлён: {e}")
+        return False
+    _current = catalog
+    logger.info(f"Каталог обновлён: тем {len(catalog.themes)}, видео {len(catalog.videos)}")
+    return True
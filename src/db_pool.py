@@ -0,0 +1,93 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+import aiosqlite # type: ignore
+
+logger = logging.getLogger(__name__)
+
+# Прагмы выставляются один раз на каждое соединение при открытии пула
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+)
+
+
+class ConnectionPool:
+    """Пул долгоживущих соединений aiosqlite.
+
+    Соединения открываются один раз в open() и живут до close(), поэтому
+    поток aiosqlite и кэш подготовленных выражений sqlite3 переиспользуются
+    между вызовами.
+    """
+
+    def __init__(self, db_name: str, size: int = 4, cached_statements: int = 256, pragmas: tuple = ()):
+        self.db_name = db_name
+        self.size = size
+        self.cached_statements = cached_statements
+        # Дополнительные прагмы (размер кэша, mmap и т.п.) - после CONNECTION_PRAGMAS
+        self.pragmas = tuple(pragmas)
+        self._connections = []
+        self._idle = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._idle is not None
+
+    async def open(self):
+        """Открывает соединения и выставляет прагмы"""
+        if self.is_open:
+            return
+        self._idle = asyncio.Queue()
+        for _ in range(self.size):
+            # isolation_level=None: транзакции открываем явно в transaction()
+            db = await aiosqlite.connect(
+                self.db_name,
+                isolation_level=None,
+                cached_statements=self.cached_statements
+            )
+            for pragma in CONNECTION_PRAGMAS + self.pragmas:
+                await db.execute(pragma)
+            self._connections.append(db)
+            self._idle.put_nowait(db)
+        logger.info(f"Открыт пул соединений с БД: {self.size} шт.")
+
+    async def close(self):
+        """Закрывает все соединения пула"""
+        if not self.is_open:
+            return
+        for db in self._connections:
+            try:
+                # Статистика для таблиц, по которым соединение выполняло запросы
+                await db.execute("PRAGMA optimize")
+                await db.close()
+            except Exception as e:
+                logger.error(f"Ошибка закрытия соединения: {e}")
+        self._connections.clear()
+        self._idle = None
+        logger.info("Пул соединений с БД закрыт")
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Выдаёт свободное соединение (для чтения)"""
+        if not self.is_open:
+            raise RuntimeError("Пул соединений не открыт")
+        idle = self._idle
+        db = await idle.get()
+        try:
+            yield db
+        finally:
+            idle.put_nowait(db)
+
+    @asynccontextmanager
+    async def transaction(self):
+        """Выдаёт соединение внутри транзакции BEGIN IMMEDIATE ... COMMIT"""
+        async with self.acquire() as db:
+            await db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                await db.rollback()
+                raise
+            else:
+                await db.commit()
@@ -0,0 +1,319 @@
+"""Шардированный режим: диспетчер и N процессов-воркеров.
+
+Диспетчер получает обновления (webhook от Telegram или getUpdates) и по
+user_id отправляет каждое своему воркеру - обычному боту в режиме
+BOT_MODE=worker со своим файлом БД. Обновления одного воркера уходят
+строго по одному: следующее - только после ответа 200 на предыдущее,
+поэтому воркер получает обновления пользователя в исходном порядке,
+а UserOrderedApplication сохраняет этот порядок при обработке.
+
+Упавший воркер перезапускается с нарастающей задержкой, а его обновления
+ждут в очереди ограниченного размера. Если очередь полна, webhook отвечает
+Telegram 503 (обновление придёт повторно), а getUpdates приостанавливается.
+"""
+import asyncio
+import json
+import logging
+import os
+import signal
+import httpx
+from telegram import Bot, Update
+from telegram.error import NetworkError, TimedOut
+from metrics import registry
+from shards import shard_of
+from webhook import SECRET_HEADER, Overloaded, WebhookServer
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+DISPATCHED = registry.counter(
+    "bot_dispatched_updates_total", "Обновления, переданные воркерам", ("shard",))
+DELIVERY_RETRIES = registry.counter(
+    "bot_dispatch_retries_total", "Повторные попытки передать обновление воркеру", ("shard",))
+WORKER_RESTARTS = registry.counter(
+    "bot_worker_restarts_total", "Перезапуски упавших воркеров", ("shard",))
+
+
+class WorkerLink:
+    """Очередь обновлений одного воркера и задача, которая отправляет их по одному"""
+
+    def __init__(self, client: httpx.AsyncClient, shard: int, url: str, secret: str,
+                 max_backoff: float = 5.0, max_queue: int = 10000):
+        self.client = client
+        self.shard = shard
+        self.url = url
+        self.secret = secret
+        self.max_backoff = max_backoff
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def put(self, body: bytes):
+        """Ставит обновление в очередь; asyncio.QueueFull, если очередь полна"""
+        self.queue.put_nowait(body)
+
+    async def put_wait(self, body: bytes):
+        """Ставит обновление в очередь, дожидаясь места"""
+        await self.queue.put(body)
+
+    async def stop(self, timeout: float = 30.0):
+        """Дожидается отправки всего, что уже в очереди (не дольше timeout)"""
+        if self._task is None:
+            return
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        try:
+            await asyncio.wait_for(self.queue.put(_STOP), timeout)
+            await asyncio.wait_for(self._task, max(0.0, deadline - loop.time()))
+        except asyncio.TimeoutError:
+            self._task.cancel()
+            logger.error(f"Воркер {self.shard} недоступен: не переданы обновления ({self.queue.qsize()})")
+        self._task = None
+
+    async def _run(self):
+        while True:
+            body = await self.queue.get()
+            if body is _STOP:
+                return
+            await self._deliver(body)
+
+    async def _deliver(self, body: bytes):
+        delay = 0.05
+        while True:
+            try:
+                response = await self.client.post(
+                    self.url,
+                    content=body,
+                    headers={SECRET_HEADER: self.secret, "Content-Type": "application/json"}
+                )
+                if response.status_code == 200:
+                    return
+                if 400 <= response.status_code < 500:
+                    # Повтор не поможет: обновление некорректно или неверен секрет
+                    logger.error(f"Воркер {self.shard} отклонил обновление: {response.status_code}")
+                    return
+                logger.warning(f"Воркер {self.shard} ответил {response.status_code}, повтор")
+            except httpx.TransportError as e:
+                # Воркер ещё запускается или перезапускается: ждём, порядок не нарушаем
+                logger.warning(f"Воркер {self.shard} недоступен ({e!r}), повтор через {delay:.2f} с")
+            DELIVERY_RETRIES.inc(str(self.shard))
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_backoff)
+
+
+class Dispatcher:
+    """Раскладывает обновления (JSON-словари) по воркерам по user_id"""
+
+    def __init__(self, worker_urls: list, secret: str, max_queue: int = 10000):
+        self.worker_urls = worker_urls
+        self.secret = secret
+        self.max_queue = max_queue
+        self._client = None
+        self.links = []
+
+    def qsize(self) -> int:
+        return sum(link.queue.qsize() for link in self.links)
+
+    async def start(self):
+        self._client = httpx.AsyncClient(timeout=httpx.Timeout(30.0, connect=5.0))
+        self.links = [
+            WorkerLink(self._client, shard, url, self.secret, max_queue=self.max_queue)
+            for shard, url in enumerate(self.worker_urls)
+        ]
+        for link in self.links:
+            link.start()
+
+    async def stop(self):
+        for link in self.links:
+            await link.stop()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def dispatch(self, update: dict) -> int:
+        """Ставит обновление в очередь его воркера и возвращает номер шарда.
+
+        asyncio.QueueFull - очередь воркера полна (он не отвечает или не успевает).
+        """
+        shard = shard_of(update, len(self.links))
+        self.links[shard].put(json.dumps(update).encode("utf-8"))
+        DISPATCHED.inc(str(shard))
+        return shard
+
+    async def dispatch_wait(self, update: dict) -> int:
+        """Как dispatch, но при полной очереди ждёт, пока воркер её разберёт"""
+        shard = shard_of(update, len(self.links))
+        await self.links[shard].put_wait(json.dumps(update).encode("utf-8"))
+        DISPATCHED.inc(str(shard))
+        return shard
+
+
+class DispatcherWebhook(WebhookServer):
+    """Webhook для Telegram перед диспетчером: проверяет секрет и передаёт JSON как есть"""
+
+    def __init__(self, dispatcher: Dispatcher, host: str, port: int, path: str, secret_token: str):
+        super().__init__(None, host, port, path, secret_token)
+        self.dispatcher = dispatcher
+
+    async def deliver(self, data: dict) -> bool:
+        if not isinstance(data, dict) or "update_id" not in data:
+            return False
+        try:
+            self.dispatcher.dispatch(data)
+        except asyncio.QueueFull:
+            raise Overloaded(f"очередь воркера {shard_of(data, len(self.dispatcher.links))} заполнена")
+        return True
+
+
+async def poll_updates(bot: Bot, dispatcher: Dispatcher, stop: asyncio.Event, timeout: int = 10):
+    """Единственный поллер: getUpdates и раздача обновлений воркерам"""
+    await bot.delete_webhook()
+    offset = None
+    while not stop.is_set():
+        try:
+            updates = await bot.get_updates(
+                offset=offset, timeout=timeout, allowed_updates=Update.ALL_TYPES,
+                read_timeout=timeout + 5
+            )
+        except (TimedOut, NetworkError) as e:
+            logger.warning(f"getUpdates: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            # Пока очередь воркера полна, offset не сдвигается: остальное хранит Telegram
+            await dispatcher.dispatch_wait(update.to_dict())
+            offset = update.update_id + 1
+
+
+async def start_workers(command: list, envs: list) -> list:
+    """Запускает по процессу на шард; envs - дополнительные переменные окружения воркеров"""
+    processes = []
+    for env in envs:
+        # Своя группа процессов: Ctrl+C получает только диспетчер, воркеры
+        # останавливаются им после передачи всех принятых обновлений
+        processes.append(await asyncio.create_subprocess_exec(
+            *command, env={**os.environ, **env}, start_new_session=True
+        ))
+    return processes
+
+
+async def supervise_worker(processes: list, shard: int, command: list, env: dict, stop: asyncio.Event,
+                           max_backoff: float = 30.0, max_failures: int = 5, stable_after: float = 60.0):
+    """Перезапускает воркер shard после падения; processes[shard] заменяется новым процессом.
+
+    Задержка перед перезапуском растёт от 1 с до max_backoff. Если воркер
+    падает max_failures раз подряд, не проработав stable_after секунд, диспетчер
+    останавливается (stop): обновления этого шарда всё равно некому обработать.
+    """
+    loop = asyncio.get_running_loop()
+    delay, failures = 1.0, 0
+    while True:
+        process = processes[shard]
+        started = loop.time()
+        returncode = await process.wait()
+        if stop.is_set():
+            return
+        if loop.time() - started >= stable_after:
+            delay, failures = 1.0, 0
+        failures += 1
+        if failures > max_failures:
+            logger.critical(f"Воркер {shard} падает {failures} раз подряд (код {returncode}), диспетчер останавливается")
+            stop.set()
+            return
+        logger.error(f"Воркер {shard} (pid {process.pid}) завершился с кодом {returncode}, "
+                     f"перезапуск через {delay:.0f} с")
+        try:
+            await asyncio.wait_for(stop.wait(), delay)
+            return
+        except asyncio.TimeoutError:
+            pass
+        processes[shard] = (await start_workers(command, [env]))[0]
+        WORKER_RESTARTS.inc(str(shard))
+        delay = min(delay * 2, max_backoff)
+
+
+async def stop_workers(processes: list, timeout: float = 30.0):
+    """SIGTERM воркерам (они дообрабатывают очередь и закрывают БД), по тайм-ауту - SIGKILL"""
+    for process in processes:
+        if process.returncode is None:
+            process.send_signal(signal.SIGTERM)
+    for process in processes:
+        try:
+            await asyncio.wait_for(process.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Воркер {process.pid} не завершился за {timeout} с, SIGKILL")
+            process.kill()
+            await process.wait()
+
+
+async def run_dispatcher(bot: Bot, worker_command: list, worker_envs: list, worker_urls: list,
+                         secret: str, webhook: dict = None, max_queue: int = 10000):
+    """Запускает воркеров и диспетчер до SIGINT/SIGTERM (или до неустранимого падения воркера).
+
+    webhook - параметры WebhookServer (host, port, path, secret_token и
+    необязательный url для setWebhook); без него обновления забираются через getUpdates.
+    max_queue - сколько обновлений может ждать передачи одному воркеру.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    processes = await start_workers(worker_command, worker_envs)
+    supervisors = [
+        asyncio.create_task(supervise_worker(processes, shard, worker_command, env, stop))
+        for shard, env in enumerate(worker_envs)
+    ]
+    if hasattr(signal, "SIGHUP"):
+        try:
+            # Перезагрузку каталога передаём воркерам
+            loop.add_signal_handler(
+                signal.SIGHUP,
+                lambda: [p.send_signal(signal.SIGHUP) for p in processes if p.returncode is None]
+            )
+        except NotImplementedError:
+            pass
+    dispatcher = Dispatcher(worker_urls, secret, max_queue=max_queue)
+    await dispatcher.start()
+    registry.gauge("bot_dispatch_queue_depth", "Обновления, ожидающие передачи воркерам", dispatcher.qsize)
+    server = None
+    poller = None
+    try:
+        await bot.initialize()
+        if webhook:
+            server = DispatcherWebhook(
+                dispatcher, webhook["host"], webhook["port"], webhook["path"], webhook["secret_token"]
+            )
+            await server.start()
+            if webhook.get("url"):
+                await bot.set_webhook(
+                    url=webhook["url"], secret_token=webhook["secret_token"],
+                    allowed_updates=Update.ALL_TYPES
+                )
+            logger.info(f"Диспетчер принимает обновления на порту {server.port}, шардов: {len(worker_urls)}")
+        else:
+            poller = asyncio.create_task(poll_updates(bot, dispatcher, stop))
+            logger.info(f"Диспетчер получает обновления через getUpdates, шардов: {len(worker_urls)}")
+        await stop.wait()
+    finally:
+        if poller is not None:
+            poller.cancel()
+            try:
+                await poller
+            except (asyncio.CancelledError, Exception):
+                pass
+        if server is not None:
+            await server.stop()
+        # Сначала отдаём воркерам всё принятое, затем останавливаем их
+        await dispatcher.stop()
+        await stop_workers(processes)
+        for supervisor in supervisors:
+            supervisor.cancel()
+        await asyncio.gather(*supervisors, return_exceptions=True)
+        await bot.shutdown()
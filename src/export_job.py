@@ -0,0 +1,83 @@
+"""Экспорт результатов из работающего бота.
+
+pandas и openpyxl работают синхронно и долго, поэтому экспорт выполняется
+в отдельном процессе (read_db.export по снимку БД), а цикл событий бота
+только ждёт результата. Если с прошлого экспорта данные не менялись
+(read_db.db_fingerprint), файл не пересобирается.
+"""
+import asyncio
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+EXPORTS = registry.counter(
+    "bot_exports_total", "Запуски экспорта по результату", ("result",))
+EXPORT_DURATION = registry.histogram(
+    "bot_export_duration_seconds", "Длительность экспорта", (),
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+
+
+def run_export(db_path: str, excel_path: str, state_path: str, last_fingerprint):
+    """Выполняется в процессе пула: (fingerprint, режим или None, если пропущен)"""
+    import read_db
+
+    read_db.DB_PATH = Path(db_path)
+    read_db.EXCEL_PATH = Path(excel_path)
+    read_db.STATE_PATH = Path(state_path)
+    read_db.ANALYSIS_CACHE_PATH = Path(state_path).with_name("analysis.cache.pkl")
+    read_db.EXCEL_PATH.parent.mkdir(parents=True, exist_ok=True)
+    fingerprint = read_db.db_fingerprint()
+    if fingerprint == last_fingerprint and read_db.EXCEL_PATH.exists():
+        return fingerprint, None
+    return fingerprint, read_db.export()
+
+
+class ExportRunner:
+    """Запускает экспорт в процессе пула; одновременно идёт не больше одного экспорта"""
+
+    def __init__(self, db_path, excel_path, state_path):
+        self.db_path = Path(db_path)
+        self.excel_path = Path(excel_path)
+        self.state_path = Path(state_path)
+        self._fingerprint = None
+        self._executor = None
+        self._lock = asyncio.Lock()
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn, а не fork: в процессе бота работают потоки aiosqlite
+            self._executor = ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    async def run(self) -> bool:
+        """Обновляет файл экспорта; False - данные не менялись и файл остался прежним"""
+        async with self._lock:
+            started = time.perf_counter()
+            try:
+                self._fingerprint, mode = await asyncio.get_running_loop().run_in_executor(
+                    self._pool(), run_export,
+                    str(self.db_path), str(self.excel_path), str(self.state_path), self._fingerprint
+                )
+            except Exception:
+                EXPORTS.inc("failed")
+                raise
+            if mode is None:
+                EXPORTS.inc("skipped")
+                return False
+            elapsed = time.perf_counter() - started
+            EXPORT_DURATION.observe(elapsed)
+            EXPORTS.inc("written")
+            logger.info(f"Экспорт записан в {self.excel_path} ({mode}) за {elapsed:.1f} с")
+            return True
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
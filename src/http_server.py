@@ -0,0 +1,77 @@
+import asyncio
+import logging
+from http import HTTPStatus
+
+logger = logging.getLogger(__name__)
+
+
+class SimpleHTTPServer:
+    """Минимальный HTTP-сервер на asyncio для служебных эндпоинтов бота.
+
+    Маршрут - точный путь без query-строки; обработчик получает метод,
+    заголовки (ключи в нижнем регистре) и тело запроса и возвращает
+    (код ответа, тело, Content-Type).
+    """
+
+    def __init__(self, host: str, port: int, max_body: int = 1024 * 1024):
+        self.host = host
+        self.port = port
+        self.max_body = max_body
+        self.routes = {}
+        self._server = None
+
+    def route(self, path: str, handler):
+        self.routes[path] = handler
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        # При port=0 система выдаёт свободный порт
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _read_request(self, reader):
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        parts = request_line.decode("latin-1").split()
+        if len(parts) < 2:
+            return None
+        headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout=5)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length") or 0)
+        if length > self.max_body:
+            raise ValueError(f"Слишком большое тело запроса: {length}")
+        body = await asyncio.wait_for(reader.readexactly(length), timeout=5) if length else b""
+        return parts[0], parts[1].split("?")[0], headers, body
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await self._read_request(reader)
+            if request is None:
+                status, body, content_type = 400, b"bad request\n", "text/plain"
+            else:
+                method, path, headers, body = request
+                handler = self.routes.get(path)
+                if handler is None:
+                    status, body, content_type = 404, b"not found\n", "text/plain"
+                else:
+                    status, body, content_type = await handler(method, headers, body)
+            writer.write(
+                f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode("latin-1") + body
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.error(f"Ошибка обработки HTTP-запроса: {e}")
+        finally:
+            writer.close()
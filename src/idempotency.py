@@ -0,0 +1,35 @@
+from collections import OrderedDict
+
+
+class RecentKeys:
+    """Ограниченное множество недавно обработанных ключей (LRU).
+
+    seen() за одно обращение проверяет ключ и запоминает его, поэтому
+    повтор (двойное нажатие, повторная доставка обновления) отсекается
+    за O(1) до обработчика и записи в БД. Вытесняются самые старые ключи.
+    """
+
+    def __init__(self, max_size: int = 50000):
+        self.max_size = max_size
+        self.duplicates = 0
+        self._keys = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, key) -> bool:
+        return key in self._keys
+
+    def seen(self, key) -> bool:
+        """True, если ключ уже встречался; иначе запоминает его и возвращает False"""
+        if key in self._keys:
+            self._keys.move_to_end(key)
+            self.duplicates += 1
+            return True
+        self._keys[key] = None
+        if len(self._keys) > self.max_size:
+            self._keys.popitem(last=False)
+        return False
+
+    def clear(self):
+        self._keys.clear()
@@ -0,0 +1,481 @@
+#! /usr/bin/env python3
+"""Офлайн нагрузочный тест бота.
+
+Собирает настоящий Application с обработчиками из tg_bot.build_application,
+но с поддельным слоем запросов к Bot API, и прогоняет N параллельных
+синтетических пользователей по полному сценарию:
+/start -> 15 нажатий rating-X -> best-X -> текст причины.
+С --double-tap P часть нажатий оценки повторяется (второе нажатие той же
+кнопки и повторная доставка того же callback_query); по БД проверяется,
+что лишних оценок нет и ни один критерий не пропущен.
+
+Запуск (из директории проекта):
+    python3 src/load_test.py --users 200 --think-time 0.2 --json data/load_test.json
+
+С --shards N тест проверяет шардированный режим: запускаются N воркеров
+(этот же скрипт с --worker-port) со своими БД, а обновления идут через
+диспетчер, как от Telegram. По окончании по БД шардов проверяется, что
+каждый пользователь прошёл сценарий целиком - т.е. порядок его обновлений
+не нарушился.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+
+from telegram import Update
+from telegram.ext import Application
+from telegram.request import BaseRequest
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "LoadTest", "username": "load_test_bot"}
+
+
+class FakeRequest(BaseRequest):
+    """Слой запросов, который отвечает на вызовы Bot API локально"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        result = self._result(endpoint, params)
+        return 200, json.dumps({"ok": True, "result": result}).encode("utf-8")
+
+    def _result(self, endpoint: str, params: dict):
+        if endpoint == "getMe":
+            return BOT_USER
+        if endpoint in ("sendMessage", "sendVideo", "editMessageText", "editMessageCaption",
+                        "editMessageReplyMarkup"):
+            return {
+                "message_id": params.get("message_id") or next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": params.get("chat_id", 0), "type": "private"},
+                "from": BOT_USER,
+                "text": params.get("text") or params.get("caption") or ""
+            }
+        return True
+
+
+class ErrorCounter(logging.Handler):
+    """Считает ошибки в логах бота, отдельно - блокировки SQLite"""
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.errors = 0
+        self.lock_errors = 0
+
+    def emit(self, record):
+        self.errors += 1
+        text = record.getMessage()
+        if record.exc_info and record.exc_info[1] is not None:
+            text += str(record.exc_info[1])
+        if "database is locked" in text or "database table is locked" in text:
+            self.lock_errors += 1
+
+
+class SyntheticUser:
+    """Пользователь, проходящий одну тему от /start до причины выбора"""
+
+    def __init__(self, harness, user_id: int):
+        self.harness = harness
+        self.user_id = user_id
+        self.user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+        self.chat = {"id": user_id, "type": "private"}
+
+    def _message(self, text: str, entities=None) -> dict:
+        message = {
+            "message_id": next(self.harness.update_ids),
+            "date": int(time.time()),
+            "chat": self.chat,
+            "from": self.user,
+            "text": text
+        }
+        if entities:
+            message["entities"] = entities
+        return message
+
+    def command(self, name: str) -> dict:
+        text = f"/{name}"
+        return {"message": self._message(text, [{"type": "bot_command", "offset": 0, "length": len(text)}])}
+
+    def text(self, text: str) -> dict:
+        return {"message": self._message(text)}
+
+    def callback(self, data: str) -> dict:
+        # Кнопки оценки висят под видео: у сообщения подпись, а не текст
+        message = self._message("")
+        message["from"] = BOT_USER
+        message["caption"] = message.pop("text")
+        return {"callback_query": {
+            "id": str(next(self.harness.update_ids)),
+            "from": self.user,
+            "chat_instance": str(self.user_id),
+            "message": message,
+            "data": data
+        }}
+
+    async def run(self, criteria_count: int, videos_count: int):
+        h = self.harness
+        await h.send("start", self.command("start"))
+        for step in range(videos_count * criteria_count):
+            await h.think()
+            data = f"rating-{random.randint(1, 5)}:{step // criteria_count}:{step % criteria_count}"
+            tap = self.callback(data)
+            await h.send("rating", tap)
+            if random.random() < h.double_tap:
+                await h.send("rating", self.callback(data))
+                await h.send("rating", tap)
+        await h.think()
+        await h.send("best", self.callback(f"best-{random.randrange(videos_count)}"))
+        await h.think()
+        await h.send("reason", self.text("Понравилось больше остальных"))
+
+
+class LoadTest:
+    def __init__(self, application: Application, think_time: float, double_tap: float = 0.0):
+        self.application = application
+        self.think_time = think_time
+        self.double_tap = double_tap
+        self.update_ids = itertools.count(1)
+        self.latencies = defaultdict(list)
+        self.failed = Counter()
+
+    async def think(self):
+        if self.think_time > 0:
+            await asyncio.sleep(random.expovariate(1 / self.think_time))
+
+    async def send(self, kind: str, payload: dict):
+        payload["update_id"] = next(self.update_ids)
+        update = Update.de_json(payload, self.application.bot)
+        started = time.perf_counter()
+        try:
+            await self.application.process_update(update)
+        except Exception:
+            self.failed[kind] += 1
+        self.latencies[kind].append(time.perf_counter() - started)
+
+
+class ShardedLoadTest(LoadTest):
+    """Обновления уходят в диспетчер; задержка - время постановки в очередь воркера"""
+
+    def __init__(self, dispatcher, think_time: float, double_tap: float = 0.0):
+        super().__init__(None, think_time, double_tap)
+        self.dispatcher = dispatcher
+
+    async def send(self, kind: str, payload: dict):
+        payload["update_id"] = next(self.update_ids)
+        started = time.perf_counter()
+        try:
+            self.dispatcher.dispatch(payload)
+        except Exception:
+            self.failed[kind] += 1
+        self.latencies[kind].append(time.perf_counter() - started)
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def quiet_logs() -> ErrorCounter:
+    """Логи теста не должны попадать в logs/bot.log; ошибки считаются"""
+    for handler in logging.root.handlers[:]:
+        if isinstance(handler, logging.FileHandler):
+            logging.root.removeHandler(handler)
+    logging.root.setLevel(logging.WARNING)
+    error_counter = ErrorCounter()
+    logging.root.addHandler(error_counter)
+    return error_counter
+
+
+def build_test_application(args):
+    import tg_bot
+    from metrics import InstrumentedRequest
+
+    request = FakeRequest(latency=args.api_latency)
+    builder = (
+        Application.builder()
+        .token("123456:LOAD-TEST")
+        .request(InstrumentedRequest(request))
+        .get_updates_request(FakeRequest())
+    )
+    return tg_bot.build_application(builder), request
+
+
+async def run_worker(args):
+    """Воркер шардированного теста: бот с поддельным Bot API за локальным webhook"""
+    import tg_bot
+    from webhook import run_webhook
+
+    error_counter = quiet_logs()
+    application, request = build_test_application(args)
+    await tg_bot.init_db()
+    await run_webhook(
+        application,
+        host="127.0.0.1",
+        port=args.worker_port,
+        path=tg_bot.WORKER_PATH,
+        secret_token=os.environ["WORKER_SECRET"]
+    )
+    with open(args.worker_report, "w", encoding="utf-8") as f:
+        json.dump({
+            "api_calls": dict(request.calls),
+            "errors": error_counter.errors,
+            "db_lock_errors": error_counter.lock_errors
+        }, f)
+
+
+def count_shard(db_path) -> dict:
+    """Итог по БД шарда: оценки, завершённые темы, пользователи с неполными сессиями"""
+    conn = sqlite3.connect(db_path)
+    try:
+        ratings, users = conn.execute("SELECT COUNT(*), COUNT(DISTINCT user_id) FROM ratings").fetchone()
+        completed = conn.execute("SELECT COUNT(*) FROM completed_themes").fetchone()[0]
+        unfinished = conn.execute("SELECT COUNT(*) FROM progress").fetchone()[0]
+    finally:
+        conn.close()
+    return {"users": users, "ratings": ratings, "completed": completed, "unfinished": unfinished}
+
+
+async def run_sharded_load_test(args, tmp_dir: Path) -> dict:
+    import secrets
+    import catalog
+    from dispatcher import Dispatcher, start_workers, stop_workers
+    from shards import shard_db_path
+
+    error_counter = quiet_logs()
+    secret = secrets.token_urlsafe(16)
+    db_path = Path(os.environ["BOT_DB_PATH"])
+    envs, urls, reports = [], [], []
+    command = [sys.executable, str(Path(__file__).resolve())]
+    for i in range(args.shards):
+        port = args.shard_base_port + i
+        reports.append(tmp_dir / f"worker{i}.json")
+        envs.append({
+            "BOT_DB_PATH": str(shard_db_path(db_path, i)),
+            "WORKER_SECRET": secret,
+        })
+        urls.append(f"http://127.0.0.1:{port}/update")
+    # У каждого воркера свои аргументы: порт и файл отчёта
+    worker_args = ["--api-latency", str(args.api_latency)]
+    processes = []
+    for i, env in enumerate(envs):
+        processes += await start_workers(
+            command + worker_args + ["--worker-port", str(args.shard_base_port + i),
+                                     "--worker-report", str(reports[i])],
+            [env]
+        )
+
+    dispatcher = Dispatcher(urls, secret)
+    await dispatcher.start()
+    harness = ShardedLoadTest(dispatcher, args.think_time, args.double_tap)
+    current = catalog.current()
+    videos_count = len(next(iter(current.themes.values())))
+    users = [SyntheticUser(harness, 10_000 + i) for i in range(args.users)]
+
+    started = time.perf_counter()
+    await asyncio.gather(*(u.run(len(current.criteria), videos_count) for u in users))
+    # Всё передано воркерам, а после SIGTERM они дообрабатывают принятое
+    await dispatcher.stop()
+    await stop_workers(processes)
+    elapsed = time.perf_counter() - started
+
+    shards = [count_shard(shard_db_path(db_path, i)) for i in range(args.shards)]
+    api_calls, errors, lock_errors = Counter(), error_counter.errors, error_counter.lock_errors
+    for path in reports:
+        if not path.exists():
+            errors += 1
+            continue
+        with open(path, encoding="utf-8") as f:
+            worker = json.load(f)
+        api_calls.update(worker["api_calls"])
+        errors += worker["errors"]
+        lock_errors += worker["db_lock_errors"]
+
+    total = sum(len(v) for v in harness.latencies.values())
+    expected_ratings = args.users * videos_count * len(current.criteria)
+    return {
+        "users": args.users,
+        "shards": args.shards,
+        "think_time": args.think_time,
+        "double_tap": args.double_tap,
+        "api_latency": args.api_latency,
+        "elapsed_s": elapsed,
+        "updates": total,
+        "throughput_updates_per_s": total / elapsed if elapsed else 0.0,
+        "handlers": {
+            kind: {
+                "count": len(values),
+                "failed": harness.failed[kind],
+                "p50_ms": percentile(values, 50) * 1000,
+                "p95_ms": percentile(values, 95) * 1000,
+                "p99_ms": percentile(values, 99) * 1000
+            }
+            for kind, values in harness.latencies.items()
+        },
+        "per_shard": shards,
+        "ordering_ok": (
+            sum(s["ratings"] for s in shards) == expected_ratings
+            and sum(s["completed"] for s in shards) == args.users
+            and not any(s["unfinished"] for s in shards)
+        ),
+        "api_calls": dict(api_calls),
+        "errors": errors,
+        "db_lock_errors": lock_errors
+    }
+
+
+async def run_load_test(args) -> dict:
+    import tg_bot
+    import catalog
+    from metrics import registry
+
+    error_counter = quiet_logs()
+    application, request = build_test_application(args)
+
+    await tg_bot.init_db()
+    await application.initialize()
+    harness = LoadTest(application, args.think_time, args.double_tap)
+    current = catalog.current()
+    videos_count = len(next(iter(current.themes.values())))
+    users = [SyntheticUser(harness, 10_000 + i) for i in range(args.users)]
+
+    started = time.perf_counter()
+    await asyncio.gather(*(u.run(len(current.criteria), videos_count) for u in users))
+    elapsed = time.perf_counter() - started
+
+    await application.shutdown()
+    await tg_bot.close_db()
+    if args.metrics:
+        with open(args.metrics, "w", encoding="utf-8") as f:
+            f.write(registry.render())
+
+    result = count_shard(os.environ["BOT_DB_PATH"])
+    total = sum(len(v) for v in harness.latencies.values())
+    return {
+        "users": args.users,
+        "think_time": args.think_time,
+        "double_tap": args.double_tap,
+        "api_latency": args.api_latency,
+        "elapsed_s": elapsed,
+        "updates": total,
+        "throughput_updates_per_s": total / elapsed if elapsed else 0.0,
+        "handlers": {
+            kind: {
+                "count": len(values),
+                "failed": harness.failed[kind],
+                "p50_ms": percentile(values, 50) * 1000,
+                "p95_ms": percentile(values, 95) * 1000,
+                "p99_ms": percentile(values, 99) * 1000
+            }
+            for kind, values in harness.latencies.items()
+        },
+        "result": result,
+        "ordering_ok": (
+            result["ratings"] == args.users * videos_count * len(current.criteria)
+            and result["completed"] == args.users
+            and not result["unfinished"]
+        ),
+        "duplicates_ignored": tg_bot.DUPLICATE_CALLBACKS.total(),
+        "api_calls": dict(request.calls),
+        "errors": error_counter.errors,
+        "db_lock_errors": error_counter.lock_errors
+    }
+
+
+def print_report(report: dict):
+    print(f"Пользователей: {report['users']}, обновлений: {report['updates']}, "
+          f"время: {report['elapsed_s']:.2f} с, "
+          f"пропускная способность: {report['throughput_updates_per_s']:.1f} обн/с")
+    print(f"{'обработчик':<10} {'кол-во':>7} {'ошибки':>7} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9}")
+    for kind, h in report["handlers"].items():
+        print(f"{kind:<10} {h['count']:>7} {h['failed']:>7} "
+              f"{h['p50_ms']:>9.2f} {h['p95_ms']:>9.2f} {h['p99_ms']:>9.2f}")
+    for i, shard in enumerate(report.get("per_shard", [])):
+        print(f"Шард {i}: пользователей {shard['users']}, оценок {shard['ratings']}, "
+              f"завершено тем {shard['completed']}, незавершённых сессий {shard['unfinished']}")
+    if "result" in report:
+        result = report["result"]
+        print(f"В БД: оценок {result['ratings']}, завершено тем {result['completed']}, "
+              f"незавершённых сессий {result['unfinished']}; "
+              f"отброшено повторных нажатий: {report['duplicates_ignored']:.0f}")
+    if "ordering_ok" in report:
+        print(f"Сценарий пройден всеми пользователями: {'да' if report['ordering_ok'] else 'НЕТ'}")
+    print(f"Вызовы Bot API: {report['api_calls']}")
+    print(f"Ошибок в логах: {report['errors']}, из них блокировок БД: {report['db_lock_errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн нагрузочный тест бота")
+    parser.add_argument("--users", type=int, default=100, help="число параллельных пользователей")
+    parser.add_argument("--think-time", type=float, default=0.0,
+                        help="среднее время на раздумья между нажатиями, с")
+    parser.add_argument("--api-latency", type=float, default=0.0,
+                        help="имитируемая задержка одного вызова Bot API, с")
+    parser.add_argument("--db", help="файл БД теста (по умолчанию временный)")
+    parser.add_argument("--json", help="сохранить отчёт в JSON-файл")
+    parser.add_argument("--metrics", help="сохранить метрики бота в формате Prometheus")
+    parser.add_argument("--no-rate-limit", action="store_true",
+                        help="отключить лимиты исходящих вызовов (SEND_GLOBAL_RATE/SEND_CHAT_RATE)")
+    parser.add_argument("--double-tap", type=float, default=0.0,
+                        help="доля нажатий оценки, которые повторяются (двойное нажатие и повторная доставка)")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="прогнать тест через диспетчер и N процессов-воркеров")
+    parser.add_argument("--shard-base-port", type=int, default=8700,
+                        help="порт первого воркера в режиме --shards")
+    parser.add_argument("--worker-port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--worker-report", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    if args.worker_port:
+        # Процесс-воркер: окружение (БД, секрет, лимиты) задал родительский тест
+        asyncio.run(run_worker(args))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Путь к БД задаётся до импорта tg_bot
+        os.environ["BOT_DB_PATH"] = args.db or str(Path(tmp_dir) / "load_test.db")
+        # Фоновый экспорт в тесте не нужен
+        os.environ["EXPORT_INTERVAL"] = "0"
+        if args.no_rate_limit:
+            os.environ["SEND_GLOBAL_RATE"] = "0"
+            os.environ["SEND_CHAT_RATE"] = "0"
+        if args.shards:
+            report = asyncio.run(run_sharded_load_test(args, Path(tmp_dir)))
+        else:
+            report = asyncio.run(run_load_test(args))
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""Обслуживание файла БД SQLite в работающем боте.
+
+Автоматический checkpoint SQLite переносит страницы из WAL в БД, но не
+уменьшает файл -wal и не может его сбросить, пока читатели держат старые
+снимки, поэтому при постоянной записи WAL растёт и чтение замедляется.
+Фоновая задача StorageMaintenance раз в interval секунд:
+- выполняет wal_checkpoint(PASSIVE), когда WAL больше checkpoint_bytes,
+  и wal_checkpoint(TRUNCATE), когда больше truncate_bytes;
+- раз в analyze_interval обновляет статистику планировщика (ANALYZE
+  с ограничением analysis_limit);
+- при auto_vacuum=INCREMENTAL возвращает свободные страницы файлу.
+Задача работает через своё соединение с коротким busy_timeout: если БД
+занята, действие откладывается до следующего прохода, а не задерживает
+запись оценок.
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+import aiosqlite # type: ignore
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINTS = registry.counter(
+    "bot_db_checkpoints_total", "Checkpoint WAL по режиму и результату", ("mode", "result"))
+CHECKPOINT_DURATION = registry.histogram(
+    "bot_db_checkpoint_duration_seconds", "Длительность checkpoint WAL", ("mode",),
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+
+# Сколько строк таблицы просматривает ANALYZE (приближённая статистика за миллисекунды)
+ANALYSIS_LIMIT = 1000
+# Свободное место, после которого запускается incremental_vacuum, и страниц за проход
+VACUUM_FREE_BYTES = 8 * 1024 * 1024
+VACUUM_PAGES_PER_RUN = 2048
+AUTO_VACUUM_MODES = {0: "none", 1: "full", 2: "incremental"}
+
+
+def tuning_pragmas(cache_size_mb: int, mmap_size_mb: int, journal_size_limit: int) -> tuple:
+    """Прагмы производительности для соединений пула (в дополнение к db_pool.CONNECTION_PRAGMAS).
+
+    journal_size_limit обрезает WAL до этого размера после каждого сброса,
+    иначе файл остаётся максимального размера, до которого успел вырасти.
+    """
+    return (
+        "PRAGMA synchronous=NORMAL",
+        f"PRAGMA cache_size=-{cache_size_mb * 1024}",
+        f"PRAGMA mmap_size={mmap_size_mb * 1024 * 1024}",
+        "PRAGMA temp_store=MEMORY",
+        f"PRAGMA journal_size_limit={journal_size_limit}",
+    )
+
+
+def file_size(path) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def format_size(size: int) -> str:
+    return f"{size / 1024 / 1024:.1f} МБ"
+
+
+def ensure_auto_vacuum(db_path, mode: str = "incremental") -> str:
+    """Включает auto_vacuum=INCREMENTAL и возвращает итоговый режим.
+
+    Вызывается до миграций. У новой БД режим выставляется сразу; у
+    существующей - только при mode="convert": для этого нужен VACUUM,
+    который переписывает весь файл и идёт всё время запуска.
+    """
+    conn = sqlite3.connect(str(db_path), isolation_level=None)
+    try:
+        current = AUTO_VACUUM_MODES[conn.execute("PRAGMA auto_vacuum").fetchone()[0]]
+        if mode == "none" or current == "incremental":
+            return current
+        is_new = conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0] == 0
+        if is_new:
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        elif mode == "convert":
+            started = time.perf_counter()
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+            logger.info(f"БД переведена на auto_vacuum=INCREMENTAL за {time.perf_counter() - started:.1f} с, "
+                        f"размер {format_size(file_size(db_path))}")
+        else:
+            return current
+        return AUTO_VACUUM_MODES[conn.execute("PRAGMA auto_vacuum").fetchone()[0]]
+    finally:
+        conn.close()
+
+
+class StorageMaintenance:
+    """Фоновое обслуживание БД: checkpoint WAL, ANALYZE, incremental_vacuum"""
+
+    def __init__(self, db_path, interval: float = 60, checkpoint_bytes: int = 16 * 1024 * 1024,
+                 truncate_bytes: int = 64 * 1024 * 1024, analyze_interval: float = 3600,
+                 busy_timeout_ms: int = 100):
+        self.db_path = str(db_path)
+        self.interval = interval
+        self.checkpoint_bytes = checkpoint_bytes
+        self.truncate_bytes = truncate_bytes
+        self.analyze_interval = analyze_interval
+        self.busy_timeout_ms = busy_timeout_ms
+        self._db = None
+        self._task = None
+        self._analyzed_at = 0.0
+        # mtime WAL после последнего полного checkpoint: файл WAL не уменьшается,
+        # поэтому по одному размеру не видно, есть ли в нём новые страницы
+        self._checkpointed_mtime = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None
+
+    def db_size(self) -> int:
+        return file_size(self.db_path)
+
+    def wal_size(self) -> int:
+        return file_size(f"{self.db_path}-wal")
+
+    def _wal_mtime(self):
+        try:
+            return os.stat(f"{self.db_path}-wal").st_mtime_ns
+        except OSError:
+            return None
+
+    async def start(self):
+        """Открывает соединение и запускает фоновую задачу (interval=0 - выключена)"""
+        if self.is_running or self.interval <= 0:
+            return
+        self._db = await aiosqlite.connect(self.db_path, isolation_level=None)
+        await self._db.execute(f"PRAGMA busy_timeout={self.busy_timeout_ms}")
+        await self._db.execute(f"PRAGMA analysis_limit={ANALYSIS_LIMIT}")
+        # Без статистики (новая БД или до обслуживания) собираем её сразу
+        if not await self._fetchone("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'"):
+            await self.analyze()
+        else:
+            self._analyzed_at = time.monotonic()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Обслуживание БД: {self.stats_line()}")
+
+    async def stop(self):
+        """Останавливает задачу (WAL переносит в БД последнее закрытое соединение)"""
+        if not self.is_running:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self._db.close()
+        self._db = None
+
+    async def _fetchone(self, sql: str):
+        async with self._db.execute(sql) as cursor:
+            return await cursor.fetchone()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Ошибка обслуживания БД: {e}", exc_info=True)
+
+    async def run_once(self):
+        """Один проход обслуживания"""
+        wal = self.wal_size()
+        if wal >= self.truncate_bytes:
+            await self.checkpoint("TRUNCATE")
+        elif wal >= self.checkpoint_bytes and self._wal_mtime() != self._checkpointed_mtime:
+            await self.checkpoint("PASSIVE")
+        if time.monotonic() - self._analyzed_at >= self.analyze_interval:
+            await self.analyze()
+            logger.info(f"Состояние БД: {self.stats_line()}")
+        await self.incremental_vacuum()
+
+    async def checkpoint(self, mode: str = "PASSIVE") -> bool:
+        """wal_checkpoint(mode); False - WAL перенесён не весь (мешают читатели или запись)"""
+        wal_before = self.wal_size()
+        started = time.perf_counter()
+        try:
+            busy, log_pages, done_pages = await self._fetchone(f"PRAGMA wal_checkpoint({mode})")
+        except sqlite3.OperationalError as e:
+            # БД занята дольше busy_timeout - повторим в следующий проход
+            CHECKPOINTS.inc(mode, "busy")
+            logger.warning(f"Checkpoint {mode} отложен: {e}")
+            return False
+        elapsed = time.perf_counter() - started
+        CHECKPOINT_DURATION.observe(elapsed, mode)
+        complete = not busy and done_pages == log_pages
+        if complete:
+            self._checkpointed_mtime = self._wal_mtime()
+        CHECKPOINTS.inc(mode, "complete" if complete else "partial")
+        if log_pages < 0:
+            # Блокировку checkpoint держит другое соединение
+            logger.info(f"Checkpoint {mode} отложен: WAL {format_size(wal_before)}, занят другим соединением")
+            return False
+        logger.info(
+            f"Checkpoint {mode}: WAL {format_size(wal_before)} -> {format_size(self.wal_size())}, "
+            f"перенесено страниц {done_pages} из {log_pages}, БД {format_size(self.db_size())}, "
+            f"{elapsed * 1000:.1f} мс" + ("" if complete else " (не полностью: WAL читается)")
+        )
+        return complete
+
+    async def analyze(self):
+        """Обновляет статистику планировщика запросов"""
+        started = time.perf_counter()
+        try:
+            await self._db.execute("ANALYZE")
+        except sqlite3.OperationalError as e:
+            logger.warning(f"ANALYZE отложен: {e}")
+            return
+        self._analyzed_at = time.monotonic()
+        logger.info(f"ANALYZE выполнен за {(time.perf_counter() - started) * 1000:.1f} мс")
+
+    async def incremental_vacuum(self):
+        """Возвращает свободные страницы файлу (только при auto_vacuum=INCREMENTAL)"""
+        if (await self._fetchone("PRAGMA auto_vacuum"))[0] != 2:
+            return
+        free_pages = (await self._fetchone("PRAGMA freelist_count"))[0]
+        page_size = (await self._fetchone("PRAGMA page_size"))[0]
+        if free_pages * page_size < VACUUM_FREE_BYTES:
+            return
+        started = time.perf_counter()
+        try:
+            # Прагма освобождает по странице за шаг, а execute() делает только первый шаг
+            await self._db.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES_PER_RUN});")
+        except sqlite3.OperationalError as e:
+            logger.warning(f"incremental_vacuum отложен: {e}")
+            return
+        left = (await self._fetchone("PRAGMA freelist_count"))[0]
+        logger.info(
+            f"incremental_vacuum: освобождено страниц {free_pages - left} из {free_pages} за {(time.perf_counter() - started) * 1000:.1f} мс, "
+            f"БД {format_size(self.db_size())}"
+        )
+
+    def stats_line(self) -> str:
+        return f"БД {format_size(self.db_size())}, WAL {format_size(self.wal_size())}"
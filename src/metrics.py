@@ -0,0 +1,212 @@
+"""Метрики бота в текстовом формате Prometheus.
+
+Гистограммы задержек и счётчики для обработчиков, функций работы с БД
+и методов Bot API, плюс небольшой встроенный HTTP-сервер (GET /metrics).
+"""
+import logging
+import time
+from functools import wraps
+from telegram.request import BaseRequest
+from http_server import SimpleHTTPServer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+
+    def inc(self, *label_values, amount: float = 1.0):
+        self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def total(self) -> float:
+        """Сумма по всем значениям меток"""
+        return sum(self._values.values())
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Gauge:
+    """Значение, которое вычисляется в момент запроса метрик"""
+
+    def __init__(self, name: str, help_text: str, func):
+        self.name = name
+        self.help_text = help_text
+        self.func = func
+
+    def render(self) -> list:
+        try:
+            value = float(self.func())
+        except Exception as e:
+            logger.error(f"Ошибка вычисления метрики {self.name}: {e}")
+            return []
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge",
+                f"{self.name} {value}"]
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # label_values -> [счётчики по корзинам, сумма, количество]
+        self._values = {}
+
+    def observe(self, value: float, *label_values):
+        state = self._values.get(label_values)
+        if state is None:
+            state = self._values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[0][i] += 1
+                break
+        state[1] += value
+        state[2] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labels, label_values, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, label_values, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name: str, help_text: str, labels: tuple = ()) -> Counter:
+        metric = Counter(name, help_text, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help_text, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, help_text: str, func) -> Gauge:
+        metric = Gauge(name, help_text, func)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+HANDLER_LATENCY = registry.histogram(
+    "bot_handler_duration_seconds", "Время работы обработчика обновления", ("handler",))
+HANDLER_ERRORS = registry.counter(
+    "bot_handler_errors_total", "Исключения, вышедшие из обработчика", ("handler", "error"))
+DB_LATENCY = registry.histogram(
+    "bot_db_duration_seconds", "Время работы функции доступа к БД", ("function",))
+DB_ERRORS = registry.counter(
+    "bot_db_errors_total", "Исключения в функциях доступа к БД", ("function", "error"))
+API_LATENCY = registry.histogram(
+    "bot_api_request_duration_seconds", "Время вызова метода Bot API", ("method",))
+API_ERRORS = registry.counter(
+    "bot_api_errors_total", "Неуспешные вызовы Bot API", ("method", "code"))
+QUERY_TOO_OLD = registry.counter(
+    "bot_query_too_old_total", "Ответы BadRequest 'Query is too old'", ("method",))
+
+
+def _timed(histogram: Histogram, errors: Counter, name: str):
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                errors.inc(name, type(e).__name__)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started, name)
+        return wrapper
+    return decorator
+
+
+def instrument_handler(func):
+    """Декоратор обработчика: гистограмма задержек и счётчик исключений"""
+    return _timed(HANDLER_LATENCY, HANDLER_ERRORS, func.__name__)(func)
+
+
+def instrument_db(func):
+    """Декоратор функции БД: гистограмма задержек и счётчик исключений"""
+    return _timed(DB_LATENCY, DB_ERRORS, func.__name__)(func)
+
+
+class InstrumentedRequest(BaseRequest):
+    """Обёртка над слоем запросов, замеряющая каждый вызов Bot API"""
+
+    def __init__(self, inner: BaseRequest):
+        self.inner = inner
+
+    async def initialize(self) -> None:
+        await self.inner.initialize()
+
+    async def shutdown(self) -> None:
+        await self.inner.shutdown()
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await self.inner.do_request(url, method, request_data, *args, **kwargs)
+        except Exception as e:
+            API_ERRORS.inc(api_method, type(e).__name__)
+            raise
+        finally:
+            API_LATENCY.observe(time.perf_counter() - started, api_method)
+        if code != 200:
+            API_ERRORS.inc(api_method, str(code))
+            if code == 400 and b"query is too old" in payload.lower():
+                QUERY_TOO_OLD.inc(api_method)
+        return code, payload
+
+
+class MetricsServer(SimpleHTTPServer):
+    """HTTP-сервер, отдающий метрики на GET /metrics"""
+
+    def __init__(self, host: str, port: int):
+        super().__init__(host, port)
+        self.route("/metrics", self._metrics)
+
+    async def start(self):
+        await super().start()
+        logger.info(f"Метрики доступны на http://{self.host}:{self.port}/metrics")
+
+    async def _metrics(self, method: str, headers: dict, body: bytes):
+        if method != "GET":
+            return 405, b"method not allowed\n", "text/plain"
+        return 200, registry.render().encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8"
@@ -0,0 +1,307 @@
+#! /usr/bin/env python3
+"""Версионированные миграции схемы ratings.db.
+
+Версия схемы хранится в PRAGMA user_version. Каждая миграция - SQL-скрипт
+или функция от соединения (когда данные нужно пересчитать в Python); она
+выполняется в отдельной транзакции вместе с обновлением версии, поэтому
+существующий файл БД обновляется на месте.
+
+Запуск вручную (из директории проекта):
+    python3 src/migrations.py
+"""
+import json
+import logging
+import sqlite3
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+DB_PATH = BASE_DIR / "data" / "ratings.db"
+
+# STRICT-таблицы поддерживаются начиная с SQLite 3.37
+STRICT = ", STRICT" if sqlite3.sqlite_version_info >= (3, 37, 0) else ""
+STRICT_ONLY = " STRICT" if STRICT else ""
+
+
+class SchemaVersionError(RuntimeError):
+    """Версия схемы БД не поддерживается этим кодом"""
+
+
+def compact_progress(conn: sqlite3.Connection):
+    """4 -> 5: прогресс хранится числами вместо JSON.
+
+    Тема - ссылка на таблицу themes, порядок видео - номер перестановки
+    позиций каталога. Строки, порядок которых не удаётся сопоставить
+    с каталогом, удаляются: пользователь начнёт тему заново.
+    """
+    # executescript закоммитил бы открытую транзакцию - только execute
+    conn.execute(f"""
+    CREATE TABLE themes (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE){STRICT_ONLY}""")
+    conn.execute(f"""
+    CREATE TABLE progress_new (
+        user_id INTEGER PRIMARY KEY,
+        theme_id INTEGER NOT NULL REFERENCES themes(id),
+        order_index INTEGER NOT NULL,
+        video_index INTEGER NOT NULL,
+        current_criterion INTEGER NOT NULL,
+        waiting_for_best_reason INTEGER NOT NULL DEFAULT 0,
+        updated_at REAL NOT NULL DEFAULT (julianday('now'))){STRICT_ONLY}""")
+    rows = conn.execute(
+        "SELECT user_id, theme, videos, video_index, current_criterion, "
+        "waiting_for_best_reason, updated_at FROM progress"
+    ).fetchall()
+    dropped = 0
+    if rows:
+        import catalog
+        current = catalog.current()
+        for user_id, theme, videos, video_index, current_criterion, waiting, updated_at in rows:
+            try:
+                order_index = current.order_index(theme, json.loads(videos or "[]"))
+            except (catalog.CatalogError, ValueError):
+                dropped += 1
+                continue
+            conn.execute("INSERT OR IGNORE INTO themes (name) VALUES (?)", (theme,))
+            conn.execute(
+                "INSERT INTO progress_new (user_id, theme_id, order_index, video_index, "
+                "current_criterion, waiting_for_best_reason, updated_at) "
+                "SELECT ?, id, ?, ?, ?, ?, ? FROM themes WHERE name = ?",
+                (user_id, order_index, video_index or 0, current_criterion or 0,
+                 int(bool(waiting)), updated_at, theme)
+            )
+    if dropped:
+        logger.warning(f"Миграция прогресса: удалено строк, не совпавших с каталогом: {dropped}")
+    conn.execute("DROP TABLE progress")
+    conn.execute("ALTER TABLE progress_new RENAME TO progress")
+    conn.execute("CREATE INDEX progress_by_updated_at ON progress(updated_at)")
+
+
+# Миграция i переводит схему с версии i на версию i + 1
+MIGRATIONS = [
+    # 0 -> 1: исходная схема (как её создавал init_db)
+    """
+    CREATE TABLE IF NOT EXISTS progress (
+        user_id INTEGER PRIMARY KEY,
+        theme TEXT,
+        videos TEXT,
+        video_index INTEGER,
+        current_criterion INTEGER,
+        current_score TEXT,
+        waiting_for_best_reason BOOLEAN);
+
+    CREATE TABLE IF NOT EXISTS completed_themes (
+        user_id INTEGER,
+        theme TEXT,
+        PRIMARY KEY(user_id, theme));
+
+    CREATE TABLE IF NOT EXISTS best_videos (
+        user_id INTEGER,
+        theme TEXT,
+        video_id TEXT,
+        reason TEXT,
+        PRIMARY KEY(user_id, theme));
+
+    CREATE TABLE IF NOT EXISTS ratings (
+        user_id INTEGER,
+        theme TEXT,
+        video_id TEXT,
+        criterion TEXT,
+        score INTEGER);
+    """,
+
+    # 1 -> 2: естественный ключ и индексы для ratings, STRICT / WITHOUT ROWID
+    f"""
+    CREATE TABLE ratings_new (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        theme TEXT NOT NULL,
+        video_id TEXT NOT NULL,
+        criterion TEXT NOT NULL,
+        score INTEGER NOT NULL,
+        UNIQUE(user_id, theme, video_id, criterion)){STRICT_ONLY};
+
+    -- Дубликаты оставляем в порядке вставки: первая оценка побеждает
+    INSERT OR IGNORE INTO ratings_new (user_id, theme, video_id, criterion, score)
+        SELECT user_id, theme, video_id, criterion, score
+        FROM ratings
+        WHERE user_id IS NOT NULL AND theme IS NOT NULL AND video_id IS NOT NULL
+              AND criterion IS NOT NULL AND score IS NOT NULL
+        ORDER BY rowid;
+    DROP TABLE ratings;
+    ALTER TABLE ratings_new RENAME TO ratings;
+
+    -- Покрывающий индекс для выборок по видео и критерию
+    CREATE INDEX ratings_by_video ON ratings(theme, video_id, criterion, score);
+
+    CREATE TABLE progress_new (
+        user_id INTEGER PRIMARY KEY,
+        theme TEXT,
+        videos TEXT,
+        video_index INTEGER,
+        current_criterion INTEGER,
+        current_score TEXT,
+        waiting_for_best_reason INTEGER){STRICT_ONLY};
+    INSERT INTO progress_new SELECT * FROM progress;
+    DROP TABLE progress;
+    ALTER TABLE progress_new RENAME TO progress;
+
+    CREATE TABLE completed_themes_new (
+        user_id INTEGER NOT NULL,
+        theme TEXT NOT NULL,
+        PRIMARY KEY(user_id, theme)) WITHOUT ROWID{STRICT};
+    INSERT OR IGNORE INTO completed_themes_new
+        SELECT user_id, theme FROM completed_themes
+        WHERE user_id IS NOT NULL AND theme IS NOT NULL;
+    DROP TABLE completed_themes;
+    ALTER TABLE completed_themes_new RENAME TO completed_themes;
+
+    CREATE TABLE best_videos_new (
+        user_id INTEGER NOT NULL,
+        theme TEXT NOT NULL,
+        video_id TEXT,
+        reason TEXT,
+        PRIMARY KEY(user_id, theme)) WITHOUT ROWID{STRICT};
+    INSERT OR IGNORE INTO best_videos_new
+        SELECT user_id, theme, video_id, reason FROM best_videos
+        WHERE user_id IS NOT NULL AND theme IS NOT NULL;
+    DROP TABLE best_videos;
+    ALTER TABLE best_videos_new RENAME TO best_videos;
+    """,
+
+    # 2 -> 3: время изменения строк для инкрементального экспорта
+    f"""
+    CREATE TABLE progress_new (
+        user_id INTEGER PRIMARY KEY,
+        theme TEXT,
+        videos TEXT,
+        video_index INTEGER,
+        current_criterion INTEGER,
+        current_score TEXT,
+        waiting_for_best_reason INTEGER,
+        updated_at REAL NOT NULL DEFAULT (julianday('now'))){STRICT_ONLY};
+    INSERT INTO progress_new SELECT *, julianday('now') FROM progress;
+    DROP TABLE progress;
+    ALTER TABLE progress_new RENAME TO progress;
+    CREATE INDEX progress_by_updated_at ON progress(updated_at);
+
+    CREATE TABLE completed_themes_new (
+        user_id INTEGER NOT NULL,
+        theme TEXT NOT NULL,
+        updated_at REAL NOT NULL DEFAULT (julianday('now')),
+        PRIMARY KEY(user_id, theme)) WITHOUT ROWID{STRICT};
+    INSERT INTO completed_themes_new SELECT *, julianday('now') FROM completed_themes;
+    DROP TABLE completed_themes;
+    ALTER TABLE completed_themes_new RENAME TO completed_themes;
+    CREATE INDEX completed_themes_by_updated_at ON completed_themes(updated_at);
+
+    CREATE TABLE best_videos_new (
+        user_id INTEGER NOT NULL,
+        theme TEXT NOT NULL,
+        video_id TEXT,
+        reason TEXT,
+        updated_at REAL NOT NULL DEFAULT (julianday('now')),
+        PRIMARY KEY(user_id, theme)) WITHOUT ROWID{STRICT};
+    INSERT INTO best_videos_new SELECT *, julianday('now') FROM best_videos;
+    DROP TABLE best_videos;
+    ALTER TABLE best_videos_new RENAME TO best_videos;
+    CREATE INDEX best_videos_by_updated_at ON best_videos(updated_at);
+    """,
+
+    # 3 -> 4: агрегаты по (theme, video_id, criterion), обновляемые триггером
+    # в той же транзакции, что и вставка оценки
+    f"""
+    CREATE TABLE rating_stats (
+        theme TEXT NOT NULL,
+        video_id TEXT NOT NULL,
+        criterion TEXT NOT NULL,
+        n INTEGER NOT NULL,
+        total INTEGER NOT NULL,
+        total_sq INTEGER NOT NULL,
+        PRIMARY KEY(theme, video_id, criterion)) WITHOUT ROWID{STRICT};
+
+    INSERT INTO rating_stats
+        SELECT theme, video_id, criterion, COUNT(*), SUM(score), SUM(score * score)
+        FROM ratings
+        GROUP BY theme, video_id, criterion;
+
+    -- INSERT OR IGNORE не вызывает триггер для отброшенных дубликатов
+    CREATE TRIGGER ratings_stats_insert AFTER INSERT ON ratings
+    BEGIN
+        INSERT INTO rating_stats (theme, video_id, criterion, n, total, total_sq)
+        VALUES (NEW.theme, NEW.video_id, NEW.criterion, 1, NEW.score, NEW.score * NEW.score)
+        ON CONFLICT(theme, video_id, criterion) DO UPDATE SET
+            n = n + 1,
+            total = total + excluded.total,
+            total_sq = total_sq + excluded.total_sq;
+    END;
+
+    CREATE TRIGGER ratings_stats_delete AFTER DELETE ON ratings
+    BEGIN
+        UPDATE rating_stats SET
+            n = n - 1,
+            total = total - OLD.score,
+            total_sq = total_sq - OLD.score * OLD.score
+        WHERE theme = OLD.theme AND video_id = OLD.video_id AND criterion = OLD.criterion;
+    END;
+    """,
+
+    # 4 -> 5: компактный прогресс без JSON
+    compact_progress,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def check_version(conn: sqlite3.Connection):
+    """Проверяет, что схема БД ровно той версии, которую понимает код"""
+    version = get_version(conn)
+    if version != SCHEMA_VERSION:
+        raise SchemaVersionError(
+            f"Версия схемы БД {version}, ожидается {SCHEMA_VERSION}. "
+            + ("Обновите код." if version > SCHEMA_VERSION
+               else "Запустите бота или python3 src/migrations.py для обновления.")
+        )
+
+
+def migrate(db_path) -> int:
+    """Обновляет схему БД до SCHEMA_VERSION и возвращает итоговую версию"""
+    conn = sqlite3.connect(str(db_path), isolation_level=None)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        version = get_version(conn)
+        if version > SCHEMA_VERSION:
+            raise SchemaVersionError(
+                f"Версия схемы БД {version} новее поддерживаемой ({SCHEMA_VERSION})"
+            )
+        for target in range(version + 1, SCHEMA_VERSION + 1):
+            migration = MIGRATIONS[target - 1]
+            try:
+                if callable(migration):
+                    conn.execute("BEGIN IMMEDIATE")
+                    migration(conn)
+                    conn.execute(f"PRAGMA user_version = {target}")
+                    conn.execute("COMMIT")
+                else:
+                    conn.executescript(
+                        "BEGIN IMMEDIATE;\n"
+                        + migration
+                        + f"\nPRAGMA user_version = {target};\nCOMMIT;"
+                    )
+            except Exception:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+        return get_version(conn)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+    print(f"Версия схемы: {migrate(DB_PATH)}")
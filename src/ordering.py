@@ -0,0 +1,112 @@
+import asyncio
+import contextvars
+from contextlib import asynccontextmanager
+from telegram import Update
+from telegram.ext import Application
+
+
+class KeyedLocks:
+    """Блокировки по ключу, которые удаляются, как только их никто не держит и не ждёт"""
+
+    def __init__(self):
+        # key -> [lock, число держателей и ожидающих]
+        self._locks = {}
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+
+class UpdateSlot:
+    """Слот update_limit, занятый обработкой одного обновления"""
+
+    def __init__(self, semaphore: asyncio.Semaphore):
+        self.semaphore = semaphore
+        self.held = False
+
+    async def acquire(self):
+        await self.semaphore.acquire()
+        self.held = True
+
+    def release(self):
+        if self.held:
+            self.held = False
+            self.semaphore.release()
+
+
+# Слот обновления, которое обрабатывается в текущей задаче
+_current_slot = contextvars.ContextVar("update_slot", default=None)
+
+
+@asynccontextmanager
+async def released_slot():
+    """Отпускает слот текущего обновления на время ожидания, не связанного
+    с обработкой (лимиты и повторы отправки), и занимает его снова после"""
+    slot = _current_slot.get()
+    if slot is None or not slot.held:
+        yield
+        return
+    slot.release()
+    try:
+        yield
+    finally:
+        await slot.acquire()
+
+
+class UserOrderedApplication(Application):
+    """Application, который обрабатывает обновления разных пользователей
+    параллельно (не больше update_limit одновременно), а обновления одного
+    user_id - строго по очереди.
+
+    Библиотечный concurrent_updates задаёт только число задач в ожидании:
+    слот update_limit занимается уже после получения блокировки пользователя,
+    поэтому очередь нажатий одного пользователя не тормозит остальных.
+    На время ожидания лимита отправки слот отпускается (released_slot):
+    иначе несколько чатов, упёршихся в свой лимит, заняли бы все слоты.
+    """
+
+    def __init__(self, *, update_limit: int = 32, **kwargs):
+        super().__init__(**kwargs)
+        self.update_limit = update_limit
+        self.user_locks = KeyedLocks()
+        self._update_slots = asyncio.BoundedSemaphore(update_limit)
+
+    @staticmethod
+    def ordering_key(update: object):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def _process_in_slot(self, update: object) -> None:
+        slot = UpdateSlot(self._update_slots)
+        await slot.acquire()
+        token = _current_slot.set(slot)
+        try:
+            await super().process_update(update)
+        finally:
+            _current_slot.reset(token)
+            slot.release()
+
+    async def process_update(self, update: object) -> None:
+        key = self.ordering_key(update)
+        if key is None:
+            await self._process_in_slot(update)
+            return
+        async with self.user_locks.hold(key):
+            await self._process_in_slot(update)
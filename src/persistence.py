@@ -0,0 +1,137 @@
+import asyncio
+import logging
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+# Версия сессии в user_data: увеличивается при каждой прямой записи кодом бота
+VERSION_KEY = '_version'
+
+
+def reset_session(data: dict):
+    """Очищает user_data, сохраняя версию сессии: иначе снимки очищенной
+    сессии выглядели бы старше последней прямой записи и не сохранялись"""
+    version = data.get(VERSION_KEY, 0)
+    data.clear()
+    data[VERSION_KEY] = version
+
+
+class SessionPersistence(BasePersistence):
+    """Persistence для user_data поверх таблиц бота.
+
+    При запуске Application все сохранённые сессии загружаются одним запросом
+    (load). Изменённые user_data Application передаёт раз в update_interval;
+    они копятся и записываются одной пачкой (save) - по интервалу и при
+    остановке. Если код бота сам записал сессию пользователя позже снимка
+    (mark_written), устаревший снимок не пишется.
+
+    Свежесть определяется по версии внутри user_data (VERSION_KEY), а не по
+    времени вызова update_user_data: Application копирует user_data раньше,
+    чем вызывает метод, и копия, сделанная до прямой записи, несёт старую версию.
+
+    load: async () -> {user_id: user_data}
+    save: async ([(user_id, версия снимка, user_data), ...], is_fresh) -> None;
+    save должна проверить is_fresh(user_id, версия снимка) непосредственно
+    перед постановкой записи в ту же очередь, через которую пишет бот.
+    """
+
+    def __init__(self, load, save, update_interval: float = 10):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self._load = load
+        self._save = save
+        # user_id -> (версия снимка, user_data)
+        self._dirty = {}
+        # user_id -> версия последней прямой записи сессии кодом бота
+        self._written = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+
+    def mark_written(self, user_id: int, data: dict):
+        """Запись сессии пользователя только что поставлена в очередь кодом бота.
+
+        Увеличивает версию в data: снимки, скопированные раньше, устаревают.
+        """
+        # max: версия в data могла откатиться (сессию восстановили из копии)
+        version = max(data.get(VERSION_KEY, 0), self._written.get(user_id, 0)) + 1
+        data[VERSION_KEY] = version
+        self._written[user_id] = version
+
+    def is_fresh(self, user_id: int, version: int) -> bool:
+        """Снимок не старше последней прямой записи"""
+        return self._written.get(user_id, 0) <= version
+
+    async def get_user_data(self) -> dict:
+        data = await self._load()
+        logger.info(f"Восстановлено сессий: {len(data)}")
+        return data
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        # Application вызывает метод для всех изменённых пользователей сразу;
+        # запись откладывается до конца этого прохода и идёт одной пачкой
+        self._dirty[user_id] = (data.get(VERSION_KEY, 0), data)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self.flush())
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._dirty.pop(user_id, None)
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+            try:
+                await self._save(
+                    [(user_id, version, data) for user_id, (version, data) in dirty.items()],
+                    self.is_fresh
+                )
+            except Exception as e:
+                logger.error(f"Ошибка записи сессий ({len(dirty)}): {e}", exc_info=True)
+                # Повторим в следующий раз, если за это время не появился снимок новее
+                for user_id, item in dirty.items():
+                    self._dirty.setdefault(user_id, item)
+                return
+            for user_id, (version, _) in dirty.items():
+                # Отметки старше записанных снимков больше не нужны
+                if self.is_fresh(user_id, version):
+                    self._written.pop(user_id, None)
+
+    # Остальные данные бот не хранит
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
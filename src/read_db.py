@@ -1,106 +1,562 @@
+import argparse
+import csv
+import gzip
+import os
+import pickle
 import sqlite3
+import tempfile
+import time
 import pandas as pd
+from openpyxl import Workbook
 from pathlib import Path
+from migrations import check_version, SCHEMA_VERSION
+from shards import find_shards
+import analysis
+import catalog
 
 BASE_DIR = Path(__file__).resolve().parent.parent
-DB_PATH = BASE_DIR / "data" / "ratings.db"
+DB_PATH = Path(os.environ.get("BOT_DB_PATH", BASE_DIR / "data" / "ratings.db"))
 EXCEL_PATH = BASE_DIR / "data" / "results.xlsx"
+# Состояние прошлого экспорта: водяные знаки и таблицы листов
+STATE_PATH = BASE_DIR / "data" / "results.state.pkl"
+# Сжатые CSV потокового экспорта: results_<лист>.csv.gz
+CSV_DIR = BASE_DIR / "data"
+# Сколько строк читается из БД за один раз при потоковом экспорте
+CHUNK_SIZE = 10000
+# Кэш листа Analysis: пересчитывается только при изменении оценок
+ANALYSIS_CACHE_PATH = BASE_DIR / "data" / "analysis.cache.pkl"
+# Число бутстреп-ресэмплов для доверительных интервалов
+BOOTSTRAP_RESAMPLES = int(os.environ.get("BOOTSTRAP_RESAMPLES", 2000))
 
-# Константы из кода бота
-CRITERIA = [
-    "Логичность",
-    "Информативность",
-    "Интересность",
-    "Естественность",
-    "Согласованность невербальных сигналов"
-]
-
-THEMES = {
-    "Робототехника": 3,
-    "Кто живет в Антарктиде?": 3,
-    "Кто побывал в космосе?": 3
-}
-
-VIDEO_NAMES = {
-    "BAACAgIAAxkBAAICd2fu0op2FHJKi1m7QGpVVdvKWTDRAAJWdwACZQl5S_llkb0_CmGJNgQ": "Робототехника - Человеческий",
-    "BAACAgIAAxkBAAICeWfu0viUdwFlNZzSdae69xGgI90uAAJgdwACZQl5SwF6kl6EP6sXNgQ": "Робототехника - Сгенерированный",
-    "BAACAgIAAxkBAAICe2fu0zeZAhxuI3k-VGGRhhtQY0ZgAAJkdwACZQl5S1sLnwKesL77NgQ": "Робототехника - Сгенерированный+",
-    "BAACAgIAAxkBAAICfWfu03duP7DAGcwrN3cCOqOF7dqfAAJqdwACZQl5S88OE6dAP5I9NgQ": "Кто живет в Антарктиде? - Человеческий",
-    "BAACAgIAAxkBAAICf2fu1BYe1Vw3VoUdOcRpNDwg7I9sAAJ3dwACZQl5S3o5xoU0FVwbNgQ": "Кто живет в Антарктиде? - Сгенерированный",
-    "BAACAgIAAxkBAAICgWfu1FtO9Octp6vsrYBV5yfJL-DjAAJ-dwACZQl5S59QIpq9JsPXNgQ": "Кто живет в Антарктиде? - Сгенерированный+",
-    "BAACAgIAAxkBAAICg2fu1J12-JorEkz5B7qVXPkP8BOJAAKLdwACZQl5S4nTlKsAAUvKITYE": "Кто побывал в космосе? - Человеческий",
-    "BAACAgIAAxkBAAIChWfu1NOaYhKlhXIGArjXcN0a1eMcAAKYdwACZQl5S_CivLrQ9MOwNgQ": "Кто побывал в космосе? - Сгенерированный",
-    "BAACAgIAAxkBAAICh2fu1RjzLDI9OeIQ7elA2L6oEAK9AAKpdwACZQl5S2cPjv9IVz8cNgQ": "Кто побывал в космосе? - Сгенерированный+"
-}
-def get_human_name(video_id: str) -> str:
-    return VIDEO_NAMES.get(video_id, video_id)
-
-def export_to_excel():
+RATINGS_KEY = ['user_id', 'theme', 'video_id']
+STATUS_KEY = ['user_id', 'theme']
+BEST_KEY = ['user_id', 'theme']
+
+
+def table_columns(conn, table: str) -> list:
+    return [row[1] for row in conn.execute(f"PRAGMA main.table_info({table})")]
+
+
+def backup_db(path, target: sqlite3.Connection):
+    """Копирует БД в target через online backup API одним шагом.
+
+    Весь файл копируется внутри одной транзакции чтения, поэтому копия
+    соответствует одному моменту. В режиме WAL (его включают миграции)
+    читатель не блокирует запись: бот продолжает писать во время копирования.
+    """
+    source = sqlite3.connect(path)
+    try:
+        check_version(source)
+        source.backup(target)
+    finally:
+        source.close()
+
+
+def merge_shard(conn: sqlite3.Connection, path):
+    """Добавляет в conn данные шарда path.
+
+    Пользователи шардов не пересекаются; id тем у шардов свои, поэтому
+    прогресс переносится с сопоставлением тем по названию. При совпадении
+    ключей остаётся строка из более раннего источника. Все чтения шарда
+    идут в одной транзакции, то есть тоже из одного момента.
+    """
+    shard = sqlite3.connect(path)
+    try:
+        check_version(shard)
+    finally:
+        shard.close()
+    conn.execute("ATTACH DATABASE ? AS shard", (str(path),))
     try:
-        conn = sqlite3.connect(DB_PATH)
-        
-        # Лист 1: Оценки по критериям
-        ratings_df = pd.read_sql("SELECT * FROM ratings", conn)
-        ratings_pivot = ratings_df.pivot_table(
-            index=['user_id', 'theme', 'video_id'],
-            columns='criterion',
-            values='score',
-            aggfunc='first'
-        ).reset_index()
-        ratings_pivot['video_name'] = ratings_pivot['video_id'].apply(get_human_name)
-        ratings_pivot = ratings_pivot.drop('video_id', axis=1)
-
-        # Лист 2: Статусы тем с прогрессом
-        status_query = """
-            SELECT 
-                p.user_id,
-                p.theme,
-                'in progress' AS status,
-                p.video_index + 1 AS current_video,
-                p.current_criterion + 1 AS current_criterion,
-                json_extract(p.videos, '$') AS videos_json
-            FROM progress p
-            UNION ALL
-            SELECT 
-                ct.user_id,
-                ct.theme,
-                'completed' AS status,
-                NULL AS current_video,
-                NULL AS current_criterion,
-                NULL AS videos_json
-            FROM completed_themes ct
+        with conn:
+            for table in ("ratings", "completed_themes", "best_videos"):
+                # id оценок в каждом шарде свои: вставляем без него, в исходном порядке
+                columns = ", ".join(c for c in table_columns(conn, table) if c != "id")
+                order = " ORDER BY id" if table == "ratings" else ""
+                conn.execute(
+                    f"INSERT OR IGNORE INTO main.{table} ({columns}) "
+                    f"SELECT {columns} FROM shard.{table}{order}"
+                )
+            conn.execute("INSERT OR IGNORE INTO main.themes (name) SELECT name FROM shard.themes ORDER BY id")
+            columns = [c for c in table_columns(conn, "progress") if c != "theme_id"]
+            conn.execute(
+                f"INSERT OR IGNORE INTO main.progress ({', '.join(columns)}, theme_id) "
+                f"SELECT {', '.join('p.' + c for c in columns)}, t.id "
+                "FROM shard.progress p "
+                "JOIN shard.themes s ON s.id = p.theme_id "
+                "JOIN main.themes t ON t.name = s.name"
+            )
+    finally:
+        conn.execute("DETACH DATABASE shard")
+
+
+def snapshot(target=":memory:"):
+    """Снимок БД для экспорта и признак шардированной БД.
+
+    Экспорт читает только снимок: рабочая БД занята лишь на время
+    копирования, а все листы строятся по данным одного момента. target -
+    ":memory:" или путь к временному файлу (для потокового экспорта, чтобы
+    память не зависела от размера БД). Если рядом с DB_PATH есть шарды
+    (ratings.shard<i>.db), снимок содержит их объединение; каждый шард
+    согласован сам с собой, а пользователи шардов не пересекаются.
+    """
+    shards = find_shards(DB_PATH)
+    sources = ([DB_PATH] if not shards or DB_PATH.exists() else []) + shards
+    if shards:
+        print(f"Объединяются шарды: {', '.join(p.name for p in sources)}")
+    conn = sqlite3.connect(target)
+    try:
+        started = time.perf_counter()
+        backup_db(sources[0], conn)
+        for path in sources[1:]:
+            merge_shard(conn, path)
+    except Exception:
+        conn.close()
+        raise
+    print(f"Снимок БД получен за {time.perf_counter() - started:.2f} с")
+    return conn, bool(shards)
+
+
+def video_names(video_ids: pd.Series) -> pd.Series:
+    """file_id -> "Тема - Вариант"; неизвестные file_id остаются как есть"""
+    return video_ids.map(catalog.current().video_names).fillna(video_ids)
+
+
+def progress_text(status: str, theme: str, current_video, current_criterion) -> str:
+    if status != 'in progress':
+        return 'Завершено'
+    current = catalog.current()
+    return (
+        f"Видео {int(current_video)}/{len(current.themes.get(theme, ()))}, "
+        f"критерий {int(current_criterion)}/{len(current.criteria)}"
+    )
+
+
+def empty_state() -> dict:
+    """Состояние для полной пересборки: водяные знаки с нуля, пустые таблицы"""
+    return {
+        'schema_version': SCHEMA_VERSION,
+        'ratings_id': 0,
+        'progress_updated_at': 0.0,
+        'completed_updated_at': 0.0,
+        'best_updated_at': 0.0,
+        'ratings': pd.DataFrame(columns=RATINGS_KEY),
+        'status': pd.DataFrame(columns=STATUS_KEY + ['status', 'progress']),
+        'best': pd.DataFrame(columns=BEST_KEY + ['video_id', 'reason'])
+    }
+
+
+def load_state() -> dict:
+    """Загружает состояние прошлого экспорта, если им можно воспользоваться"""
+    if not STATE_PATH.exists() or not EXCEL_PATH.exists():
+        return None
+    try:
+        with open(STATE_PATH, "rb") as f:
+            state = pickle.load(f)
+    except Exception as e:
+        print(f"Не удалось прочитать состояние экспорта ({e}), выполняется полная пересборка")
+        return None
+    if state.get('schema_version') != SCHEMA_VERSION:
+        return None
+    return state
+
+
+def save_state(state: dict):
+    tmp_path = temp_path(STATE_PATH)
+    with open(tmp_path, "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, STATE_PATH)
+
+
+def temp_path(path: Path) -> Path:
+    """Временный файл рядом с path: файл пишется в него целиком и подменяет path
+    через os.replace, поэтому читатель никогда не увидит недописанный файл.
+
+    Имя уникально для процесса: в шардированном режиме /export может идти
+    в нескольких воркерах сразу, и общий временный файл они испортили бы.
+    """
+    return path.with_name(f".{path.name}.{os.getpid()}.tmp")
+
+
+def upsert(old: pd.DataFrame, new: pd.DataFrame, key: list) -> pd.DataFrame:
+    """Добавляет новые строки и заменяет изменённые по ключу"""
+    if new.empty:
+        return old
+    if old.empty:
+        return new.drop_duplicates(subset=key, keep='last').reset_index(drop=True)
+    merged = pd.concat([old, new], ignore_index=True)
+    return merged.drop_duplicates(subset=key, keep='last').reset_index(drop=True)
+
+
+def update_ratings(conn, state: dict):
+    """Лист 1: оценки по критериям (только строки с id выше водяного знака).
+
+    Здесь строгое сравнение верно: новая строка получает id = max(id) + 1
+    (запись в SQLite идёт по одной транзакции, оценки не удаляются), поэтому
+    строки, добавленные после прошлого экспорта, всегда выше водяного знака.
+    """
+    new_df = pd.read_sql(
+        "SELECT id, user_id, theme, video_id, criterion, score FROM ratings WHERE id > ?",
+        conn, params=(state['ratings_id'],)
+    )
+    if new_df.empty:
+        return
+    state['ratings_id'] = int(new_df['id'].max())
+    new_pivot = new_df.pivot_table(
+        index=RATINGS_KEY,
+        columns='criterion',
+        values='score',
+        aggfunc='first'
+    )
+    old = state['ratings']
+    if old.empty:
+        merged = new_pivot
+    else:
+        # Новые оценки дополняют уже выгруженные строки (user_id, theme, video_id)
+        merged = old.set_index(RATINGS_KEY).combine_first(new_pivot)
+    criteria = sorted(c for c in merged.columns if c not in RATINGS_KEY)
+    state['ratings'] = merged[criteria].reset_index()
+
+
+def update_status(conn, state: dict):
+    """Лист 2: статусы тем с прогрессом (изменённые строки).
+
+    Фильтр по updated_at нестрогий: julianday('now') у разных записей может
+    совпасть, и строка с тем же временем, записанная после прошлого экспорта,
+    иначе была бы пропущена. Строки на самом водяном знаке читаются повторно,
+    upsert заменяет их по ключу.
+    """
+    progress_df = pd.read_sql(
+        """
+        SELECT
+            p.user_id,
+            t.name AS theme,
+            'in progress' AS status,
+            p.video_index + 1 AS current_video,
+            p.current_criterion + 1 AS current_criterion,
+            p.updated_at
+        FROM progress p JOIN themes t ON t.id = p.theme_id
+        WHERE p.updated_at >= ?
+        """, conn, params=(state['progress_updated_at'],)
+    )
+    completed_df = pd.read_sql(
         """
-        status_df = pd.read_sql(status_query, conn)
-        status_df['total_videos'] = status_df['theme'].map(THEMES)
-        status_df['total_criteria'] = len(CRITERIA)
-        status_df['progress'] = status_df.apply(
-            lambda x: (
-                f"Видео {int(x.current_video)}/{int(x.total_videos)}, "
-                f"критерий {int(x.current_criterion)}/{int(x.total_criteria)}"
-            ) if x.status == 'in progress' else 'Завершено', 
-            axis=1
+        SELECT
+            user_id,
+            theme,
+            'completed' AS status,
+            NULL AS current_video,
+            NULL AS current_criterion,
+            updated_at
+        FROM completed_themes
+        WHERE updated_at >= ?
+        """, conn, params=(state['completed_updated_at'],)
+    )
+    if not progress_df.empty:
+        state['progress_updated_at'] = float(progress_df['updated_at'].max())
+    if not completed_df.empty:
+        state['completed_updated_at'] = float(completed_df['updated_at'].max())
+
+    status = state['status']
+    # Прогресс удаляется при завершении или сбросе темы: убираем такие строки
+    if not status.empty:
+        active = pd.read_sql(
+            "SELECT p.user_id, t.name AS theme FROM progress p JOIN themes t ON t.id = p.theme_id", conn
         )
+        active_keys = pd.MultiIndex.from_frame(active)
+        in_progress = status['status'] == 'in progress'
+        stale = in_progress & ~pd.MultiIndex.from_frame(status[STATUS_KEY]).isin(active_keys)
+        status = status[~stale]
 
-        # Лист 3: Лучшие видео
-        best_df = pd.read_sql("SELECT * FROM best_videos", conn)
-        best_df['video_name'] = best_df['video_id'].apply(get_human_name)
-        best_df = best_df.drop('video_id', axis=1)
+    # Завершённые идут последними, чтобы перекрыть прогресс той же темы.
+    # Пустые выборки в concat не передаются: pandas предупреждает о них при каждом запуске
+    frames = [df for df in (progress_df, completed_df) if not df.empty]
+    status_df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    if not status_df.empty:
+        current = catalog.current()
+        theme_sizes = status_df['theme'].map({t: len(v) for t, v in current.themes.items()}).fillna(0)
+        in_progress = status_df['status'] == 'in progress'
+        status_df['progress'] = 'Завершено'
+        status_df.loc[in_progress, 'progress'] = (
+            "Видео " + status_df['current_video'].astype('Int64').astype(str)
+            + "/" + theme_sizes.astype(int).astype(str)
+            + ", критерий " + status_df['current_criterion'].astype('Int64').astype(str)
+            + f"/{len(current.criteria)}"
+        )[in_progress]
+        status_df = status_df[STATUS_KEY + ['status', 'progress']]
+    state['status'] = upsert(status, status_df, STATUS_KEY)
 
-        # Экспорт в Excel
-        with pd.ExcelWriter(EXCEL_PATH, engine='openpyxl') as writer:
-            ratings_pivot.to_excel(writer, sheet_name='Ratings', index=False)
-            status_df[['user_id', 'theme', 'status', 'progress']].to_excel(
-                writer, sheet_name='Theme Status', index=False
-            )
-            best_df.to_excel(writer, sheet_name='Best Videos', index=False)
 
-        print(f"Данные успешно экспортированы в {EXCEL_PATH}")
+def update_best(conn, state: dict):
+    """Лист 3: лучшие видео (изменённые строки, водяной знак нестрогий, как в update_status)"""
+    best_df = pd.read_sql(
+        "SELECT user_id, theme, video_id, reason, updated_at FROM best_videos WHERE updated_at >= ?",
+        conn, params=(state['best_updated_at'],)
+    )
+    if best_df.empty:
+        return
+    state['best_updated_at'] = float(best_df['updated_at'].max())
+    state['best'] = upsert(state['best'], best_df.drop('updated_at', axis=1), BEST_KEY)
+
+
+def analysis_sheet(data: analysis.RatingArray) -> pd.DataFrame:
+    """Лист 4: согласованность оценщиков и сравнение вариантов (см. analysis.py)"""
+    return analysis.cached_analysis(data, ANALYSIS_CACHE_PATH, resamples=BOOTSTRAP_RESAMPLES)
+
 
+def write_excel(state: dict, analysis_table: pd.DataFrame):
+    ratings = state['ratings'].copy()
+    ratings['video_name'] = video_names(ratings['video_id'])
+    ratings = ratings.drop('video_id', axis=1)
+
+    best = state['best'].copy()
+    best['video_name'] = video_names(best['video_id'])
+    best = best.drop('video_id', axis=1)
+
+    tmp_path = temp_path(EXCEL_PATH)
+    with pd.ExcelWriter(tmp_path, engine='openpyxl') as writer:
+        ratings.to_excel(writer, sheet_name='Ratings', index=False)
+        state['status'].to_excel(writer, sheet_name='Theme Status', index=False)
+        best.to_excel(writer, sheet_name='Best Videos', index=False)
+        analysis_table.to_excel(writer, sheet_name='Analysis', index=False)
+    os.replace(tmp_path, EXCEL_PATH)
+
+
+def fetch_batches(conn, query: str, params=()):
+    """Отдаёт результат запроса порциями (списками строк) по CHUNK_SIZE"""
+    cursor = conn.execute(query, params)
+    try:
+        while True:
+            rows = cursor.fetchmany(CHUNK_SIZE)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cursor.close()
+
+
+def fetch_chunks(conn, query: str, params=()):
+    """Построчно отдаёт результат запроса, читая его порциями по CHUNK_SIZE"""
+    for rows in fetch_batches(conn, query, params):
+        yield from rows
+
+
+def stream_ratings(conn, criteria: list):
+    """Строки листа Ratings без pivot_table в памяти.
+
+    Оценки читаются в порядке уникального индекса (user_id, theme, video_id,
+    criterion), поэтому строка сводной таблицы собирается из соседних записей.
+    """
+    rows = fetch_chunks(
+        conn,
+        "SELECT user_id, theme, video_id, criterion, score FROM ratings "
+        "ORDER BY user_id, theme, video_id, criterion"
+    )
+    names = catalog.current().video_names
+    key, scores = None, {}
+    for user_id, theme, video_id, criterion, score in rows:
+        if (user_id, theme, video_id) != key:
+            if key is not None:
+                yield [key[0], key[1], *(scores.get(c) for c in criteria), names.get(key[2], key[2])]
+            key, scores = (user_id, theme, video_id), {}
+        # Как aggfunc='first': первая оценка критерия побеждает
+        scores.setdefault(criterion, score)
+    if key is not None:
+        yield [key[0], key[1], *(scores.get(c) for c in criteria), names.get(key[2], key[2])]
+
+
+def stream_status(conn):
+    rows = fetch_chunks(
+        conn,
+        """
+        SELECT p.user_id, t.name, 'in progress', p.video_index + 1, p.current_criterion + 1
+        FROM progress p JOIN themes t ON t.id = p.theme_id
+        UNION ALL
+        SELECT user_id, theme, 'completed', NULL, NULL
+        FROM completed_themes
+        """
+    )
+    for user_id, theme, status, current_video, current_criterion in rows:
+        yield [user_id, theme, status, progress_text(status, theme, current_video, current_criterion)]
+
+
+def stream_best(conn):
+    names = catalog.current().video_names
+    rows = fetch_chunks(conn, "SELECT user_id, theme, reason, video_id FROM best_videos")
+    for user_id, theme, reason, video_id in rows:
+        yield [user_id, theme, reason, names.get(video_id, video_id)]
+
+
+def stream_analysis(conn):
+    """Лист Analysis: статистика считается по массиву всех оценок, но сам массив
+    заполняется порциями - строки БД целиком в память не читаются"""
+    raters = conn.execute("SELECT COUNT(DISTINCT user_id) FROM ratings").fetchone()[0]
+    # Порядок уникального индекса: оценщики нумеруются так же, как в полном экспорте
+    batches = fetch_batches(
+        conn,
+        "SELECT user_id, video_id, criterion, score FROM ratings "
+        "ORDER BY user_id, theme, video_id, criterion"
+    )
+    data = analysis.build_array_chunks(batches, catalog.current(), raters)
+    yield from analysis_sheet(data).itertuples(index=False, name=None)
+
+
+def stream_sheets(conn):
+    """Листы экспорта: (имя, заголовок, генератор строк)"""
+    criteria = [row[0] for row in conn.execute(
+        "SELECT DISTINCT criterion FROM ratings ORDER BY criterion"
+    )]
+    return [
+        ('Ratings', ['user_id', 'theme', *criteria, 'video_name'], stream_ratings(conn, criteria)),
+        ('Theme Status', ['user_id', 'theme', 'status', 'progress'], stream_status(conn)),
+        ('Best Videos', ['user_id', 'theme', 'reason', 'video_name'], stream_best(conn)),
+        ('Analysis', analysis.COLUMNS, stream_analysis(conn))
+    ]
+
+
+def write_xlsx_stream(sheets):
+    """Пишет листы через write_only-книгу openpyxl, не строя DOM в памяти"""
+    wb = Workbook(write_only=True)
+    for name, header, rows in sheets:
+        ws = wb.create_sheet(name)
+        ws.append(header)
+        for row in rows:
+            ws.append(row)
+    tmp_path = temp_path(EXCEL_PATH)
+    wb.save(tmp_path)
+    os.replace(tmp_path, EXCEL_PATH)
+    return [EXCEL_PATH]
+
+
+def write_csv_stream(sheets):
+    """Пишет каждый лист в отдельный results_<лист>.csv.gz"""
+    paths = []
+    for name, header, rows in sheets:
+        path = CSV_DIR / f"results_{name.lower().replace(' ', '_')}.csv.gz"
+        tmp_path = temp_path(path)
+        with gzip.open(tmp_path, "wt", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+        os.replace(tmp_path, path)
+        paths.append(path)
+    return paths
+
+
+def stream_export(fmt: str = "xlsx") -> list:
+    """Полный потоковый экспорт: память не зависит от размера БД. Возвращает пути файлов"""
+    EXCEL_PATH.parent.mkdir(parents=True, exist_ok=True)
+    # Снимок во временном файле рядом с результатами: данные не держатся в памяти,
+    # а рабочая БД не удерживается в транзакции на всё время записи файлов
+    with tempfile.TemporaryDirectory(dir=EXCEL_PATH.parent) as tmp_dir:
+        conn, _ = snapshot(Path(tmp_dir) / "snapshot.db")
+        try:
+            sheets = stream_sheets(conn)
+            if fmt == "csv":
+                return write_csv_stream(sheets)
+            return write_xlsx_stream(sheets)
+        finally:
+            conn.close()
+
+
+def export_stream(fmt: str = "xlsx"):
+    """Потоковый экспорт из командной строки (см. stream_export)"""
+    try:
+        paths = stream_export(fmt)
+        print("Данные успешно экспортированы в " + ", ".join(str(p) for p in paths))
     except Exception as e:
         print(f"Ошибка: {str(e)}")
+
+
+def export(full: bool = False) -> str:
+    """Экспорт в Excel; возвращает режим ("полный" или "инкрементальный").
+
+    По умолчанию инкрементальный: из БД читаются только строки, добавленные
+    или изменённые после прошлого экспорта, и объединяются с его таблицами.
+    full=True пересобирает файл с нуля. Шарды всегда выгружаются полностью:
+    водяные знаки (id, updated_at) у каждого шарда свои.
+    """
+    conn, sharded = snapshot()
+    try:
+        if sharded:
+            full = True
+
+        state = None if full else load_state()
+        mode = "инкрементальный" if state else "полный"
+        if state is None:
+            state = empty_state()
+
+        # Листы читаются из снимка, поэтому согласованы между собой
+        update_ratings(conn, state)
+        update_status(conn, state)
+        update_best(conn, state)
     finally:
-        if conn:
+        conn.close()
+
+    # Все оценки уже есть в листе Ratings: разворачиваем его обратно в строки
+    ratings = state['ratings'].melt(id_vars=RATINGS_KEY, var_name='criterion', value_name='score')
+    write_excel(state, analysis_sheet(analysis.build_array(ratings.dropna(subset=['score']), catalog.current())))
+    if sharded:
+        # Состояние не соответствует ни одной из БД - не сохраняем и не оставляем старое
+        STATE_PATH.unlink(missing_ok=True)
+    else:
+        save_state(state)
+    return mode
+
+
+def export_to_excel(full: bool = False):
+    """Экспорт в Excel из командной строки (см. export)"""
+    try:
+        mode = export(full)
+        print(f"Данные успешно экспортированы в {EXCEL_PATH} ({mode} экспорт)")
+    except Exception as e:
+        print(f"Ошибка: {str(e)}")
+
+
+def db_fingerprint() -> tuple:
+    """Дешёвый отпечаток содержимого БД (и шардов): меняется при любой записи бота.
+
+    Оценки только добавляются, остальные таблицы обновляют updated_at, а
+    строки прогресса ещё и удаляются - поэтому берутся максимумы и числа строк.
+    """
+    shards = find_shards(DB_PATH)
+    sources = ([DB_PATH] if not shards or DB_PATH.exists() else []) + shards
+    fingerprint = []
+    for path in sources:
+        conn = sqlite3.connect(path)
+        try:
+            check_version(conn)
+            fingerprint.append(conn.execute(
+                """
+                SELECT
+                    (SELECT max(id) FROM ratings),
+                    (SELECT count(*) FROM progress),
+                    (SELECT max(updated_at) FROM progress),
+                    (SELECT count(*) FROM completed_themes),
+                    (SELECT max(updated_at) FROM completed_themes),
+                    (SELECT count(*) FROM best_videos),
+                    (SELECT max(updated_at) FROM best_videos)
+                """
+            ).fetchone())
+        finally:
             conn.close()
+    return tuple(fingerprint)
 
 if __name__ == "__main__":
-    export_to_excel()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Экспорт оценок в Excel")
+    parser.add_argument(
+        "--full", action="store_true",
+        help="пересобрать файл с нуля вместо инкрементального обновления"
+    )
+    parser.add_argument(
+        "--stream", action="store_true",
+        help="потоковый полный экспорт порциями с постоянным расходом памяти"
+    )
+    parser.add_argument(
+        "--format", choices=["xlsx", "csv"], default="xlsx",
+        help="формат потокового экспорта: xlsx или сжатые csv.gz (подразумевает --stream)"
+    )
+    args = parser.parse_args()
+    if args.stream or args.format == "csv":
+        export_stream(args.format)
+    else:
+        export_to_excel(full=args.full)
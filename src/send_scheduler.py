@@ -0,0 +1,188 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+from telegram.error import BadRequest, RetryAfter, TimedOut, NetworkError
+from telegram.ext import BaseRateLimiter
+from metrics import registry
+from ordering import released_slot
+
+logger = logging.getLogger(__name__)
+
+# Правки сообщений (ответ на нажатие оценки) важнее информационных сообщений
+HIGH_PRIORITY_METHODS = {
+    "editMessageText",
+    "editMessageCaption",
+    "editMessageReplyMarkup",
+}
+HIGH, NORMAL = 0, 1
+# Лимиты Telegram (30 сообщений в секунду, около 1 в секунду на чат) считают
+# только сообщения: отправку и правку. Остальные вызовы (answerCallbackQuery,
+# getMe, getUpdates, setWebhook...) идут без вёдер, иначе ответы на нажатия
+# отнимали бы бюджет у сообщений.
+METERED_PREFIXES = ("send", "edit", "forward", "copy")
+# Правка уже отправленного сообщения не добавляет сообщений в чат: на каждое
+# нажатие оценки приходится правка подписи, и лимит чата (1 в секунду после
+# всплеска) тормозил бы каждое нажатие. Правки учитываются только в общем лимите.
+CHAT_EXEMPT_PREFIXES = ("editMessage",)
+
+
+def is_metered(endpoint: str) -> bool:
+    return endpoint.startswith(METERED_PREFIXES)
+
+
+SEND_WAIT = registry.histogram(
+    "bot_send_wait_seconds", "Ожидание отправки в планировщике Bot API", ("priority",))
+SEND_RETRIES = registry.counter(
+    "bot_send_retries_total", "Повторы вызовов Bot API", ("method", "reason"))
+
+
+class TokenBucket:
+    """Ведро токенов с приоритетной очередью ожидающих.
+
+    Пока токенов хватает, запрос проходит сразу; иначе ждёт в куче
+    (приоритет, порядок поступления), и токены раздаются сначала
+    запросам с меньшим значением приоритета.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._waiters = []
+        self._order = itertools.count()
+        self._drainer = None
+
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def is_ready(self) -> bool:
+        """Запрос пройдёт сразу, без ожидания"""
+        self._refill()
+        return not self._waiters and self.tokens >= 1
+
+    def is_idle(self) -> bool:
+        self._refill()
+        return not self._waiters and self.tokens >= self.capacity
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, priority: int = NORMAL):
+        self._refill()
+        if not self._waiters and self.tokens >= 1:
+            self.tokens -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), future))
+        if self._drainer is None or self._drainer.done():
+            self._drainer = asyncio.create_task(self._drain())
+        await future
+
+    async def _drain(self):
+        while self._waiters:
+            self._refill()
+            while self._waiters and self.tokens >= 1:
+                _, _, future = heapq.heappop(self._waiters)
+                if future.done():
+                    # Ожидающий был отменён
+                    continue
+                self.tokens -= 1
+                future.set_result(None)
+            if self._waiters:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class SendScheduler(BaseRateLimiter):
+    """Планировщик исходящих вызовов Bot API.
+
+    Общий лимит и лимит на чат - вёдра токенов, в них учитываются только
+    сообщения (is_metered). Правки сообщений проходят только общий лимит и
+    вне очереди, остальные вызовы (в том числе ответы на нажатия) - сразу. RetryAfter и сетевые тайм-ауты
+    повторяются с задержкой и случайным разбросом.
+    """
+
+    def __init__(self, global_rate: float = 30.0, chat_rate: float = 1.0, chat_burst: float = 3.0,
+                 max_retries: int = 3, backoff: float = 0.5, max_chat_buckets: int = 10000):
+        # rate <= 0 отключает соответствующий лимит
+        self.global_bucket = TokenBucket(global_rate, global_rate) if global_rate > 0 else None
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_chat_buckets = max_chat_buckets
+        self._chat_buckets = {}
+
+    def queue_depth(self) -> int:
+        depth = sum(b.waiting() for b in self._chat_buckets.values())
+        if self.global_bucket is not None:
+            depth += self.global_bucket.waiting()
+        return depth
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.max_chat_buckets:
+                # Полные вёдра без ожидающих ничем не отличаются от новых
+                for key in [k for k, b in self._chat_buckets.items() if b.is_idle()]:
+                    del self._chat_buckets[key]
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _wait_turn(self, endpoint: str, data: dict):
+        if not is_metered(endpoint):
+            return
+        priority = HIGH if endpoint in HIGH_PRIORITY_METHODS else NORMAL
+        started = time.perf_counter()
+        chat_id = data.get("chat_id") if data else None
+        buckets = []
+        if chat_id is not None and self.chat_rate > 0 and not endpoint.startswith(CHAT_EXEMPT_PREFIXES):
+            buckets.append(self._chat_bucket(chat_id))
+        if self.global_bucket is not None:
+            buckets.append(self.global_bucket)
+        if all(bucket.is_ready() for bucket in buckets):
+            for bucket in buckets:
+                await bucket.acquire(priority)
+        else:
+            # Ждать лимита будем долго: слот обработки обновлений пока нужен другим
+            async with released_slot():
+                for bucket in buckets:
+                    await bucket.acquire(priority)
+        SEND_WAIT.observe(time.perf_counter() - started, "high" if priority == HIGH else "normal")
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        max_retries = (rate_limit_args or {}).get("max_retries", self.max_retries)
+        attempt = 0
+        while True:
+            await self._wait_turn(endpoint, data)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= max_retries:
+                    raise
+                delay = float(e.retry_after) * (1 + random.uniform(0, 0.1))
+                SEND_RETRIES.inc(endpoint, "retry_after")
+                logger.warning(f"{endpoint}: RetryAfter {e.retry_after} с, повтор через {delay:.1f} с")
+            except BadRequest:
+                # BadRequest - наследник NetworkError, но повтор его не исправит
+                raise
+            except (TimedOut, NetworkError) as e:
+                if attempt >= max_retries:
+                    raise
+                delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+                SEND_RETRIES.inc(endpoint, type(e).__name__)
+                logger.warning(f"{endpoint}: {e}, повтор через {delay:.1f} с")
+            attempt += 1
+            async with released_slot():
+                await asyncio.sleep(delay)
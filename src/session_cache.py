@@ -0,0 +1,67 @@
+import copy
+import time
+from collections import OrderedDict
+
+# Признак отсутствия значения в кэше (None - допустимое значение: "прогресса нет")
+MISSING = object()
+
+
+class SessionCache:
+    """LRU-кэш с TTL для состояния пользователей.
+
+    Ключ - user_id, внутри хранятся отдельные поля (прогресс, множество
+    пройденных тем). Кэш сквозной: функции записи в БД сразу обновляют
+    или сбрасывают соответствующее поле.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, user_id: int, field: str):
+        """Возвращает копию значения поля или MISSING"""
+        entry = self._entries.get(user_id)
+        if entry is not None and field in entry:
+            value, expires_at = entry[field]
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return copy.deepcopy(value)
+            del entry[field]
+        self.misses += 1
+        return MISSING
+
+    def set(self, user_id: int, field: str, value):
+        """Сохраняет копию значения поля"""
+        entry = self._entries.setdefault(user_id, {})
+        entry[field] = (copy.deepcopy(value), time.monotonic() + self.ttl)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int, field: str = None):
+        """Сбрасывает одно поле или всю запись пользователя"""
+        if field is None:
+            self._entries.pop(user_id, None)
+            return
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            entry.pop(field, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
@@ -0,0 +1,165 @@
+"""Шардирование по user_id: номер шарда для обновления и файлы БД шардов.
+
+Модуль без зависимостей от telegram, им пользуются и диспетчер, и read_db.py.
+"""
+import logging
+import os
+import re
+import sqlite3
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Таблицы с данными пользователей (делятся между шардами по user_id)
+USER_TABLES = ("ratings", "progress", "completed_themes", "best_videos")
+
+
+class ShardLayoutError(Exception):
+    """Файлы БД не соответствуют числу шардов - нужен ручной перенос"""
+
+
+def update_user_id(update: dict):
+    """user_id отправителя из JSON обновления (как UserOrderedApplication.ordering_key:
+    сначала пользователь, затем чат); None, если его нет"""
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        for field in ("from", "user"):
+            if isinstance(value.get(field), dict) and "id" in value[field]:
+                return value[field]["id"]
+        # callback_query без from не бывает, но у сообщения внутри есть чат
+        message = value.get("message") if isinstance(value.get("message"), dict) else value
+        if isinstance(message.get("chat"), dict) and "id" in message["chat"]:
+            return message["chat"]["id"]
+    return None
+
+
+def shard_of(update: dict, shards: int) -> int:
+    """Номер шарда: все обновления одного пользователя попадают в один шард"""
+    user_id = update_user_id(update)
+    if user_id is None:
+        return 0
+    return user_id % shards
+
+
+def shard_db_path(db_path, index: int) -> Path:
+    """data/ratings.db -> data/ratings.shard<index>.db"""
+    db_path = Path(db_path)
+    return db_path.with_name(f"{db_path.stem}.shard{index}{db_path.suffix}")
+
+
+def find_shards(db_path) -> list:
+    """Файлы шардов рядом с db_path в порядке номеров"""
+    db_path = Path(db_path)
+    pattern = re.compile(rf"^{re.escape(db_path.stem)}\.shard(\d+){re.escape(db_path.suffix)}$")
+    found = []
+    if db_path.parent.is_dir():
+        for path in db_path.parent.iterdir():
+            match = pattern.match(path.name)
+            if match:
+                found.append((int(match.group(1)), path))
+    return [path for _, path in sorted(found)]
+
+
+def presharded_path(db_path) -> Path:
+    """data/ratings.db -> data/ratings.presharded.db (исходная БД после разделения)"""
+    db_path = Path(db_path)
+    return db_path.with_name(f"{db_path.stem}.presharded{db_path.suffix}")
+
+
+def count_users(path) -> int:
+    """Число пользователей с данными в БД (0, если файла или таблиц нет)"""
+    if not Path(path).exists():
+        return 0
+    conn = sqlite3.connect(path)
+    try:
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        parts = [f"SELECT user_id FROM {table}" for table in USER_TABLES if table in tables]
+        if not parts:
+            return 0
+        return conn.execute(f"SELECT COUNT(*) FROM ({' UNION '.join(parts)})").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def split_db(db_path, shards: int) -> list:
+    """Делит БД на файлы шардов: в шард i попадают пользователи с user_id % shards == i.
+
+    Каждый шард - копия БД (backup API), из которой удалены чужие
+    пользователи; темы и агрегаты rating_stats (через триггер удаления)
+    остаются согласованными. Файл шарда появляется под своим именем только
+    целиком (запись во временный файл и переименование).
+    """
+    paths = []
+    for index in range(shards):
+        path = shard_db_path(db_path, index)
+        tmp_path = path.with_name(path.name + ".split")
+        tmp_path.unlink(missing_ok=True)
+        source = sqlite3.connect(db_path)
+        target = sqlite3.connect(tmp_path)
+        try:
+            source.backup(target)
+            target.create_function("shard_of_user", 1, lambda user_id: user_id % shards, deterministic=True)
+            with target:
+                for table in USER_TABLES:
+                    target.execute(f"DELETE FROM {table} WHERE shard_of_user(user_id) != ?", (index,))
+            target.execute("VACUUM")
+        finally:
+            target.close()
+            source.close()
+        os.replace(tmp_path, path)
+        paths.append(path)
+    return paths
+
+
+def prepare_shards(db_path, shards: int) -> list:
+    """Проверяет файлы БД перед запуском шардированного режима.
+
+    Если шардов ещё нет, а в db_path есть пользователи (переход с обычного
+    режима), БД делится на шарды и переименовывается в ratings.presharded.db.
+    Если шарды уже есть, запуск запрещается, когда в db_path снова появились
+    пользователи или число файлов шардов не совпадает с shards (пользователи
+    попали бы не в свой шард). Возвращает пути файлов шардов.
+    """
+    db_path = Path(db_path)
+    existing = find_shards(db_path)
+    users = count_users(db_path)
+    if existing:
+        expected = [shard_db_path(db_path, i) for i in range(shards)]
+        if existing != expected and any(count_users(path) for path in existing):
+            raise ShardLayoutError(
+                f"Найдено шардов: {len(existing)}, а SHARDS={shards}. Смена числа шардов "
+                "не поддерживается: верните прежнее SHARDS или перенесите данные вручную"
+            )
+        if users:
+            raise ShardLayoutError(
+                f"В {db_path.name} есть пользователи ({users}), а рядом уже есть шарды. "
+                f"Перенесите данные вручную или уберите {db_path.name}"
+            )
+        return expected
+    if not users:
+        return [shard_db_path(db_path, i) for i in range(shards)]
+
+    # Весь WAL должен попасть в файл БД: если это не удаётся, БД ещё открыта
+    # другим процессом (например, ботом в обычном режиме)
+    conn = sqlite3.connect(db_path)
+    try:
+        busy = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()[0]
+    finally:
+        conn.close()
+    if busy:
+        raise ShardLayoutError(f"{db_path.name} открыта другим процессом - остановите бота в обычном режиме")
+
+    started = time.perf_counter()
+    logger.info(f"Переход на шарды: {db_path.name} ({users} пользователей) делится на {shards}")
+    paths = split_db(db_path, shards)
+    # Исходная БД больше не рабочая: переименовываем, чтобы ни бот, ни экспорт
+    # не учитывали её вместе с шардами
+    os.replace(db_path, presharded_path(db_path))
+    logger.info(
+        f"Шарды созданы за {time.perf_counter() - started:.1f} с: "
+        + ", ".join(f"{p.name} ({count_users(p)})" for p in paths)
+        + f"; исходная БД сохранена как {presharded_path(db_path).name}"
+    )
+    return paths
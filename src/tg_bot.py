@@ -2,14 +2,17 @@
 import nest_asyncio
 import asyncio
 import logging
-import random
+import math
 import os
+import re
+import secrets
+import signal
+import sys
 from pathlib import Path
-from functools import partial
-import json
-import aiosqlite # type: ignore
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from functools import lru_cache, partial
+from telegram import Bot, Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.error import BadRequest 
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -18,12 +21,28 @@ from telegram.ext import (
     filters,
     CallbackContext
 )
+import migrations
+from db_pool import ConnectionPool
+from write_behind import WriteBehindQueue
+from maintenance import StorageMaintenance, ensure_auto_vacuum, tuning_pragmas
+from session_cache import SessionCache, MISSING
+from idempotency import RecentKeys
+from metrics import registry, instrument_handler, instrument_db, InstrumentedRequest, MetricsServer
+from webhook import run_webhook
+from dispatcher import run_dispatcher
+from shards import ShardLayoutError, prepare_shards, shard_db_path
+from export_job import ExportRunner
+from ordering import UserOrderedApplication
+from persistence import SessionPersistence, reset_session
+from send_scheduler import SendScheduler
+import catalog
+from assignment import AssignmentScheduler
 # тестировочный тег видео: BAACAgIAAxkBAAMDZ9wPRzeP1WZuKtSvvUWdHajDfKgAAgpnAALm0-hKoF7kuBm7AAH4NgQ
 nest_asyncio.apply()
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 TOKEN_PATH = BASE_DIR / "token" / "config.txt"
-DB_PATH = BASE_DIR / "data" / "ratings.db"
+DB_PATH = Path(os.environ.get("BOT_DB_PATH", BASE_DIR / "data" / "ratings.db"))
 LOG_DIR = BASE_DIR / "logs"
 
 # Автоматическое создание директорий
@@ -42,110 +61,187 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
-# Чтение токена с обработкой ошибок
-try:
-    with open(TOKEN_PATH, "r") as f:
-        BOT_TOKEN = f.read().strip()
-except FileNotFoundError:
-    logging.critical(f"❌ Файл с токеном не найден: {TOKEN_PATH}")
-    exit(1)
-except Exception as e:
-    logging.critical(f"❌ Ошибка чтения токена: {str(e)}")
-    exit(1)
+
+def read_token() -> str:
+    """Чтение токена с обработкой ошибок"""
+    try:
+        with open(TOKEN_PATH, "r") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        logging.critical(f"❌ Файл с токеном не найден: {TOKEN_PATH}")
+        exit(1)
+    except Exception as e:
+        logging.critical(f"❌ Ошибка чтения токена: {str(e)}")
+        exit(1)
 
 DB_NAME = str(DB_PATH)  # Для совместимости с aiosqlite
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 4))
+RATING_BATCH_SIZE = int(os.environ.get("RATING_BATCH_SIZE", 200))
+# Обработчик нажатия ждёт коммита своей оценки, поэтому задержка небольшая:
+# пачка и так набирается, пока пишется предыдущая
+RATING_FLUSH_INTERVAL = float(os.environ.get("RATING_FLUSH_INTERVAL", 0.005))
+# Кэш страниц и отображение файла в память на каждое соединение пула, МБ
+DB_CACHE_SIZE_MB = int(os.environ.get("DB_CACHE_SIZE_MB", 16))
+DB_MMAP_SIZE_MB = int(os.environ.get("DB_MMAP_SIZE_MB", 256))
+# auto_vacuum: incremental (у новой БД), convert (перевести существующую БД, один VACUUM при запуске), none
+DB_AUTO_VACUUM = os.environ.get("DB_AUTO_VACUUM", "incremental")
+# Обслуживание БД: период проверки, с (0 - выключено), пороги размера WAL для
+# checkpoint PASSIVE и TRUNCATE, МБ, период обновления статистики (ANALYZE), с
+DB_MAINTENANCE_INTERVAL = float(os.environ.get("DB_MAINTENANCE_INTERVAL", 60))
+WAL_CHECKPOINT_MB = int(os.environ.get("WAL_CHECKPOINT_MB", 16))
+WAL_TRUNCATE_MB = int(os.environ.get("WAL_TRUNCATE_MB", 64))
+DB_ANALYZE_INTERVAL = float(os.environ.get("DB_ANALYZE_INTERVAL", 3600))
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", 10000))
+SESSION_CACHE_TTL = float(os.environ.get("SESSION_CACHE_TTL", 600))
+# Сколько последних id нажатий и оценок (пользователь, видео, критерий) помнить
+# для отсечения повторов
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", 50000))
+# Telegram id администраторов через запятую (доступ к /stats)
+ADMIN_IDS = [int(x) for x in os.environ.get("ADMIN_IDS", "").split(",") if x.strip()]
+# Порт HTTP-сервера метрик Prometheus (0 - выключен)
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+# Сколько обновлений разных пользователей обрабатывается одновременно
+# (обновления одного пользователя всегда идут по очереди)
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", 32))
+# Сколько принятых обновлений может ждать обработки
+PENDING_UPDATES_LIMIT = 1024
+# Как часто изменённые сессии (user_data) пачкой записываются в БД, с
+PERSISTENCE_INTERVAL = float(os.environ.get("PERSISTENCE_INTERVAL", 10))
+# Лимиты исходящих вызовов Bot API (вызовов в секунду; 0 - без лимита)
+SEND_GLOBAL_RATE = float(os.environ.get("SEND_GLOBAL_RATE", 30))
+SEND_CHAT_RATE = float(os.environ.get("SEND_CHAT_RATE", 1))
+SEND_CHAT_BURST = float(os.environ.get("SEND_CHAT_BURST", 3))
+SEND_MAX_RETRIES = int(os.environ.get("SEND_MAX_RETRIES", 3))
+# Периодический экспорт результатов в Excel (JobQueue), с; 0 - выключен.
+# Ручной экспорт - команда /export для администраторов
+EXPORT_INTERVAL = float(os.environ.get("EXPORT_INTERVAL", 3600))
+EXPORT_PATH = Path(os.environ.get("EXPORT_PATH", BASE_DIR / "data" / "results.xlsx"))
+# БД для экспорта; у воркеров шардированного режима - общий путь, по которому находятся все шарды
+EXPORT_DB_PATH = Path(os.environ.get("EXPORT_DB_PATH", DB_PATH))
+# Режим получения обновлений: polling (по умолчанию), webhook или sharded;
+# worker - процесс-воркер шардированного режима (запускается диспетчером)
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+# Публичный адрес для setWebhook; пустой - адрес не регистрируется
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+# Шардированный режим: число процессов-воркеров и порт первого из них
+# (воркеры слушают 127.0.0.1:SHARD_BASE_PORT+i, у каждого своя БД ratings.shard<i>.db)
+SHARDS = int(os.environ.get("SHARDS", 2))
+SHARD_BASE_PORT = int(os.environ.get("SHARD_BASE_PORT", 8600))
+# Сколько обновлений может ждать передачи одному воркеру (пока он перезапускается или не успевает)
+SHARD_QUEUE_LIMIT = int(os.environ.get("SHARD_QUEUE_LIMIT", 10000))
+# Задаются диспетчером для воркеров
+WORKER_PORT = int(os.environ.get("WORKER_PORT", 0))
+WORKER_SECRET = os.environ.get("WORKER_SECRET", "")
+WORKER_PATH = "/update"
+
+# Общий пул соединений: открывается в init_db, закрывается в close_db
+db_pool = ConnectionPool(
+    DB_NAME, size=DB_POOL_SIZE,
+    pragmas=tuning_pragmas(DB_CACHE_SIZE_MB, DB_MMAP_SIZE_MB, WAL_TRUNCATE_MB * 1024 * 1024)
+)
+# Checkpoint WAL, ANALYZE и incremental_vacuum в фоне; запускается в init_db
+storage_maintenance = StorageMaintenance(
+    DB_NAME,
+    interval=DB_MAINTENANCE_INTERVAL,
+    checkpoint_bytes=WAL_CHECKPOINT_MB * 1024 * 1024,
+    truncate_bytes=WAL_TRUNCATE_MB * 1024 * 1024,
+    analyze_interval=DB_ANALYZE_INTERVAL
+)
+# Оценки и все записи прогресса идут пачками через одну очередь групповой записи:
+# она пишет строго по порядку постановки
+rating_queue = WriteBehindQueue(db_pool, max_batch=RATING_BATCH_SIZE, max_delay=RATING_FLUSH_INTERVAL)
+# Название темы -> id в таблице themes (id не меняются, кэш не сбрасывается)
+theme_ids = {}
+# Сессии (user_data) загружаются при запуске Application и записываются пачками
+# (load_sessions и save_sessions объявлены ниже)
+persistence = SessionPersistence(
+    load=lambda: load_sessions(),
+    save=lambda batch, is_fresh: save_sessions(batch, is_fresh),
+    update_interval=PERSISTENCE_INTERVAL
+)
+# Счётчики показов тем и порядков видео; восстанавливаются из БД в init_db
+assignments = AssignmentScheduler()
+# Кэш прогресса и пройденных тем перед get_progress / get_completed_themes
+session_cache = SessionCache(max_size=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL)
+# Повторы нажатий: id уже обработанных callback_query и уже принятые оценки
+# (пользователь, тема, видео, критерий). Последний рубеж - UNIQUE(user_id, theme, video_id, criterion) в таблице ratings
+processed_callbacks = RecentKeys(IDEMPOTENCY_CACHE_SIZE)
+rated_keys = RecentKeys(IDEMPOTENCY_CACHE_SIZE)
+metrics_server = MetricsServer(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+# Экспорт выполняется в отдельном процессе по снимку БД; состояние инкрементального
+# экспорта общее с read_db.py (results.state.pkl рядом с файлом)
+export_runner = ExportRunner(EXPORT_DB_PATH, EXPORT_PATH, EXPORT_PATH.with_suffix(".state.pkl"))
+# Все вызовы Bot API проходят через лимиты Telegram; ответы на нажатия - вне очереди
+send_scheduler = SendScheduler(
+    global_rate=SEND_GLOBAL_RATE,
+    chat_rate=SEND_CHAT_RATE,
+    chat_burst=SEND_CHAT_BURST,
+    max_retries=SEND_MAX_RETRIES
+)
 
-# Человеко-читаемые названия
-VIDEO_NAMES = {
-    "BAACAgIAAxkBAAIJhGf6hWz6Tf4UzrfUzQzVmA4uQEaBAAK9bwACrIbQS4ODBoPbU0kWNgQ": "Робототехника - Человеческий",
-    "BAACAgIAAxkBAAIJhmf6hYP7qB-f2nuwvg9FDaGofHMzAAK-bwACrIbQS7U72c2RicaGNgQ": "Робототехника - Сгенерированный",
-    "BAACAgIAAxkBAAIJiGf6hY39rfGimXYyxRrFFI7-YJTaAAK_bwACrIbQS7UX2rFb1Sp3NgQ": "Робототехника - Сгенерированный+",
-    "BAACAgIAAxkBAAIJimf6hagbHeQgOb_EEZYz00u72p4pAALBbwACrIbQSzP-35GDsrVfNgQ": "Кто живет в Антарктиде? - Человеческий",
-    "BAACAgIAAxkBAAIJjGf6hbx_L4QTiT1LIl5gL62GyhS0AALEbwACrIbQS7OJU7yemkUJNgQ": "Кто живет в Антарктиде? - Сгенерированный",
-    "BAACAgIAAxkBAAIJlmf6h_aTQQ7T2CUF99_Yl0nW1wmgAAL3bwACrIbQS6IJn7l8ajYgNgQ": "Кто живет в Антарктиде? - Сгенерированный+",
-    "BAACAgIAAxkBAAIJkGf6hd4QqdiDb9CzNVCWT7iGtQ9jAALIbwACrIbQS7_QaCaZeO7PNgQ": "Кто побывал в космосе? - Человеческий",
-    "BAACAgIAAxkBAAIJkmf6hfQzUpF2V5fcvG5zfv--99IOAALKbwACrIbQS50Y8yKJKRujNgQ": "Кто побывал в космосе? - Сгенерированный",
-    "BAACAgIAAxkBAAIJlGf6hgW5MCA1OC_pf7cxjCac4JRdAALLbwACrIbQS0TChyBosMQLNgQ": "Кто побывал в космосе? - Сгенерированный+"
-}
-
-THEMES = {
-    "Робототехника": [
-        "BAACAgIAAxkBAAIJhGf6hWz6Tf4UzrfUzQzVmA4uQEaBAAK9bwACrIbQS4ODBoPbU0kWNgQ",
-        "BAACAgIAAxkBAAIJhmf6hYP7qB-f2nuwvg9FDaGofHMzAAK-bwACrIbQS7U72c2RicaGNgQ",
-        "BAACAgIAAxkBAAIJiGf6hY39rfGimXYyxRrFFI7-YJTaAAK_bwACrIbQS7UX2rFb1Sp3NgQ"
-    ],
-    "Кто живет в Антарктиде?": [
-        "BAACAgIAAxkBAAIJimf6hagbHeQgOb_EEZYz00u72p4pAALBbwACrIbQSzP-35GDsrVfNgQ",
-        "BAACAgIAAxkBAAIJjGf6hbx_L4QTiT1LIl5gL62GyhS0AALEbwACrIbQS7OJU7yemkUJNgQ",
-        "BAACAgIAAxkBAAIJlmf6h_aTQQ7T2CUF99_Yl0nW1wmgAAL3bwACrIbQS6IJn7l8ajYgNgQ"
-    ],
-    "Кто побывал в космосе?": [
-        "BAACAgIAAxkBAAIJkGf6hd4QqdiDb9CzNVCWT7iGtQ9jAALIbwACrIbQS7_QaCaZeO7PNgQ",
-        "BAACAgIAAxkBAAIJkmf6hfQzUpF2V5fcvG5zfv--99IOAALKbwACrIbQS50Y8yKJKRujNgQ",
-        "BAACAgIAAxkBAAIJlGf6hgW5MCA1OC_pf7cxjCac4JRdAALLbwACrIbQS0TChyBosMQLNgQ"
-    ]
-}
-
-# 5 критериев
-CRITERIA = [
-    "Логичность",
-    "Информативность",
-    "Интересность",
-    "Естественность",
-    "Согласованность невербальных сигналов"
-]
-
-# Интерпретации шкалы для каждого критерия
-CRITERIA_HINTS = [
-    "«Текст хаотичен» → «Текст логичен».",
-    "«Текст поверхностен» → «Текст информативен».",
-    "«Текст звучит сухо» → «Текст интересный».",
-    "«Текст механический» → «Текст естественный».",
-    "«Действия в тексте случайны» → «Действия полностью дополняют контекст»."
-]
+registry.gauge("bot_session_cache_hits", "Попадания в кэш сессий", lambda: session_cache.hits)
+registry.gauge("bot_session_cache_misses", "Промахи кэша сессий", lambda: session_cache.misses)
+registry.gauge("bot_rating_queue_depth", "Оценки, ожидающие записи в БД", rating_queue.qsize)
+registry.gauge("bot_db_size_bytes", "Размер файла БД", storage_maintenance.db_size)
+registry.gauge("bot_db_wal_size_bytes", "Размер файла WAL", storage_maintenance.wal_size)
+registry.gauge("bot_send_queue_depth", "Вызовы Bot API, ожидающие отправки", send_scheduler.queue_depth)
+
+DUPLICATE_CALLBACKS = registry.counter(
+    "bot_duplicate_callbacks_total", "Отброшенные повторные нажатия кнопок по причине", ("reason",))
+
+# Кнопки оценки помечены шагом (видео, критерий): повторное нажатие на уже
+# пройденный шаг не засчитывается следующему критерию.
+# Старый формат rating-X (без шага) тоже принимается
+RATING_DATA = re.compile(r'^rating-(\d)(?::(\d+):(\d+))?$')
+
+
+@lru_cache(maxsize=1024)
+def rating_keyboard(video_index: int, criterion_index: int) -> InlineKeyboardMarkup:
+    """Клавиатура оценок для шага; собирается один раз на шаг"""
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton(f"{i}", callback_data=f"rating-{i}:{video_index}:{criterion_index}")
+        for i in range(1, 6)
+    ]])
 
 async def init_db():
     """Инициализация базы данных"""
     os.makedirs(os.path.dirname(DB_NAME), exist_ok=True)
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("PRAGMA journal_mode=WAL")
-        await db.execute('''CREATE TABLE IF NOT EXISTS progress (
-                          user_id INTEGER PRIMARY KEY,
-                          theme TEXT,
-                          videos TEXT,
-                          video_index INTEGER,
-                          current_criterion INTEGER,
-                          current_score TEXT,
-                          waiting_for_best_reason BOOLEAN)''')
-        
-        await db.execute('''CREATE TABLE IF NOT EXISTS completed_themes (
-                          user_id INTEGER,
-                          theme TEXT,
-                          PRIMARY KEY(user_id, theme))''')
-        
-        await db.execute('''CREATE TABLE IF NOT EXISTS best_videos (
-                          user_id INTEGER,
-                          theme TEXT,
-                          video_id TEXT,
-                          reason TEXT,
-                          PRIMARY KEY(user_id, theme))''')
-        
-        await db.execute('''CREATE TABLE IF NOT EXISTS ratings (
-                          user_id INTEGER,
-                          theme TEXT,
-                          video_id TEXT,
-                          criterion TEXT,
-                          score INTEGER)''')
-        await db.commit()
-
-
+    # auto_vacuum выставляется до создания таблиц
+    auto_vacuum = await asyncio.to_thread(ensure_auto_vacuum, DB_NAME, DB_AUTO_VACUUM)
+    logger.info(f"auto_vacuum: {auto_vacuum}")
+    # Создание/обновление схемы до актуальной версии
+    version = await asyncio.to_thread(migrations.migrate, DB_NAME)
+    logger.info(f"Версия схемы БД: {version}")
+    await db_pool.open()
+    await rating_queue.start()
+    await storage_maintenance.start()
+    assignments.seed(catalog.current(), await get_past_sessions())
+
+
+async def close_db():
+    """Закрытие пула соединений с БД"""
+    # Сначала дописываем все накопленные оценки
+    await rating_queue.close()
+    await storage_maintenance.stop()
+    await db_pool.close()
+    logger.info(f"Статистика кэша сессий: {session_cache.stats()}")
+
+
+@instrument_handler
 async def start(update: Update, context: CallbackContext) -> None:
     """Обработчик команды /start."""
     user = update.effective_user
     user_id = user.id
 
-    # Единая проверка прогресса
-    progress = await get_progress(user_id)
+    # Единая проверка прогресса: сессии восстанавливаются в user_data при запуске,
+    # в БД идём только если её там нет
+    data = context.user_data
+    progress = snapshot_progress(data) if data.get('current_theme') else await get_progress(user_id)
     if progress:
         await continue_progress(update, context, progress)
         return
@@ -154,7 +250,7 @@ async def start(update: Update, context: CallbackContext) -> None:
     completed_themes = await get_completed_themes(user_id)
 
     # Какие темы ещё не пройдены
-    all_themes = list(THEMES.keys())
+    all_themes = list(catalog.current().themes)
     unfinished = [t for t in all_themes if t not in completed_themes]
 
     if not unfinished:
@@ -171,13 +267,9 @@ async def start(update: Update, context: CallbackContext) -> None:
         await continue_progress(update, context, progress)
         return
     
-    # Начинаем новую сессию
-    # Берём одну случайную тему из непройденных
-    chosen_theme = random.choice(unfinished)
-
-    # Перемешиваем 3 видео этой темы
-    videos = THEMES[chosen_theme][:]
-    random.shuffle(videos)
+    # Начинаем новую сессию: наименее показанная тема из непройденных
+    # и наименее использованный порядок видео
+    chosen_theme, _, videos = assignments.assign(catalog.current(), unfinished)
 
     context.user_data.update({
         'current_theme': chosen_theme,
@@ -193,7 +285,7 @@ async def start(update: Update, context: CallbackContext) -> None:
     await update.message.reply_text(
         f"Здравствуй, {user.first_name}!\n"
         f"Тебе выпала тема: {chosen_theme}\n"
-        "Сейчас покажу 3 видео. Каждое видео нужно будет оценить по 5 критериям: логичность, информативность, интересность и естественность текста, а также степень согласованности невербальных сигналов содержанию текста.\n"
+        f"Сейчас покажу {len(videos)} видео. Каждое видео нужно будет оценить по 5 критериям: логичность, информативность, интересность и естественность текста, а также степень согласованности невербальных сигналов содержанию текста.\n"
         "В конце нужно будет выбрать лучшее видео, представившее данную тему, и сказать почему.\n\n"
         f"Всего тем: {len(all_themes)}, вы прошли: {len(completed_themes)}, осталось: {len(unfinished)}."
     )
@@ -217,18 +309,7 @@ async def send_video(update: Update, context: CallbackContext) -> None:
         await ask_favorite_video(update, context)
         return
 
-    current_video_id = videos[idx]
-    await context.bot.send_video(
-        chat_id=update.effective_chat.id,
-        video=current_video_id,
-        caption=(
-            f"Тема: {data['current_theme']}\n"
-            f"Видео {idx+1} из {len(videos)}\n"
-            f"Критерий №{data['current_criterion']+1}: {CRITERIA[data['current_criterion']]}"
-        )
-    )
-
-    if data["current_criterion"] >= len(CRITERIA):
+    if data["current_criterion"] >= len(catalog.current().criteria):
         # Если уже всё оценили для данного видео
         # переход к следующему
         data["video_index"] += 1
@@ -236,39 +317,51 @@ async def send_video(update: Update, context: CallbackContext) -> None:
         await send_video(update, context)
         return
 
-    # Спрашиваем конкретный критерий
-    await ask_criterion(update, context)
+    # Видео, текущий критерий и кнопки оценки - одним сообщением
+    await context.bot.send_video(
+        chat_id=update.effective_chat.id,
+        video=videos[idx],
+        caption=criterion_caption(data),
+        reply_markup=rating_keyboard(idx, data["current_criterion"])
+    )
 
 
-async def ask_criterion(update: Update, context: CallbackContext) -> None:
-    """
-    Выводит кнопки 1..5 для текущего критерия. 
-    """
-    data = context.user_data
-    c_idx = data["current_criterion"]
-    if c_idx >= len(CRITERIA):
-        await update.message.reply_text("Все критерии пройдены.")
-        return
+def video_caption(data: dict) -> str:
+    return (
+        f"Тема: {data['current_theme']}\n"
+        f"Видео {data['video_index']+1} из {len(data['videos'])}"
+    )
 
-    criterion = CRITERIA[c_idx]
-    hint_text = CRITERIA_HINTS[c_idx]
-    keyboard = [
-        [
-            InlineKeyboardButton(f"{i}", callback_data=f"rating-{i}") 
-            for i in range(1, 6)
-        ]
-    ]
-    markup = InlineKeyboardMarkup(keyboard)
-    await update.effective_chat.send_message(
-        text=f"{criterion}\n{hint_text}\nВыберите оценку от 1 до 5:",
-        reply_markup=markup
+
+def criterion_caption(data: dict) -> str:
+    """Подпись к видео с текущим критерием и подсказкой по шкале"""
+    c_idx = data["current_criterion"]
+    current = catalog.current()
+    return (
+        f"{video_caption(data)}\n"
+        f"Критерий №{c_idx+1}: {current.criteria[c_idx]}\n"
+        f"{current.hints[c_idx]}\n"
+        "Выберите оценку от 1 до 5:"
     )
 
+
+async def edit_rating_message(query, text: str, reply_markup=None) -> None:
+    """Редактирует сообщение с кнопками оценки на месте (подпись видео или текст)"""
+    if query.message and query.message.text is not None:
+        await query.edit_message_text(text=text, reply_markup=reply_markup)
+    else:
+        await query.edit_message_caption(caption=text, reply_markup=reply_markup)
+
+@instrument_handler
 async def handle_rating(update: Update, context: CallbackContext) -> None:
     """Обработка нажатия кнопок rating-X."""
     try:
         query = update.callback_query
-        await query.answer()
+        # Повторная доставка того же нажатия
+        if processed_callbacks.seen(query.id):
+            DUPLICATE_CALLBACKS.inc("query")
+            return
+        await query.answer("Спасибо!")
 
         data = context.user_data
         
@@ -278,54 +371,74 @@ async def handle_rating(update: Update, context: CallbackContext) -> None:
         data.setdefault('videos', [])
         data.setdefault('current_score', {})
 
-        if not query.data.startswith("rating-"):
+        match = RATING_DATA.match(query.data)
+        if not match:
             return
 
-        rating_str = query.data.split('-')[1]
-        rating = int(rating_str)
+        rating = int(match[1])
 
-        # Выключаем кнопки
-        await query.edit_message_reply_markup(reply_markup=None)
-
-        data = context.user_data
         c_idx = data['current_criterion']
-        criterion = CRITERIA[c_idx]
-
-        # Сохраняем оценку
-        await save_rating(
-            user_id=query.from_user.id,
-            theme=data['current_theme'],
-            video_id=data['videos'][data['video_index']],
-            criterion=criterion,
-            score=rating
-        )
-
-        # После сохранения оценки:
-        if data['current_criterion'] >= len(CRITERIA):
+        criteria = catalog.current().criteria
+        if not data['videos'] or data['video_index'] >= len(data['videos']) or c_idx >= len(criteria):
+            # Все видео уже оценены или сессии нет (сброс, устаревшая сессия) -
+            # нажатие на старое сообщение
+            DUPLICATE_CALLBACKS.inc("stale")
+            return
+        criterion = criteria[c_idx]
+        video_id = data['videos'][data['video_index']]
+        if match[2] is not None and (int(match[2]), int(match[3])) != (data['video_index'], c_idx):
+            # Кнопка уже пройденного шага (второе нажатие, старое сообщение)
+            DUPLICATE_CALLBACKS.inc("stale")
+            return
+        # Оценка этого шага уже принята (например, сессия откатилась к старому
+        # прогрессу): в БД её не пишем, только продвигаем прогресс
+        rated_key = (query.from_user.id, data.get('current_theme'), video_id, criterion)
+        duplicate = rated_key in rated_keys
+        rated_caption = video_caption(data)
+
+        # Сначала продвигаем состояние, затем пишем оценку и новый прогресс
+        # одной транзакцией: при восстановлении сессия продолжится ровно
+        # со следующего критерия (или видео)
+        step = (data['video_index'], data['current_criterion'])
+        data['current_criterion'] += 1
+        video_done = data['current_criterion'] >= len(criteria)
+        if video_done:
             data['video_index'] += 1
-            data['current_criterion'] = 0  # Сброс перед сохранением
-        
+            data['current_criterion'] = 0
+        if duplicate:
+            DUPLICATE_CALLBACKS.inc("rating")
+            await save_progress(data, query.from_user.id)
         else:
-            data['current_criterion'] += 1
-        
-        await save_progress(data, query.from_user.id)  # Обновить прогресс
+            try:
+                await record_rating(query.from_user.id, video_id, criterion, rating, data)
+            except Exception as e:
+                # Оценка не записана: возвращаемся к этому же шагу, кнопки под
+                # сообщением остаются прежними и снова подходят к состоянию
+                data['video_index'], data['current_criterion'] = step
+                logger.error(f"Record rating error: {e}", exc_info=True)
+                await context.bot.send_message(
+                    chat_id=update.effective_chat.id,
+                    text="❌ Не удалось сохранить оценку. Нажмите на оценку ещё раз."
+                )
+                return
+            rated_keys.seen(rated_key)
 
-        if data['current_criterion'] < len(CRITERIA):
-            await query.message.reply_text("Спасибо! Следующий критерий:")
-            await ask_criterion(update, context)
+        if not video_done:
+            # Тот же ролик: меняем критерий в подписи, кнопки остаются
+            await edit_rating_message(
+                query, criterion_caption(data), rating_keyboard(data['video_index'], data['current_criterion'])
+            )
         else:
-            data['video_index'] += 1
-            data['current_criterion'] = 0  # Сброс критерия для нового видео
+            # Видео оценено: убираем кнопки со старого сообщения
+            await edit_rating_message(query, f"{rated_caption}\n✅ Оценки сохранены")
 
             if data['video_index'] < len(data['videos']):
-                await query.message.reply_text("Спасибо! Переходим к следующему видео.")
                 await send_video(update, context)
             else:
-                await query.message.reply_text(
-                    f"Все 3 видео по теме {data['current_theme']} просмотрены.\n"
-                    "Теперь выберите, какое понравилось больше всего:"
+                await ask_favorite_video(
+                    update, context,
+                    intro=f"Все {len(data['videos'])} видео по теме {data['current_theme']} просмотрены.\n"
                 )
-                await ask_favorite_video(update, context)
 
     except BadRequest as e:
         if "Query is too old" in str(e):
@@ -339,66 +452,189 @@ async def handle_rating(update: Update, context: CallbackContext) -> None:
             logger.error(f"BadRequest: {e}")
 
 
-async def save_rating(user_id: int, theme: str, video_id: str, criterion: str, score: int):
-    """Сохранение оценки в БД"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
-            "INSERT INTO ratings VALUES (?, ?, ?, ?, ?)",
-            (user_id, theme, video_id, criterion, score)
-        )
-        await db.commit()
+RATING_INSERT = (
+    # Повторная оценка того же критерия отбрасывается уникальным ключом
+    "INSERT OR IGNORE INTO ratings (user_id, theme, video_id, criterion, score) "
+    "VALUES (?, ?, ?, ?, ?)"
+)
 
+# Один UPSERT вместо DELETE + INSERT
+PROGRESS_UPSERT = (
+    "INSERT INTO progress (user_id, theme_id, order_index, video_index, current_criterion, "
+    "waiting_for_best_reason) VALUES (?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT(user_id) DO UPDATE SET "
+    "theme_id = excluded.theme_id, order_index = excluded.order_index, "
+    "video_index = excluded.video_index, current_criterion = excluded.current_criterion, "
+    "waiting_for_best_reason = excluded.waiting_for_best_reason, "
+    "updated_at = julianday('now')"
+)
+
+
+def snapshot_progress(data: dict) -> dict:
+    """Копия прогресса из user_data в том виде, в каком его хранят кэш и БД"""
+    # Проверяем обязательные ключи
+    required_keys = ['current_theme', 'videos', 'video_index', 'current_criterion', 'current_score']
+    if not all(key in data for key in required_keys):
+        raise ValueError("Invalid data structure")
+    return {
+        'current_theme': data['current_theme'],
+        'videos': list(data['videos']),
+        'video_index': data['video_index'],
+        'current_criterion': data['current_criterion'],
+        'current_score': data.get('current_score', {}),
+        'waiting_for_best_reason': bool(data.get('waiting_for_best_reason', False))
+    }
+
+
+async def progress_params(progress: dict, user_id: int) -> tuple:
+    """Параметры PROGRESS_UPSERT: тема - id из таблицы themes, порядок видео - номер перестановки"""
+    theme_id = await get_theme_id(progress['current_theme'])
+    order_index = catalog.current().order_index(progress['current_theme'], progress['videos'])
+    return (
+        user_id,
+        theme_id,
+        order_index,
+        progress['video_index'],
+        progress['current_criterion'],
+        int(progress['waiting_for_best_reason'])
+    )
 
+
+@instrument_db
+async def record_rating(user_id: int, video_id: str, criterion: str, score: int, data: dict):
+    """Оценка и уже продвинутый прогресс записываются одной транзакцией.
+
+    Обе строки идут одной группой через очередь групповой записи, поэтому
+    после сбоя в БД либо есть и оценка, и новый прогресс, либо ни того, ни другого.
+    Ошибка записи пробрасывается: обработчик откатывает шаг и просит нажать ещё раз.
+    """
+    try:
+        progress = snapshot_progress(data)
+        params = await progress_params(progress, user_id)
+        written = rating_queue.put_many([
+            (RATING_INSERT, (user_id, progress['current_theme'], video_id, criterion, score)),
+            (PROGRESS_UPSERT, params)
+        ])
+        persistence.mark_written(user_id, data)
+        await written
+        session_cache.set(user_id, 'progress', progress)
+    except Exception:
+        session_cache.invalidate(user_id, 'progress')
+        raise
+
+
+@instrument_db
 async def save_progress(data: dict, user_id: int):
     """Сохранение прогресса в БД"""
     try:
-        # Проверяем обязательные ключи
-        required_keys = ['current_theme', 'videos', 'video_index', 'current_criterion', 'current_score']
-        if not all(key in data for key in required_keys):
-            raise ValueError("Invalid data structure")
-        
-        async with aiosqlite.connect(DB_NAME) as db:
-            async with db.execute("BEGIN"):
-                # Удаляем старый прогресс
-                await db.execute("DELETE FROM progress WHERE user_id = ?", (user_id,))
-                # Добавляем новый
-                await db.execute(
-                    "INSERT INTO progress VALUES (?, ?, ?, ?, ?, ?, ?)",
-                    (
-                        user_id,
-                        data['current_theme'],
-                        json.dumps(data['videos']),
-                        data['video_index'],
-                        data['current_criterion'],
-                        json.dumps(data.get('current_score', {})),
-                        data.get('waiting_for_best_reason', False)
-                    )
-                )
-                await db.commit()
+        progress = snapshot_progress(data)
+        params = await progress_params(progress, user_id)
+        # Все записи прогресса идут через одну очередь, чтобы сохранялся их порядок
+        written = rating_queue.put(PROGRESS_UPSERT, params)
+        persistence.mark_written(user_id, data)
+        await written
+        session_cache.set(user_id, 'progress', progress)
     except Exception as e:
+        session_cache.invalidate(user_id, 'progress')
         logger.error(f"Save progress error: {e}", exc_info=True)    
 
 
+@instrument_db
+async def load_sessions() -> dict:
+    """Все незавершённые сессии {user_id: user_data} - одним запросом при запуске"""
+    current = catalog.current()
+    sessions = {}
+    async with db_pool.acquire() as db:
+        async with db.execute(
+            "SELECT p.user_id, t.name, p.order_index, p.video_index, p.current_criterion, "
+            "p.waiting_for_best_reason FROM progress p JOIN themes t ON t.id = p.theme_id"
+        ) as cursor:
+            async for user_id, theme, order_index, video_index, current_criterion, waiting in cursor:
+                if theme not in current.themes:
+                    # Тему убрали из каталога: continue_progress сбросит сессию по /start
+                    continue
+                progress = {
+                    'current_theme': theme,
+                    'videos': current.order_videos(theme, order_index),
+                    'video_index': video_index,
+                    'current_criterion': current_criterion,
+                    'current_score': {},
+                    'waiting_for_best_reason': bool(waiting)
+                }
+                sessions[user_id] = dict(progress)
+                session_cache.set(user_id, 'progress', progress)
+    return sessions
+
+
+@instrument_db
+async def save_sessions(batch: list, is_fresh):
+    """Пачка сессий [(user_id, версия снимка, user_data)] от persistence - одной транзакцией"""
+    prepared = []
+    for user_id, version, data in batch:
+        if not data.get('current_theme'):
+            # Пустые user_data - тема завершена или не начата, прогресс уже удалён
+            continue
+        try:
+            progress = snapshot_progress(data)
+            params = await progress_params(progress, user_id)
+        except Exception as e:
+            logger.error(f"Сессия {user_id} не сохранена: {e}")
+            continue
+        prepared.append((user_id, version, progress, params))
+    # Проверка свежести и постановка в очередь - без await между ними:
+    # очередь пишет по порядку, более новая запись бота не будет перезаписана
+    fresh = [item for item in prepared if is_fresh(item[0], item[1])]
+    if not fresh:
+        return
+    await rating_queue.put_many([(PROGRESS_UPSERT, params) for _, _, _, params in fresh])
+    for user_id, _, progress, _ in fresh:
+        session_cache.set(user_id, 'progress', progress)
+
+
+@instrument_db
+async def get_theme_id(theme: str) -> int:
+    """id темы в таблице themes (тема добавляется при первом обращении)"""
+    theme_id = theme_ids.get(theme)
+    if theme_id is None:
+        async with db_pool.acquire() as db:
+            await db.execute("INSERT OR IGNORE INTO themes (name) VALUES (?)", (theme,))
+            async with db.execute("SELECT id FROM themes WHERE name = ?", (theme,)) as cursor:
+                theme_id = (await cursor.fetchone())[0]
+        theme_ids[theme] = theme_id
+    return theme_id
+
+
+@instrument_db
 async def get_progress(user_id: int) -> dict:
-    """Получение прогресса из БД"""
+    """Получение прогресса (из кэша или БД)"""
+    cached = session_cache.get(user_id, 'progress')
+    if cached is not MISSING:
+        return cached
     try:
-        async with aiosqlite.connect(DB_NAME) as db:
-            cursor = await db.execute("SELECT * FROM progress WHERE user_id = ?", (user_id,))
-            row = await cursor.fetchone()
-            return {
-                'current_theme': row[1],
-                'videos': json.loads(row[2]),
-                'video_index': row[3],
-                'current_criterion': row[4],
-                'current_score': json.loads(row[5]),
-                'waiting_for_best_reason': bool(row[6])
-            } if row else None
+        async with db_pool.acquire() as db:
+            async with db.execute(
+                "SELECT t.name, p.order_index, p.video_index, p.current_criterion, "
+                "p.waiting_for_best_reason FROM progress p JOIN themes t ON t.id = p.theme_id "
+                "WHERE p.user_id = ?",
+                (user_id,)
+            ) as cursor:
+                row = await cursor.fetchone()
+        progress = {
+            'current_theme': row[0],
+            'videos': catalog.current().order_videos(row[0], row[1]),
+            'video_index': row[2],
+            'current_criterion': row[3],
+            'current_score': {},
+            'waiting_for_best_reason': bool(row[4])
+        } if row else None
+        session_cache.set(user_id, 'progress', progress)
+        return progress
     except Exception as e:
         logging.error(f"Get progress error: {e}")
         return None
 
 
-async def ask_favorite_video(update: Update, context: CallbackContext) -> None:
+async def ask_favorite_video(update: Update, context: CallbackContext, intro: str = "") -> None:
     """Спрашивает, какое из 3 видео было лучшим."""
     data = context.user_data
     videos = data['videos']
@@ -409,14 +645,14 @@ async def ask_favorite_video(update: Update, context: CallbackContext) -> None:
     markup = InlineKeyboardMarkup(keyboard)
 
     await update.effective_chat.send_message(
-        text="Какое видео было лучшим?",
+        text=f"{intro}Какое видео было лучшим?",
         reply_markup=markup
     )
 
 
 async def continue_progress(update: Update, context: CallbackContext, progress: dict):
     data = context.user_data
-    data.clear()
+    reset_session(data)
     try:
         # Проверяем наличие всех необходимых ключей
         required_keys = ['current_theme', 'videos', 'video_index', 'current_criterion']
@@ -425,11 +661,12 @@ async def continue_progress(update: Update, context: CallbackContext, progress:
 
         # Восстанавливаем videos даже если сессия была на этапе выбора лучшего
         if 'videos' not in progress:
-            progress['videos'] = THEMES.get(progress['current_theme'], [])
+            progress['videos'] = list(catalog.current().themes.get(progress['current_theme'], ()))
 
         # Корректируем индексы
-        progress['video_index'] = min(progress['video_index'], len(progress['videos']) - 1)
-        progress['current_criterion'] = min(progress['current_criterion'], len(CRITERIA) - 1)
+        # video_index == len(videos) - этап выбора лучшего видео
+        progress['video_index'] = min(progress['video_index'], len(progress['videos']))
+        progress['current_criterion'] = min(progress['current_criterion'], len(catalog.current().criteria) - 1)
 
         # Восстанавливаем данные
         data.update({
@@ -465,7 +702,8 @@ async def continue_progress(update: Update, context: CallbackContext, progress:
 
     except Exception as e:
         logger.error(f"Ошибка восстановления: {e}")
-        await clear_progress(update.effective_user.id)
+        reset_session(data)
+        await clear_progress(update.effective_user.id, data)
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text="❌ Не удалось восстановить сессию. Начинаем новую тему."
@@ -473,10 +711,14 @@ async def continue_progress(update: Update, context: CallbackContext, progress:
         await start(update, context)
 
 
+@instrument_handler
 async def handle_favorite_video(update: Update, context: CallbackContext) -> None:
     """Обрабатывает нажатие best-X."""
     try:
         query = update.callback_query
+        if processed_callbacks.seen(query.id):
+            DUPLICATE_CALLBACKS.inc("query")
+            return
         await query.answer()
         
         data = context.user_data
@@ -507,9 +749,8 @@ async def handle_favorite_video(update: Update, context: CallbackContext) -> Non
             video_id=best_video_id
         )
 
-        # Просим указать причину
+        # Просим указать причину; прогресс с этим флагом запишет persistence
         data['waiting_for_best_reason'] = True
-        await save_progress(data, query.from_user.id)
         await query.message.reply_text(
             "Почему вам показалось это видео самым удачным?\n"
             "Введите ваш ответ сообщением в чат.\n\n"
@@ -536,15 +777,16 @@ async def handle_favorite_video(update: Update, context: CallbackContext) -> Non
             text="❌ Произошла ошибка. Продолжите ввод причины."
         )
 
+@instrument_db
 async def save_best_video(user_id: int, theme: str, video_id: str):
     """Сохраняет выбор лучшего видео в БД"""
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with db_pool.transaction() as db:
         await db.execute(
             "INSERT OR REPLACE INTO best_videos (user_id, theme, video_id) VALUES (?, ?, ?)",
             (user_id, theme, video_id)
         )
-        await db.commit()
 
+@instrument_handler
 async def handle_best_reason_message(update: Update, context: CallbackContext) -> None:
     data = context.user_data
     if data.get('waiting_for_best_reason'):
@@ -556,10 +798,15 @@ async def handle_best_reason_message(update: Update, context: CallbackContext) -
             if not theme or not reason:
                 raise ValueError("Недостаточно данных")
 
-            await save_best_reason(user_id, theme, reason)
-            await mark_theme_completed(user_id, theme)
-            await clear_progress(user_id)
-            data.clear()
+            # Сессия очищается до ожидания записи: снимок persistence, сделанный
+            # после этого, пуст и не вернёт прогресс завершённой темы
+            session = dict(data)
+            reset_session(data)
+            try:
+                await complete_theme(user_id, theme, reason, data)
+            except Exception:
+                data.update(session)
+                raise
 
             await update.message.reply_text("✅ Спасибо! Ответ сохранён. Используйте /start для новых тем.")
 
@@ -572,48 +819,152 @@ async def handle_best_reason_message(update: Update, context: CallbackContext) -
             )
 
 
-async def save_best_reason(user_id: int, theme: str, reason: str):
-    """Обновляет запись с лучшим видео, добавляя причину"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
-            """UPDATE best_videos 
-            SET reason = ? 
-            WHERE user_id = ? AND theme = ?""",
+@instrument_db
+async def complete_theme(user_id: int, theme: str, reason: str, data: dict):
+    """Причина выбора, отметка о завершении темы и удаление прогресса - одной транзакцией"""
+    session_cache.invalidate(user_id, 'completed_themes')
+    session_cache.invalidate(user_id, 'progress')
+    written = rating_queue.put_many([
+        (
+            "UPDATE best_videos SET reason = ?, updated_at = julianday('now') "
+            "WHERE user_id = ? AND theme = ?",
             (reason, user_id, theme)
-        )
-        await db.commit()
-
-
-async def mark_theme_completed(user_id: int, theme: str):
-    """Помечает тему как завершенную"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
-            "INSERT INTO completed_themes VALUES (?, ?)",
-            (user_id, theme)
-        )
-        await db.commit()
-
-async def clear_progress(user_id: int):
+        ),
+        # Повторное завершение (например, после сбоя отправки ответа) не ошибка
+        ("INSERT OR IGNORE INTO completed_themes (user_id, theme) VALUES (?, ?)", (user_id, theme)),
+        ("DELETE FROM progress WHERE user_id = ?", (user_id,))
+    ])
+    persistence.mark_written(user_id, data)
+    await written
+    session_cache.invalidate(user_id, 'completed_themes')
+    session_cache.set(user_id, 'progress', None)
+
+@instrument_db
+async def clear_progress(user_id: int, data: dict):
     """Удаляет запись о прогрессе"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
-            "DELETE FROM progress WHERE user_id = ?",
-            (user_id,)
-        )
-        await db.commit()
+    session_cache.invalidate(user_id, 'progress')
+    written = rating_queue.put("DELETE FROM progress WHERE user_id = ?", (user_id,))
+    persistence.mark_written(user_id, data)
+    await written
+    session_cache.set(user_id, 'progress', None)
 
 
+@instrument_db
 async def get_completed_themes(user_id: int) -> list:
-    """Получение завершенных тем"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute(
+    """Получение завершенных тем (из кэша или БД)"""
+    cached = session_cache.get(user_id, 'completed_themes')
+    if cached is not MISSING:
+        return list(cached)
+    async with db_pool.acquire() as db:
+        async with db.execute(
             "SELECT theme FROM completed_themes WHERE user_id = ?",
             (user_id,)
-        )
-        result = await cursor.fetchall()
-        return [row[0] for row in result]
+        ) as cursor:
+            result = await cursor.fetchall()
+    completed = frozenset(row[0] for row in result)
+    session_cache.set(user_id, 'completed_themes', completed)
+    return list(completed)
+
+
+@instrument_db
+async def get_past_sessions() -> list:
+    """Прошлые сессии (theme, file_id в порядке показа) для восстановления назначений.
+
+    Для текущих сессий порядок берётся из progress, для остальных -
+    по первой оценке каждого видео; пройденные темы без оценок дают только тему.
+    """
+    current = catalog.current()
+    sessions = {}
+    async with db_pool.acquire() as db:
+        async with db.execute("SELECT user_id, theme FROM completed_themes") as cursor:
+            async for user_id, theme in cursor:
+                sessions[(user_id, theme)] = []
+        async with db.execute(
+            "SELECT user_id, theme, video_id FROM ratings "
+            "GROUP BY user_id, theme, video_id ORDER BY user_id, theme, MIN(id)"
+        ) as cursor:
+            async for user_id, theme, video_id in cursor:
+                sessions.setdefault((user_id, theme), []).append(video_id)
+        async with db.execute(
+            "SELECT p.user_id, t.name, p.order_index FROM progress p JOIN themes t ON t.id = p.theme_id"
+        ) as cursor:
+            async for user_id, theme, order_index in cursor:
+                if theme in current.themes:
+                    sessions[(user_id, theme)] = current.order_videos(theme, order_index)
+    return [(theme, shown) for (_, theme), shown in sessions.items()]
+
+
+@instrument_db
+async def get_rating_stats() -> list:
+    """Агрегаты оценок (theme, video_id, criterion, n, total, total_sq)"""
+    async with db_pool.acquire() as db:
+        async with db.execute(
+            "SELECT theme, video_id, criterion, n, total, total_sq FROM rating_stats WHERE n > 0"
+        ) as cursor:
+            return await cursor.fetchall()
+
+
+def summarize(n: int, total: int, total_sq: int) -> tuple:
+    """Среднее и стандартное отклонение по n, сумме и сумме квадратов"""
+    mean = total / n
+    variance = (total_sq - total * total / n) / (n - 1) if n > 1 else 0.0
+    return mean, math.sqrt(max(variance, 0.0))
+
+
+@instrument_handler
+async def stats(update: Update, context: CallbackContext) -> None:
+    """Команда /stats для администраторов: средние оценки по вариантам видео"""
+    rows = await get_rating_stats()
+    if not rows:
+        await update.message.reply_text("Оценок пока нет.")
+        return
+
+    current = catalog.current()
+    # theme -> variant -> criterion -> [n, total, total_sq]
+    grouped = {}
+    for theme, video_id, criterion, n, total, total_sq in rows:
+        variant = current.variant(video_id)
+        acc = grouped.setdefault(theme, {}).setdefault(variant, {}).setdefault(criterion, [0, 0, 0])
+        acc[0] += n
+        acc[1] += total
+        acc[2] += total_sq
+
+    lines = []
+    for theme, variants in grouped.items():
+        lines.append(f"📊 {theme}")
+        for variant, criteria in sorted(variants.items()):
+            lines.append(f"  {variant}:")
+            for criterion in current.criteria:
+                if criterion not in criteria:
+                    continue
+                n, total, total_sq = criteria[criterion]
+                mean, sd = summarize(n, total, total_sq)
+                lines.append(f"    {criterion}: {mean:.2f} ± {sd:.2f} (n={n})")
+    await update.message.reply_text("\n".join(lines))
+
+
+@instrument_handler
+async def export_results(update: Update, context: CallbackContext) -> None:
+    """Команда /export для администраторов: свежая выгрузка в Excel файлом"""
+    await update.message.reply_text("⏳ Готовлю выгрузку...")
+    try:
+        await export_runner.run()
+    except Exception as e:
+        logger.error(f"Ошибка экспорта: {e}", exc_info=True)
+        await update.message.reply_text("⚠️ Не удалось выгрузить данные, подробности в логе бота.")
+        return
+    await update.message.reply_document(document=EXPORT_PATH, filename=EXPORT_PATH.name)
+
+
+async def scheduled_export(context: CallbackContext) -> None:
+    """Задача JobQueue: периодический экспорт (пропускается, если данные не менялись)"""
+    try:
+        await export_runner.run()
+    except Exception as e:
+        logger.error(f"Ошибка периодического экспорта: {e}", exc_info=True)
 
 
+@instrument_handler
 async def handle_video(update: Update, context: CallbackContext) -> None:
     """Если пользователь присылает видео, выводим file_id для справки."""
     if update.message.video:
@@ -624,8 +975,7 @@ async def handle_video(update: Update, context: CallbackContext) -> None:
 
 async def shutdown(application: Application):
     """Корректное завершение работы бота."""
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.close()
+    await close_db()
     await application.stop()
     await application.updater.stop()
     await application.update_queue.put(None)
@@ -647,13 +997,68 @@ def handle_shutdown(signum, loop, application):
     loop.create_task(shutdown(application))
 
 
-async def main():
-    """Запуск бота."""
-    await init_db()
-    application = Application.builder().token(BOT_TOKEN).build()
+def reload_catalog():
+    """SIGHUP: перечитать catalog.json без перезапуска бота"""
+    catalog.reload()
+
+
+async def post_init(application: Application) -> None:
+    """Запускает сервер метрик, если он включён, периодический экспорт
+    и включает перезагрузку каталога по SIGHUP"""
+    if metrics_server:
+        await metrics_server.start()
+    if EXPORT_INTERVAL > 0:
+        if application.job_queue is None:
+            logger.warning("Периодический экспорт выключен: нужен python-telegram-bot[job-queue]")
+        else:
+            application.job_queue.run_repeating(
+                scheduled_export, interval=EXPORT_INTERVAL, first=EXPORT_INTERVAL, name="export"
+            )
+    if hasattr(signal, "SIGHUP"):
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, reload_catalog)
+        except (NotImplementedError, RuntimeError):
+            # Обработчики сигналов доступны только в главном потоке и не на Windows
+            pass
+
+
+async def post_shutdown(application: Application) -> None:
+    """Закрывает ресурсы после остановки Application"""
+    if metrics_server:
+        await metrics_server.stop()
+    # Дожидаемся идущего экспорта, чтобы не оставить временный файл
+    await asyncio.to_thread(export_runner.shutdown)
+    await close_db()
+
+
+def build_application(builder=None) -> Application:
+    """Создаёт Application и регистрирует обработчики.
+
+    builder позволяет подменить настройки (например, слой запросов
+    в нагрузочном тесте); по умолчанию используется токен из token/config.txt.
+    """
+    if builder is None:
+        builder = (
+            Application.builder()
+            .token(read_token())
+            # Каждый вызов Bot API попадает в метрики
+            .request(InstrumentedRequest(HTTPXRequest(connection_pool_size=256)))
+        )
+    application = (
+        builder
+        .application_class(UserOrderedApplication, kwargs={'update_limit': CONCURRENT_UPDATES})
+        .concurrent_updates(PENDING_UPDATES_LIMIT)
+        .rate_limiter(send_scheduler)
+        .persistence(persistence)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     application.add_error_handler(error_handler)
     application.add_handler(CommandHandler('start', start))
-    application.add_handler(CallbackQueryHandler(handle_rating, pattern=r'^rating-\d$'))
+    application.add_handler(CommandHandler('stats', stats, filters=filters.User(user_id=ADMIN_IDS)))
+    application.add_handler(CommandHandler('export', export_results, filters=filters.User(user_id=ADMIN_IDS)))
+    application.add_handler(CallbackQueryHandler(handle_rating, pattern=r'^rating-\d(:\d+:\d+)?$'))
     application.add_handler(CallbackQueryHandler(handle_favorite_video, pattern=r'^best-\d$'))
     # Обработка входящих видео (выдаём file_id)
     application.add_handler(MessageHandler(filters.VIDEO & ~filters.COMMAND, handle_video))
@@ -662,8 +1067,104 @@ async def main():
     application.add_handler(
         MessageHandler(filters.TEXT & ~filters.COMMAND, handle_best_reason_message)
     )
+    return application
+
+
+def worker_envs(secret: str) -> list:
+    """Переменные окружения воркеров шардированного режима"""
+    envs = []
+    for i in range(SHARDS):
+        env = {
+            "BOT_MODE": "worker",
+            "BOT_DB_PATH": str(shard_db_path(DB_PATH, i)),
+            "WORKER_PORT": str(SHARD_BASE_PORT + i),
+            "WORKER_SECRET": secret,
+            # Общий лимит Telegram делится между воркерами
+            "SEND_GLOBAL_RATE": str(SEND_GLOBAL_RATE / SHARDS),
+            # /export в любом воркере выгружает все шарды; периодически - только воркер 0
+            "EXPORT_DB_PATH": str(DB_PATH),
+        }
+        if i > 0:
+            env["EXPORT_INTERVAL"] = "0"
+        if METRICS_PORT:
+            env["METRICS_PORT"] = str(METRICS_PORT + 1 + i)
+        envs.append(env)
+    return envs
+
+
+async def run_sharded():
+    """Диспетчер: принимает обновления и раздаёт их воркерам по user_id"""
+    # Пользователи обычной БД переносятся в шарды до запуска воркеров
+    try:
+        await asyncio.to_thread(prepare_shards, DB_PATH, SHARDS)
+    except ShardLayoutError as e:
+        logging.critical(f"❌ {e}")
+        exit(1)
+    secret = secrets.token_urlsafe(32)
+    webhook = None
+    if WEBHOOK_SECRET:
+        webhook = {
+            "host": WEBHOOK_LISTEN,
+            "port": WEBHOOK_PORT,
+            "path": WEBHOOK_PATH,
+            "secret_token": WEBHOOK_SECRET,
+            "url": WEBHOOK_URL or None,
+        }
+    if metrics_server:
+        await metrics_server.start()
+    try:
+        await run_dispatcher(
+            Bot(read_token()),
+            worker_command=[sys.executable, str(Path(__file__).resolve())],
+            worker_envs=worker_envs(secret),
+            worker_urls=[f"http://127.0.0.1:{SHARD_BASE_PORT + i}{WORKER_PATH}" for i in range(SHARDS)],
+            secret=secret,
+            webhook=webhook,
+            max_queue=SHARD_QUEUE_LIMIT
+        )
+    finally:
+        if metrics_server:
+            await metrics_server.stop()
+
 
-    await application.run_polling()
+async def main():
+    """Запуск бота."""
+    if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+        logging.critical("❌ Для режима webhook нужно задать WEBHOOK_SECRET")
+        exit(1)
+    if BOT_MODE == "worker" and not (WORKER_PORT and WORKER_SECRET):
+        logging.critical("❌ Воркер запускается диспетчером (BOT_MODE=sharded)")
+        exit(1)
+    try:
+        catalog.current()
+    except catalog.CatalogError as e:
+        logging.critical(f"❌ {e}")
+        exit(1)
+    if BOT_MODE == "sharded":
+        # Диспетчер не работает с БД: у каждого воркера своя
+        await run_sharded()
+        return
+    await init_db()
+    application = build_application()
+    if BOT_MODE == "webhook":
+        await run_webhook(
+            application,
+            host=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            path=WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            webhook_url=WEBHOOK_URL or None
+        )
+    elif BOT_MODE == "worker":
+        await run_webhook(
+            application,
+            host="127.0.0.1",
+            port=WORKER_PORT,
+            path=WORKER_PATH,
+            secret_token=WORKER_SECRET
+        )
+    else:
+        await application.run_polling()
 
 
 if __name__ == "__main__":
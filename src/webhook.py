@@ -0,0 +1,93 @@
+import asyncio
+import hmac
+import json
+import logging
+import signal
+from telegram import Update
+from telegram.ext import Application
+from http_server import SimpleHTTPServer
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+
+
+class Overloaded(Exception):
+    """Получатель не успевает принять обновление: ответ 503, Telegram повторит его позже"""
+
+
+class WebhookServer(SimpleHTTPServer):
+    """Принимает обновления от Telegram (POST JSON) и передаёт их в Application"""
+
+    def __init__(self, application: Application, host: str, port: int, path: str, secret_token: str):
+        super().__init__(host, port)
+        self.application = application
+        self.path = path
+        self.secret_token = secret_token
+        self.route(path, self._receive)
+
+    async def _receive(self, method: str, headers: dict, body: bytes):
+        if method != "POST":
+            return 405, b"method not allowed\n", "text/plain"
+        if not hmac.compare_digest(headers.get(SECRET_HEADER, ""), self.secret_token):
+            logger.warning("Webhook: запрос с неверным секретным токеном")
+            return 403, b"forbidden\n", "text/plain"
+        try:
+            delivered = await self.deliver(json.loads(body))
+        except Overloaded as e:
+            logger.warning(f"Webhook: обновление не принято: {e}")
+            return 503, b"overloaded\n", "text/plain"
+        except Exception as e:
+            logger.error(f"Webhook: некорректное обновление: {e}")
+            return 400, b"bad request\n", "text/plain"
+        if not delivered:
+            return 400, b"bad request\n", "text/plain"
+        return 200, b"", "text/plain"
+
+    async def deliver(self, data: dict) -> bool:
+        """Передаёт проверенное обновление дальше; False - обновление пустое"""
+        update = Update.de_json(data, self.application.bot)
+        if update is None:
+            return False
+        await self.application.update_queue.put(update)
+        return True
+
+
+async def run_webhook(application: Application, host: str, port: int, path: str,
+                      secret_token: str, webhook_url: str = None):
+    """Запуск бота в режиме webhook до получения SIGINT/SIGTERM.
+
+    Если задан webhook_url, адрес регистрируется в Telegram через setWebhook;
+    без него сервер просто принимает обновления (удобно для локальной проверки).
+    """
+    server = WebhookServer(application, host, port, path, secret_token)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            # add_signal_handler недоступен на Windows
+            pass
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    try:
+        await server.start()
+        if webhook_url:
+            await application.bot.set_webhook(
+                url=webhook_url,
+                secret_token=secret_token,
+                allowed_updates=Update.ALL_TYPES
+            )
+        logger.info(f"Webhook принимает обновления на http://{host}:{server.port}{path}")
+        await stop.wait()
+    finally:
+        await server.stop()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+from itertools import groupby
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class WriteBehindQueue:
+    """Очередь отложенной записи с групповым коммитом.
+
+    Запросы от разных пользователей копятся в очереди и записываются одной
+    транзакцией, когда набирается max_batch строк или проходит max_delay
+    секунд с момента первой строки в пачке.
+
+    Элемент очереди - группа запросов, которые всегда попадают в одну
+    транзакцию; put/put_many возвращают future, завершающийся после коммита.
+    """
+
+    def __init__(self, pool, max_batch: int = 200, max_delay: float = 0.05):
+        self.pool = pool
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = None
+        self._worker = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._worker is not None
+
+    def qsize(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    async def start(self):
+        """Запускает фоновую задачу записи"""
+        if self.is_running:
+            return
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.create_task(self._run())
+
+    def put(self, sql: str, params: tuple) -> asyncio.Future:
+        """Ставит запрос в очередь, не дожидаясь записи"""
+        return self.put_many([(sql, params)])
+
+    def put_many(self, statements: list) -> asyncio.Future:
+        """Ставит группу запросов [(sql, params), ...], записываемую атомарно"""
+        if not self.is_running:
+            raise RuntimeError("Очередь записи не запущена")
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((list(statements), future))
+        return future
+
+    async def close(self):
+        """Дописывает всё, что накопилось в очереди, и останавливает задачу"""
+        if not self.is_running:
+            return
+        self._queue.put_nowait(_STOP)
+        await self._worker
+        self._worker = None
+        self._queue = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            rows = len(item[0])
+            deadline = loop.time() + self.max_delay
+            while rows < self.max_batch:
+                if self._queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    item = self._queue.get_nowait()
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+                rows += len(item[0])
+            await self._flush(batch)
+
+    async def _flush(self, batch: list):
+        """Записывает пачку одной транзакцией"""
+        statements = [statement for group, _ in batch for statement in group]
+        try:
+            async with self.pool.transaction() as db:
+                # Подряд идущие одинаковые запросы отправляем через executemany
+                for sql, group in groupby(statements, key=lambda item: item[0]):
+                    await db.executemany(sql, [params for _, params in group])
+        except Exception as e:
+            logger.error(f"Ошибка групповой записи ({len(statements)} строк): {e}", exc_info=True)
+            await self._flush_one_by_one(batch)
+            return
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+    async def _flush_one_by_one(self, batch: list):
+        """Повторная запись по одной группе, чтобы одна ошибка не теряла всю пачку"""
+        for group, future in batch:
+            try:
+                async with self.pool.transaction() as db:
+                    for sql, params in group:
+                        await db.execute(sql, params)
+            except Exception as e:
+                logger.error(f"Группа не записана: {group}: {e}")
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            if not future.done():
+                future.set_result(None)
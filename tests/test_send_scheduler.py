@@ -0,0 +1,72 @@
+"""Лимиты исходящих вызовов не должны тормозить нажатия оценок.
+
+Запуск: python -m pytest -q tests
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from send_scheduler import SendScheduler  # noqa: E402
+
+# Задержка, после которой нажатие считается упёршимся в лимит чата (1 в секунду)
+STALL = 0.5
+
+
+async def ok():
+    return True
+
+
+def test_edits_skip_chat_limit():
+    scheduler = SendScheduler(global_rate=30, chat_rate=1, chat_burst=3)
+
+    async def run():
+        started = time.perf_counter()
+        for _ in range(10):
+            await scheduler.process_request(ok, (), {}, "editMessageCaption", {"chat_id": 1}, None)
+        edits = time.perf_counter() - started
+        started = time.perf_counter()
+        for _ in range(4):
+            await scheduler.process_request(ok, (), {}, "sendMessage", {"chat_id": 1}, None)
+        return edits, time.perf_counter() - started
+
+    edits, sends = asyncio.run(run())
+    assert edits < STALL
+    # Новые сообщения сверх всплеска по-прежнему ждут лимита чата
+    assert sends >= 0.9
+
+
+def test_rating_taps_are_not_throttled():
+    # Настоящие обработчики с лимитами по умолчанию; tg_bot читает настройки при импорте
+    os.environ["BOT_DB_PATH"] = str(Path(tempfile.mkdtemp()) / "ratings.db")
+    os.environ["EXPORT_INTERVAL"] = "0"
+    import catalog
+    import load_test
+    import tg_bot
+
+    async def run():
+        load_test.quiet_logs()
+        application, _ = load_test.build_test_application(argparse.Namespace(api_latency=0))
+        await tg_bot.init_db()
+        await application.initialize()
+        try:
+            harness = load_test.LoadTest(application, think_time=0)
+            user = load_test.SyntheticUser(harness, 1)
+            await harness.send("start", user.command("start"))
+            # Все критерии первого видео, кроме последнего: каждое нажатие - только правка подписи
+            for step in range(len(catalog.current().criteria) - 1):
+                await harness.send("rating", user.callback(f"rating-4:0:{step}"))
+            return harness.latencies["rating"], harness.failed
+        finally:
+            await application.shutdown()
+            await tg_bot.close_db()
+
+    latencies, failed = asyncio.run(run())
+    assert not failed
+    assert len(latencies) >= 3
+    assert max(latencies) < STALL, latencies